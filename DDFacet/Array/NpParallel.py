@@ -136,6 +136,99 @@ def A_whereMaxParallel(A,NCPU=0,DoAbs=1,Mask=None):
     A=A.reshape(ShapeOrig)
     return i,j,V
 
+# tile size (in pixels along each axis) of WhereMaxIndex
+WHERE_MAX_TILE_SIZE=64
+
+class WhereMaxIndex():
+    """
+    Keeps the per-tile maxima of an image, so that the minor cycle loops can find the peak without scanning the
+    whole image on every iteration. A minor cycle iteration only changes a PSF-box-sized patch of the image:
+    after each such change, call update() with the edges of the patch, which recomputes the maxima of the tiles
+    it touches. whereMax() then only looks at the per-tile-row maxima and at the tiles holding the peak.
+
+    Returns the same x,y,max as A_whereMax(A,DoAbs=DoAbs,Mask=Mask) (the first peak in row-major order, with
+    pixels where Mask is set excluded), for an image A of shape [...,NX,NY], but note that A and Mask are
+    referenced, not copied: the image must be changed in place, and update() called for every change.
+    """
+    def __init__(self,A,DoAbs=1,Mask=None,TileSize=WHERE_MAX_TILE_SIZE):
+        NX,NY=A.shape[-2],A.shape[-1]
+        nz=A.size/(NX*NY)
+        self.A=A.reshape((nz,NX,NY))
+        self.Mask=Mask.reshape((nz,NX,NY)) if Mask is not None else None
+        self.DoAbs=DoAbs
+        self.TileSize=TileSize
+        self.NX,self.NY=NX,NY
+        ntx=(NX+TileSize-1)/TileSize
+        nty=(NY+TileSize-1)/TileSize
+        # TileMax[z,tx,ty]: max of the tile; RowMax[z,tx]: max over a row of tiles. Masked pixels count as -inf
+        self.TileMax=np.zeros((nz,ntx,nty),A.dtype)
+        self.RowMax=np.zeros((nz,ntx),A.dtype)
+        self.update(0,NX,0,NY)
+
+    def _give(self,z,x0,x1,y0,y1):
+        """Returns the values searched for the peak over a slice of the image, masked pixels set to -inf"""
+        A=self.A[z,x0:x1,y0:y1]
+        A=np.abs(A) if self.DoAbs else A
+        if self.Mask is not None:
+            A=np.where(self.Mask[z,x0:x1,y0:y1],A.dtype.type(-np.inf),A)
+        return A
+
+    def update(self,x0,x1,y0,y1):
+        """Recomputes the maxima of all tiles overlapping the [x0:x1,y0:y1] patch of the image"""
+        T=self.TileSize
+        x0,x1=max(x0,0),min(x1,self.NX)
+        y0,y1=max(y0,0),min(y1,self.NY)
+        if x0>=x1 or y0>=y1:
+            return
+        tx0,tx1=x0/T,(x1-1)/T+1
+        ty0,ty1=y0/T,(y1-1)/T+1
+        bx0,bx1=tx0*T,min(tx1*T,self.NX)
+        by0,by1=ty0*T,min(ty1*T,self.NY)
+        A=self._give(slice(None),bx0,bx1,by0,by1)
+        A=np.maximum.reduceat(A,np.arange(0,bx1-bx0,T),axis=1)
+        self.TileMax[:,tx0:tx1,ty0:ty1]=np.maximum.reduceat(A,np.arange(0,by1-by0,T),axis=2)
+        self.RowMax[:,tx0:tx1]=self.TileMax[:,tx0:tx1,:].max(axis=2)
+
+    def whereMax(self):
+        """Returns x,y,max of the peak, as A_whereMax() does"""
+        T=self.TileSize
+        M=self.RowMax.max()
+        if M==-np.inf:
+            raise ValueError("all pixels are masked")
+        # usually a single tile holds the peak, but in case of ties, pick the first one in row-major order, as
+        # A_whereMax() does
+        Best=None
+        for z,tx in zip(*np.where(self.RowMax==M)):
+            for ty in np.where(self.TileMax[z,tx]==M)[0]:
+                x0,y0=tx*T,ty*T
+                x,y=np.where(self._give(z,x0,x0+T,y0,y0+T)==M)
+                Peak=(z,x0+x[0],y0+y[0])
+                if Best is None or Peak<Best:
+                    Best=Peak
+        _,x,y=Best
+        return x,y,M
+
+    def wherePeaks(self,Threshold,MinSeparation,MaxPeaks):
+        """
+        Returns a list of up to MaxPeaks (x,y,max) peaks above Threshold, in order of decreasing value, such that
+        no two peaks are closer than MinSeparation pixels along both axes. Peaks are looked up per tile (at most
+        one per tile, its maximum), so only the tiles with a maximum above Threshold are scanned. The first peak
+        is the one whereMax() returns.
+        """
+        T=self.TileSize
+        ListPeaks=[self.whereMax()]
+        z,tx,ty=np.where(self.TileMax>=Threshold)
+        Vals=self.TileMax[z,tx,ty]
+        for i in np.argsort(-Vals,kind="mergesort"):
+            if len(ListPeaks)>=MaxPeaks:
+                break
+            x0,y0=tx[i]*T,ty[i]*T
+            x,y=np.where(self._give(z[i],x0,x0+T,y0,y0+T)==Vals[i])
+            x,y=x0+x[0],y0+y[0]
+            if all(abs(x-xp)>=MinSeparation or abs(y-yp)>=MinSeparation for xp,yp,_ in ListPeaks):
+                ListPeaks.append((x,y,Vals[i]))
+        return ListPeaks
+
 # def A_whereMax(A, NCPU=0, DoAbs=1, Mask=None):
 #     """
 #     Args:
@@ -26,6 +26,7 @@ from DDFacet.Other import MyLogger
 import traceback
 log = MyLogger.getLogger("NpShared")
 import os.path
+import time
 
 
 def zeros(Name, *args, **kwargs):
@@ -37,37 +38,188 @@ def zeros(Name, *args, **kwargs):
 
 
 def SizeShm():
-    from subprocess import check_output
-    import subprocess
+    """Returns the amount of /dev/shm in use (by all processes on the node), in MB, or None on error"""
     try:
-        cmd = "df -h | grep shm"
-        ps = subprocess.Popen(cmd,shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
-        s=ps.communicate()[0]
-        
-        ss=s.split(" ")
-
-        ss=[i for i in ss if i!=""][2]
-        if "G" in ss:
-            S=float(ss.replace("G",""))*1024
-        elif "M" in ss:
-            S=float(ss.replace("M",""))
-        elif "K" in ss:
-            S=float(ss.replace("K",""))/1024
-
-        #S=float(check_output(["du", "-sc","/dev/shm/"]).split("\t")[0])/1024
-    except:
-        S=None
-    return S
-    # L = ListNames()
-    # S = 0
-    # for l in L:
-    #     A = GiveArray(l)
-    #     if A is not None:
-    #         S += A.nbytes
-    # return float(S)/(1024**2)
+        st = os.statvfs(SHM_DIR)
+    except OSError:
+        return None
+    return (st.f_blocks - st.f_bfree) * st.f_frsize / float(2**20)
+
+
+# Shared memory budget. All SharedArrays are made by CreateShared(), which checks allocations in /dev/shm
+# against the free space there, and against an optional cap on our own usage. See SetShmBudget().
+SHM_DIR = "/dev/shm/"
+_shm_prefix = None          # names of our shm objects start with this, used to measure our own usage
+_shm_budget = None          # cap on our own shm usage, in bytes
+_shm_spill_dir = None       # if set, arrays that don't fit in shm are spilled to files under this directory
+_shm_warn_fraction = 0.9    # warn once usage goes above this fraction of the cap
+_shm_warned = set()
+_shm_usage_cache = [0, 0]   # time of last measurement of our usage, bytes used (plus what we allocated since)
+_SHM_USAGE_CACHE_TIME = 1.  # remeasure usage if cache is older than this many seconds
+
+def SetShmBudget(prefix, budget_gb=None, spill_dir=None, warn_fraction=0.9):
+    """
+    Sets up shared memory accounting. Should be called in the parent process before the workers are forked.
+
+    Args:
+        prefix: names of our shm objects (SharedDict directories included) start with this (i.e. ddf.PID)
+        budget_gb: if set, cap on our shm usage, in GB
+        spill_dir: if set, arrays that would go over the cap (or over the free space in /dev/shm) are placed in
+            disk-backed files under this directory, and symlinked into /dev/shm, so they can be attached to
+            as usual. Otherwise a warning is printed, or a MemoryError raised if /dev/shm would overflow.
+        warn_fraction: a warning is printed when usage goes above this fraction of the cap (or of /dev/shm)
+    """
+    global _shm_prefix, _shm_budget, _shm_spill_dir, _shm_warn_fraction
+    _shm_prefix = prefix
+    _shm_budget = int(budget_gb*2**30) if budget_gb else None
+    _shm_spill_dir = os.path.join(os.path.abspath(spill_dir), "") if spill_dir else None
+    _shm_warn_fraction = warn_fraction
+    _shm_warned.clear()
+    if _shm_budget:
+        print>>log, "shared memory use capped at %.2f GB" % (_shm_budget/float(2**30))
+    if _shm_spill_dir:
+        print>>log, "shared arrays over the shared memory cap will be spilled to %s" % _shm_spill_dir
+
+def ShmUsage(path=None):
+    """
+    Returns the space used by the shared arrays under the given path (a /dev/shm file or directory, e.g. a
+    SharedDict), or by all our shm objects if path is None. Returns tuple of bytes in shm, bytes spilled to disk.
+    Arrays linked in from elsewhere (e.g. cache files) don't count.
+    """
+    if path is None:
+        if _shm_prefix is None:
+            return 0, 0
+        paths = [SHM_DIR + name for name in os.listdir(SHM_DIR) if name.startswith(_shm_prefix)]
+    else:
+        paths = [path]
+    inshm = spilled = 0
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            files = [os.path.join(dirpath, name) for dirpath, dirnames, filenames in os.walk(path)
+                     for name in filenames]
+        else:
+            files = [path]
+        for filename in files:
+            try:
+                if os.path.islink(filename):
+                    if _isSpilled(filename):
+                        spilled += os.stat(filename).st_size
+                else:
+                    inshm += os.lstat(filename).st_size
+            except OSError:
+                pass   # deleted under our feet
+    return inshm, spilled
+
+def ReportShmUsage(dest=None, top=10):
+    """Prints our shm usage to the log, broken down by the biggest SharedDicts and arrays"""
+    if _shm_prefix is None:
+        return
+    usage = [(name, ShmUsage(SHM_DIR + name)) for name in os.listdir(SHM_DIR) if name.startswith(_shm_prefix)]
+    # break down SharedDict directories by their top-level dicts
+    for name, _ in usage[:]:
+        if os.path.isdir(SHM_DIR + name):
+            usage.remove((name, _))
+            usage += [(os.path.join(name, item), ShmUsage(os.path.join(SHM_DIR, name, item)))
+                      for item in os.listdir(SHM_DIR + name)]
+    usage.sort(key=lambda x: -sum(x[1]))
+    inshm, spilled = sum([x[1][0] for x in usage]), sum([x[1][1] for x in usage])
+    print>>(dest or log), "shared memory use: %.2f GB (%.2f GB spilled to disk), /dev/shm is %.2f GB full" % (
+        inshm/float(2**30), spilled/float(2**30), (SizeShm() or 0)/1024.)
+    for name, (inshm, spilled) in usage[:top]:
+        if inshm or spilled:
+            print>>(dest or log), "  %8.3f GB %s%s" % (inshm/float(2**30), name,
+                                                      " (+%.3f GB spilled)" % (spilled/float(2**30)) if spilled else "")
+
+def _shmPath(Name):
+    """Returns /dev/shm path corresponding to SharedArray name, or None if it is not in /dev/shm"""
+    if Name.startswith("file://"):
+        path = os.path.abspath(Name[7:])
+        return path if path.startswith(SHM_DIR) else None
+    if Name.startswith("shm://"):
+        Name = Name[6:]
+    return SHM_DIR + Name
+
+def _isSpilled(path):
+    return _shm_spill_dir is not None and os.path.islink(path) and \
+           os.path.realpath(path).startswith(_shm_spill_dir)
+
+def _warnShm(key, message):
+    if key not in _shm_warned:
+        _shm_warned.add(key)
+        print>>log, ModColor.Str("WARNING: " + message)
+        ReportShmUsage()
+
+def _checkShmBudget(Name, nbytes):
+    """
+    Checks allocation of nbytes for the given SharedArray name against the free space in /dev/shm, and the budget.
+    Returns None if the array is to go into shm as usual, or a path to spill the array to.
+    """
+    path = _shmPath(Name)
+    if path is None or not nbytes:
+        return None
+    st = os.statvfs(SHM_DIR)
+    free, total = st.f_bavail * st.f_frsize, st.f_blocks * st.f_frsize
+    if _shm_budget:
+        # measuring our usage means walking through all our files, so don't do it on every call
+        if time.time() - _shm_usage_cache[0] > _SHM_USAGE_CACHE_TIME:
+            _shm_usage_cache[:] = time.time(), ShmUsage()[0]
+        available, limit = min(free, _shm_budget - _shm_usage_cache[1]), _shm_budget
+    else:
+        available, limit = free, total
+    if nbytes <= available:
+        _shm_usage_cache[1] += nbytes
+        if available - nbytes < (1 - _shm_warn_fraction) * limit:
+            _warnShm("high", "shared memory use is above %d%% of the %s (%.2f GB left)" % (
+                _shm_warn_fraction*100, "cap" if _shm_budget else "size of /dev/shm", (available - nbytes)/float(2**30)))
+        return None
+    # doesn't fit: spill to disk, if we can. Only file:// names can be redirected by a symlink.
+    if _shm_spill_dir and Name.startswith("file://"):
+        _warnShm("spill", "shared memory %s exceeded, spilling arrays to %s" % (
+            "cap" if nbytes <= free else "is full", _shm_spill_dir))
+        return os.path.join(_shm_spill_dir, path[len(SHM_DIR):])
+    if nbytes > free:
+        ReportShmUsage()
+        raise MemoryError("%s: need %.3f GB, but only %.3f GB free in %s. Consider setting --Misc-ShmSpillDir." % (
+            Name, nbytes/float(2**30), free/float(2**30), SHM_DIR))
+    _warnShm("over", "shared memory use is over the cap of %.2f GB" % (_shm_budget/float(2**30)))
+    return None
+
+def UnlinkFile(path):
+    """Removes an array file, and its spilled data if it was spilled to disk"""
+    if _isSpilled(path):
+        os.unlink(os.path.realpath(path))
+    os.unlink(path)
+
+def CleanupSpilled():
+    """Removes all our arrays spilled to disk"""
+    if _shm_spill_dir is None or _shm_prefix is None or not os.path.isdir(_shm_spill_dir):
+        return
+    for name in os.listdir(_shm_spill_dir):
+        if name.startswith(_shm_prefix):
+            os.system("rm -fr " + os.path.join(_shm_spill_dir, name))
+
+def DelSpilled(path):
+    """Removes spilled data of all arrays in the given directory (the directory itself is left to the caller)"""
+    if _shm_spill_dir is None or not os.path.isdir(path):
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            filename = os.path.join(dirpath, name)
+            if _isSpilled(filename):
+                os.unlink(os.path.realpath(filename))
 
 
 def CreateShared(Name, shape, dtype):
+    spillpath = _checkShmBudget(Name, int(np.prod(shape))*np.dtype(dtype).itemsize)
+    if spillpath is not None:
+        # create disk-backed array, and link it into shm so that it can be attached to under its usual name
+        DelArray(Name)
+        if not os.path.exists(os.path.dirname(spillpath)):
+            os.makedirs(os.path.dirname(spillpath))
+        DelArray("file://" + spillpath)
+        a = SharedArray.create("file://" + spillpath, shape, dtype=dtype)
+        os.symlink(spillpath, _shmPath(Name))
+        return a
     try:
         a = SharedArray.create(Name, shape, dtype=dtype)
     except OSError:
@@ -84,7 +236,10 @@ def ToShared(Name, A):
 
 def DelArray(Name):
     try:
-        SharedArray.delete(Name)
+        if Name.startswith("file://") and _isSpilled(Name[7:]):
+            UnlinkFile(Name[7:])
+        else:
+            SharedArray.delete(Name)
     except:
         pass
 
@@ -131,6 +131,7 @@ class SharedDict (collections.OrderedDict):
             raise RuntimeError("SharedDict %s attached as read-only" % self.path)
         collections.OrderedDict.clear(self)
         if os.path.exists(self.path):
+            NpShared.DelSpilled(self.path)
             os.system("rm -fr %s" % self.path)
         os.mkdir(self.path)
 
@@ -142,8 +143,13 @@ class SharedDict (collections.OrderedDict):
         else:
             collections.OrderedDict.clear(self)
 
+    def getShmUsage(self):
+        """Returns tuple of bytes used by the dict's arrays in shared memory, and bytes spilled to disk"""
+        return NpShared.ShmUsage(self.path)
+
     def save(self, filename):
-        os.system("tar cf %s -C %s ." % (filename, self.path))
+        # h: store contents of any arrays spilled to disk, rather than their symlinks
+        os.system("tar chf %s -C %s ." % (filename, self.path))
 
     def restore(self, filename):
         self.delete()
@@ -224,9 +230,10 @@ class SharedDict (collections.OrderedDict):
         name = self._key_to_name(item)
         path = os.path.join(self.path, name)
         for suffix in "ap":
-            if os.path.exists(path+suffix):
-                os.unlink(path+suffix)
+            if os.path.lexists(path+suffix):
+                NpShared.UnlinkFile(path+suffix)
         if os.path.exists(path+"d"):
+            NpShared.DelSpilled(path+"d")
             os.system("rm -fr "+path+"d")
 
 
@@ -240,9 +247,10 @@ class SharedDict (collections.OrderedDict):
         # remove previous item from SHM, if it's in the local dict
         if collections.OrderedDict.__contains__(self,item):
             for suffix in "ap":
-                if os.path.exists(path+suffix):
-                    os.unlink(path+suffix)
+                if os.path.lexists(path+suffix):
+                    NpShared.UnlinkFile(path+suffix)
             if os.path.exists(path+"d"):
+                NpShared.DelSpilled(path+"d")
                 os.system("rm -fr "+path+"d")
         # if item is not in local dict but is on disk, this is a multiprocessing logic error
         else:
@@ -298,6 +306,24 @@ class SharedDict (collections.OrderedDict):
         collections.OrderedDict.__setitem__(self, item, array)
         return array
 
+    def addLinkedSharedArray (self, item, filepath):
+        """adds a SharedArray entry backed by an existing disk-based SharedArray file (e.g. a cache element).
+        The entry is a symlink to the file, so no data is copied, and other processes attaching to the dict
+        map the same file. Note that writes to the array go straight to the file."""
+        if not self._readwrite:
+            raise RuntimeError("SharedDict %s attached as read-only" % self.path)
+        name = self._key_to_name(item) + 'a'
+        linkpath = os.path.join(self.path, name)
+        if os.path.lexists(linkpath):
+            os.unlink(linkpath)
+        os.symlink(os.path.abspath(filepath), linkpath)
+        array = NpShared.GiveArray(_to_shm(filepath))
+        if array is None:
+            os.unlink(linkpath)
+            raise RuntimeError("SharedDict %s: can't attach %s" % (self.path, filepath))
+        collections.OrderedDict.__setitem__(self, item, array)
+        return array
+
 SharedDict.setBaseName("shared_dict:"+str(os.getpid()))
 
 def testSharedDict ():
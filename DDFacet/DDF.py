@@ -39,6 +39,7 @@ import numexpr
 import numpy as np
 from DDFacet.Other import logo
 from DDFacet.Array import NpParallel
+from DDFacet.Array import NpShared
 from DDFacet.Imager import ClassDeconvMachine
 from DDFacet.Parset import ReadCFG
 from DDFacet.Other import MyPickle
@@ -49,6 +50,7 @@ from DDFacet.Other import Exceptions
 from DDFacet.ToolsDir import ModFFTW
 from DDFacet.Other import ClassTimeIt
 from DDFacet.Other import Multiprocessing
+from DDFacet.Other import Tracing
 import SkyModel.Other.ModColor   # because it's duplicated there
 from DDFacet.Other import progressbar
 from DDFacet.Other.AsyncProcessPool import APP, WorkerProcessError
@@ -168,9 +170,17 @@ def main(OP=None, messages=[]):
     # enable memory logging
     MyLogger.enableMemoryLogging(DicoConfig["Log"]["Memory"])
 
+    # enable tracing of jobs and processing stages (before any worker processes are started)
+    if DicoConfig["Debug"]["Trace"]:
+        Tracing.enable(ImageName + ".trace.json")
+
     # get rid of old shm arrays from previous runs
     Multiprocessing.cleanupStaleShm()
 
+    # set up shared memory accounting
+    NpShared.SetShmBudget(Multiprocessing.getShmPrefix(), DicoConfig["Misc"]["ShmBudget"],
+                          DicoConfig["Misc"]["ShmSpillDir"])
+
     # initialize random seed from config if set, or else from system time
     if DicoConfig["Misc"]["RandomSeed"] is not None:
         print>>log, "random seed=%d (explicit)" % DicoConfig["Misc"]["RandomSeed"]
@@ -193,6 +203,8 @@ def main(OP=None, messages=[]):
     DicoConfig["Parallel"]["NCPU"]=ncpu
     _pyArrays.pySetOMPNumThreads(ncpu)
     NpParallel.NCPU_global = ModFFTW.NCPU_global = ncpu
+    # each of the ncpu workers and the main process keeps its own FFTW plans
+    ModFFTW.setPlanCacheSize(DicoConfig["Cache"]["MaxSizeFFTWPlans"]*2**30, ncpu+1)
     numexpr.set_num_threads(ncpu)
     print>>log,"using up to %d CPUs for parallelism" % ncpu
 
@@ -413,5 +425,6 @@ if __name__ == "__main__":
         retcode = 1 # Should at least give the command line an indication of failure
 
     APP.shutdown()
+    Tracing.finalize()
     Multiprocessing.cleanupShm()
     sys.exit(retcode)
@@ -26,13 +26,16 @@ from DDFacet.ToolsDir import ModCoord
 import ClassJones
 from DDFacet.Imager import ModCF
 from DDFacet.ToolsDir import ModFFTW
-from DDFacet.Other import ClassTimeIt
 from DDFacet.Array import shared_dict
 from scipy.interpolate import griddata
 from DDFacet.Other.AsyncProcessPool import APP
 import copy
 import os
 
+# the Jones matrices of a batch of directions (evaluated for all beam times and antennas of a chunk) are kept
+# under this size (bytes) when stacking
+STACK_JONES_MAX_SIZE = 2**28
+
 class ClassBeamMean():
     def __init__(self,VS):
         MyLogger.setSilent(["ClassJones","ClassLOFARBeam"])
@@ -98,110 +101,130 @@ class ClassBeamMean():
         
 
 
-    def StackBeam(self,ThisMSData,iDir):
+    def _stackCacheKeys(self, ThisMSData):
+        """Returns cache keys for the per-chunk sums of squared weights made by StackBeamWeights()"""
+        keys = dict(Weight=self.GD["Weight"],
+                    Selection=self.GD["Selection"],
+                    Beam=dict([(key, self.GD["Beam"][key]) for key in ("Model", "NBand", "DtBeamMin", "FITSParAngleIncDeg")]),
+                    ChanMapping=ThisMSData["ChanMapping"],
+                    NFreqBands=self.VS.NFreqBands)
+        # natural weights are the visibility weights, while others depend on the weighting grid (i.e. on the image
+        # and on all the data)
+        if self.GD["Weight"]["Mode"] != "Natural":
+            keys["Image"] = dict(NPix=self.GD["Image"]["NPix"], Cell=self.GD["Image"]["Cell"])
+            keys["MSNames"] = [ms.MSName for ms in self.ListMS]
+        return keys
+
+    def StackBeamWeights(self,ThisMSData):
+        """
+        First stage of beam stacking, run once per chunk. Sums the squared imaging weights of the chunk per beam
+        time interval, baseline and channel group (channels sharing a Jones channel and a frequency band), and places
+        the sums in StackedBeamDict["Chunk"]. These don't depend on the directions at which the beam is stacked,
+        so they are cached per chunk. Under natural weighting they don't depend on the image either, and are reused
+        when re-imaging with another image size or cell. Other weightings go through the weighting grid, so there
+        the cache is keyed on NPix and Cell, and changing either recomputes the sums.
+        """
         self.StackedBeamDict.reload()
-        MyLogger.setSilent("ClassJones")
-        Dt=self.GD["Beam"]["DtBeamMin"]*60.
-        JonesMachine=self.DicoJonesMachine[ThisMSData["iMS"]]
-        RAs,DECs = self.radec
-
+        iMS, iChunk = ThisMSData["iMS"], ThisMSData["iChunk"]
+        JonesMachine=self.DicoJonesMachine[iMS]
+        MS=self.ListMS[iMS]
+        cache=MS.getChunkCache(*MS.getChunkRow0Row1()[iChunk])
+        cachepath, valid = cache.checkCache("BeamStackWeights.npz", self._stackCacheKeys(ThisMSData))
+        if valid:
+            Stack = dict(np.load(cachepath))
+        else:
+            Stack = self._sumStackWeights(ThisMSData, JonesMachine)
+            np.savez(file(cachepath, "w"), **Stack)
+            cache.saveCache("BeamStackWeights.npz")
+        if "Chunk" in self.StackedBeamDict:
+            self.StackedBeamDict.delete_item("Chunk")
+        self.StackedBeamDict["Chunk"] = Stack
+
+    def _sumStackWeights(self,ThisMSData,JonesMachine):
         times=ThisMSData["times"]
         A0=ThisMSData["A0"]
         A1=ThisMSData["A1"]
-        flags=ThisMSData["flags"]
         W=ThisMSData["Weights"]
         ChanToFreqBand=ThisMSData["ChanMapping"]
-        beam_times = np.array(JonesMachine.BeamMachine.getBeamSampleTimes(times, quiet=True))
-
-        T2=ClassTimeIt.ClassTimeIt()
-        T2.disable()
-        CurrentBeamITime=-1
-        # #print "  Estimate beam in %i directions"%(RAs.size)
-        # MS=self.ListMS[ThisMSData["iMS"]]
-        # JonesMachine=ClassJones.ClassJones(self.GD,MS,self.VS.FacetMachine)
-        # JonesMachine.InitBeamMachine()
-        DicoBeam=JonesMachine.EstimateBeam(beam_times, RAs[iDir:iDir+1], DECs[iDir:iDir+1], progressBar=False, quiet=True)
-        T2.timeit("GetBeam 1")
-        #DicoBeam=JonesMachine.EstimateBeam(beam_times, RAs[0:10], DECs[0:10],progressBar=False)
-        #T2.timeit("GetBeam 10")
-        #print DicoBeam["Jones"].shape
-        NTRange=DicoBeam["t0"].size
-        #pBAR= ProgressBar(Title="      Mean Beam")
-        #pBAR.render(0, '%4i/%i' % (0,NTRange))
-        T=ClassTimeIt.ClassTimeIt("Stacking")
-        T.disable()
-
-        # DicoBeam["Jones"].shape = nt, nd, na, nch, _, _
-
-        for iTRange in range(DicoBeam["t0"].size):
-        
-            t0=DicoBeam["t0"][iTRange]
-            t1=DicoBeam["t1"][iTRange]
-            J=np.abs(DicoBeam["Jones"][iTRange])
-            ind=np.where((times>=t0)&(times<t1))[0]
-            T.timeit("0")
-            A0s=A0[ind]
-            A1s=A1[ind]
-            fs=flags[ind]
-            Ws=W[ind]
-            MSnchan=Ws.shape[1]
-            T.timeit("1")
-            
-            nd,na,nch,_,_=J.shape
-            
-            # ######################
-            # This call is slow
-            J0=J[:,A0s,:,:,:]
-            J1=J[:,A1s,:,:,:]
-            T.timeit("2")
-            # ######################
-
-            # J0=np.zeros((nd,A0s.size,nch,2,2),dtype=J.dtype)
-            # #T.timeit("1a")
-            # J0List=[J[:,A0s[i],:,:,:] for i in range(A0s.size)]
-            # #T.timeit("1b")
-            # J1=np.zeros((nd,A0s.size,nch,2,2),dtype=J.dtype)
-            # #T.timeit("1c")
-            # J1List=[J[:,A1s[i],:,:,:] for i in range(A0s.size)]
-            # #T.timeit("1d")
-            # for i in range(A0s.size):
-            #     J0[:,i,:,:,:]=J0List[i]
-            #     J1[:,i,:,:,:]=J1List[i]
-            # T.timeit("2b")
-
-        
-            JJ=(J0[:,:,:,0,0]*J1[:,:,:,0,0]+J0[:,:,:,1,1]*J1[:,:,:,1,1])/2.
-            T.timeit("3")
-            
-            WW=Ws**2
-            T.timeit("4")
-            WW=WW.reshape((1,ind.size,MSnchan))
-            T.timeit("5")
-            JJsq=WW*JJ**2
-            T.timeit("6")
-            
-            SumWsqThisRange=np.sum(JJsq,axis=1)
-            T.timeit("7")
-
-            #self.SumJJsq+=SumWsqThisRange.reshape((self.npix,self.npix,self.MS.Nchan))
-            #T.timeit("8")
-            SumWsq=np.sum(WW,axis=1)
-            #self.SumWsq+=SumWsq
-
-            for iBand in range(self.VS.NFreqBands):
-                indFreqBand,=np.where(ChanToFreqBand==iBand)
-                if indFreqBand.size==0: continue
-                self.StackedBeamDict[iDir]["SumJJsq"][iBand]+=np.sum(SumWsqThisRange.reshape((MSnchan,))[indFreqBand])
-                self.StackedBeamDict[iDir]["SumWsq"][iBand]+=np.sum(SumWsq.reshape((MSnchan,))[indFreqBand])
-
-            #print SumWsq,self.SumWsq,self.SumJJsq.shape,J0.shape
-            T.timeit("9")
-            
-            #NDone = iTRange+1
-            #intPercent = int(100 * NDone / float(NTRange))
-            #pBAR.render(intPercent, '%4i/%i' % (NDone, NTRange))
+        na=ThisMSData["na"]
+        NBands=self.VS.NFreqBands
+        nrow=times.size
+        nchan=ChanToFreqBand.size
+        # rows may be sorted by baseline, so sort by time once
+        order=np.argsort(times,kind="mergesort")
+        stimes=times[order]
+        beam_times = np.array(JonesMachine.BeamMachine.getBeamSampleTimes(np.unique(stimes), quiet=True))
+        t0s,t1s=beam_times[:-1],beam_times[1:]
+        nt=t0s.size
+        row0s=np.searchsorted(stimes,t0s,"left")
+        row1s=np.searchsorted(stimes,t1s,"left")
+
+        # channel groups: channels with the same Jones channel and frequency band are summed together
+        ChanToJones=JonesMachine.GiveVisToJonesChanMapping(JonesMachine.BeamMachine.getFreqDomains())
+        ValidChan=np.where((ChanToFreqBand>=0)&(ChanToFreqBand<NBands))[0]
+        GroupIDs,ChanToGroup=np.unique(ChanToJones[ValidChan]*NBands+ChanToFreqBand[ValidChan],return_inverse=True)
+        ngrp=GroupIDs.size
+
+        # unique baselines
+        BaselineIDs,RowToBaseline=np.unique(A0.astype(np.int64)*na+A1,return_inverse=True)
+        nbl=BaselineIDs.size
+
+        Wbl=np.zeros((nt,nbl,ngrp),np.float64)
+        if W is not None and ngrp:
+            if np.isscalar(W):
+                W=np.full((nrow,nchan),W,np.float64)
+            rows=order[np.concatenate([np.arange(r0,r1) for r0,r1 in zip(row0s,row1s)])]
+            RowToRange=np.repeat(np.arange(nt),row1s-row0s)
+            index=RowToRange*nbl+RowToBaseline[rows]
+            WWsq=W[rows][:,ValidChan].astype(np.float64)**2
+            for igrp in range(ngrp):
+                Wgrp=WWsq[:,ChanToGroup==igrp].sum(axis=1)
+                Wbl[:,:,igrp]=np.bincount(index,weights=Wgrp,minlength=nt*nbl).reshape((nt,nbl))
+        GroupBand=GroupIDs%NBands
+        SumWsq=np.bincount(GroupBand,weights=Wbl.sum(axis=(0,1)),minlength=NBands) if ngrp else np.zeros(NBands)
+        return dict(beam_times=beam_times, Wbl=Wbl, SumWsq=SumWsq,
+                    A0=BaselineIDs//na, A1=BaselineIDs%na,
+                    GroupJones=GroupIDs//NBands, GroupBand=GroupBand)
+
+    def StackBeam(self,ThisMSData,ListDir):
+        """
+        Second stage of beam stacking, see StackBeamWeights(). Evaluates the beam in the given directions (in batches),
+        and stacks it using the weight sums of the current chunk.
+        """
+        self.StackedBeamDict.reload()
+        MyLogger.setSilent("ClassJones")
+        JonesMachine=self.DicoJonesMachine[ThisMSData["iMS"]]
+        RAs,DECs = self.radec
+        Stack=self.StackedBeamDict["Chunk"]
+        Wbl=Stack["Wbl"]
+        nt,nbl,ngrp=Wbl.shape
+        if not Wbl.any():
+            MyLogger.setLoud("ClassJones")
+            return
+        A0s,A1s,GroupJones=Stack["A0"],Stack["A1"],Stack["GroupJones"]
+        GroupToBand=np.zeros((ngrp,self.VS.NFreqBands),np.float64)
+        GroupToBand[np.arange(ngrp),Stack["GroupBand"]]=1
+
+        na=ThisMSData["na"]
+        nch=JonesMachine.BeamMachine.getFreqDomains().shape[0]
+        ndir_batch=max(STACK_JONES_MAX_SIZE/(nt*na*nch*4*8),1)
+        ListDir=np.array(ListDir)
+        for i0 in range(0,ListDir.size,ndir_batch):
+            Dirs=ListDir[i0:i0+ndir_batch]
+            DicoBeam=JonesMachine.EstimateBeam(Stack["beam_times"], RAs[Dirs], DECs[Dirs], progressBar=False, quiet=True)
+            # DicoBeam["Jones"].shape = nt, nd, na, nch, _, _
+            SumJJsq=np.zeros((Dirs.size,ngrp),np.float64)
+            for iTRange in range(nt):
+                J=np.abs(DicoBeam["Jones"][iTRange][:,:,GroupJones])
+                J0=J[:,A0s]
+                J1=J[:,A1s]
+                JJ=(J0[:,:,:,0,0]*J1[:,:,:,0,0]+J0[:,:,:,1,1]*J1[:,:,:,1,1])/2.
+                SumJJsq+=np.einsum("dbg,bg->dg",JJ**2,Wbl[iTRange])
+            SumJJsq=SumJJsq.dot(GroupToBand)
+            for i,iDir in enumerate(Dirs):
+                self.StackedBeamDict[iDir]["SumJJsq"]+=SumJJsq[i]
+                self.StackedBeamDict[iDir]["SumWsq"]+=Stack["SumWsq"]
 
-        T2.timeit("Stack")
         MyLogger.setLoud("ClassJones")
   
         
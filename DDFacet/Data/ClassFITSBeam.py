@@ -45,6 +45,17 @@ CIRCULAR_CORRS = set(["RR", "RL", "LR", "LL"]);
 # set of linear correlations
 LINEAR_CORRS = set(["XX", "XY", "YX", "YY"]);
 
+# sidereal rate, in radians per (UT) second
+SIDEREAL_RATE = 1.00273781191135448*2*np.pi/86400
+# max discrepancy (radians) between analytic and casacore parallactic angles before we fall back to casacore
+PA_TOLERANCE = 1e-3
+# beam is interpolated in blocks of at most this many times*directions
+BEAM_BLOCK_SIZE = 2**16
+
+def _wrap_angle(x):
+    """Wraps angle(s) into the -pi to pi range"""
+    return (x + np.pi)%(2*np.pi) - np.pi
+
 
 class ClassFITSBeam (object):
     def __init__ (self, ms, opts):
@@ -173,13 +184,7 @@ class ClassFITSBeam (object):
         if not quiet:
             print>>log,"  DtBeamMin=%.2f min results in %d samples"%(self.time_inc, len(beam_times))
         if self.pa_inc:
-            pas = [ 
-                # put antenna0 position as reference frame. NB: in the future may want to do it per antenna
-                dm.do_frame(self.pos0) and 
-                # put time into reference frame
-                dm.do_frame(dm.epoch("UTC",dq.quantity(t0,"s"))) and
-                # compute PA 
-                dm.posangle(self.field_centre,self.zenith).get_value("deg") for t0 in beam_times ]
+            pas = np.degrees(self.getParallacticAngles(beam_times))
             pa0 = pas[0]
             beam_times1 = [ beam_times[0] ]
             for t, pa in zip(beam_times[1:], pas[1:]):
@@ -200,57 +205,79 @@ class ClassFITSBeam (object):
 #        import pdb; pdb.set_trace()
         return domains
 
-    def evaluateBeam (self, t0, ra, dec):
-        """Evaluates beam at time t0, in directions ra, dec.
-        Inputs: t0 is a single time. ra, dec are Ndir vectors of directions.
-        Output: a complex array of shape [Ndir,Nant,Nfreq,2,2] giving the Jones matrix per antenna, direction and frequency
-        """
-
+    def _casacoreParallacticAngle (self, t0):
+        """Returns parallactic angle (in radians) at time t0, as computed by casacore measures"""
         # put antenna0 position as reference frame. NB: in the future may want to do it per antenna
-        dm.do_frame(self.pos0);
+        dm.do_frame(self.pos0)
         # put time into reference frame
         dm.do_frame(dm.epoch("UTC",dq.quantity(t0,"s")))
-        # compute PA 
-        parad = dm.posangle(self.field_centre,self.zenith).get_value("rad")
-        # print>>log,"time %f, position angle %f"%(t0, parad*180/math.pi)
+        # compute PA
+        return dm.posangle(self.field_centre,self.zenith).get_value("rad")
+
+    def getParallacticAngles (self, times):
+        """Returns parallactic angles (in radians) for a vector of times.
+
+        Calling into casacore per time is slow for long tracks, so the angles are computed analytically, from the
+        apparent hour angle and declination of the field centre at the first time (the hour angle then advances at the
+        sidereal rate), and the latitude of antenna 0. The result is lined up with casacore (which measures the angle
+        in the J2000 frame) at the first time, and checked against it at the middle and last time. If these disagree
+        (e.g. for a field very close to the pole), falls back to casacore for every time.
+        """
+        times = np.asarray(times, np.float64)
+        if len(times) < 4:
+            return np.array([self._casacoreParallacticAngle(t0) for t0 in times])
+        dm.do_frame(self.pos0)
+        dm.do_frame(dm.epoch("UTC",dq.quantity(times[0],"s")))
+        hadec = dm.measure(self.field_centre, "HADEC")
+        ha0, dec = hadec["m0"]["value"], hadec["m1"]["value"]
+        lat = dm.measure(self.pos0, "WGS84")["m1"]["value"]
+        ha = ha0 + (times - times[0])*SIDEREAL_RATE
+        pa = np.arctan2(np.cos(lat)*np.sin(ha), np.sin(lat)*np.cos(dec) - np.cos(lat)*np.sin(dec)*np.cos(ha))
+        icheck = [0, len(times)/2, len(times)-1]
+        pa_casacore = np.array([self._casacoreParallacticAngle(times[i]) for i in icheck])
+        pa = _wrap_angle(pa + (pa_casacore[0] - pa[0]))
+        error = abs(_wrap_angle(pa_casacore - pa[icheck])).max()
+        if error > PA_TOLERANCE:
+            print>>log,"analytic parallactic angles are off by %.3f deg, using casacore for every time"%np.degrees(error)
+            return np.array([self._casacoreParallacticAngle(t0) for t0 in times])
+        return pa
+
+    def evaluateBeams (self, times, ra, dec):
+        """Evaluates beam at a number of times, in directions ra, dec.
+        Inputs: times is an Ntime vector of times. ra, dec are Ndir vectors of directions.
+        Output: a complex array of shape [Ntime,Ndir,1,Nfreq,2,2] giving the Jones matrix per time, direction and
+        frequency. The same Jones applies to every antenna, so the antenna axis has length 1: broadcast as needed.
+        """
+        times = np.asarray(times, np.float64)
+        ntime, ndir, nfreq = len(times), len(ra), len(self.freqs)
+        parad = self.getParallacticAngles(times)
 
         # compute l,m per direction
-        ndir = len(ra)
-        l0 = numpy.zeros(ndir,float)
-        m0 = numpy.zeros(ndir,float)
-        for i,(r1,d1) in enumerate(zip(ra,dec)):
-          l0[i], m0[i] = self.ms.radec2lm_scalar(r1,d1)
-        # print>>log,ra*180/np.pi,dec*180/np.pi
-        # print>>log,l0*180/np.pi,m0*180/np.pi
-        # rotate each by parallactic angle
+        l0, m0 = self.ms.radec2lm_scalar(np.asarray(ra, np.float64), np.asarray(dec, np.float64))
         r = numpy.sqrt(l0*l0+m0*m0)
         angle = numpy.arctan2(m0,l0)
-        l = r*numpy.cos(angle+parad)
-        m = r*numpy.sin(angle+parad)  
-
-        # print>>log,"Beam evaluated for l,m"
-        # print>>log,l
-        # print>>log,m
-
-        # get interpolated values. Output shape will be [ndir,nfreq]
-        beamjones = [ self.vbs[corr].interpolate(l,m,freq=self.freqs,freqaxis=1) for corr in self.corrs ]
-
-        # now make output matrix
-        jones = numpy.zeros((ndir,self.ms.na,len(self.freqs),2,2),dtype=numpy.complex64)
 
-        # populate it with values
-        # NB: here we copy the same Jones to every antenna. In principle we could compute
-        # a parangle per antenna. When we have pointing error, it's also going to be per
-        # antenna
-        for iant in xrange(self.ms.na):
+        jones = numpy.zeros((ntime,ndir,1,nfreq,2,2),dtype=numpy.complex64)
+        ntblock = max(BEAM_BLOCK_SIZE/ndir, 1)
+        for it0 in xrange(0, ntime, ntblock):
+            it1 = min(it0+ntblock, ntime)
+            # rotate each by parallactic angle
+            rotated = angle[numpy.newaxis, :] + parad[it0:it1, numpy.newaxis]
+            l = (r*numpy.cos(rotated)).ravel()
+            m = (r*numpy.sin(rotated)).ravel()
+            # get interpolated values for all times and directions of the block. Output shape will be [ntime*ndir,nfreq]
             for ijones,(ix,iy) in enumerate(((0,0),(0,1),(1,0),(1,1))):
-                bj = beamjones[ijones]
-                jones[:,iant,:,ix,iy] = beamjones[ijones].reshape((len(bj),1)) if bj.ndim == 1 else bj
+                bj = self.vbs[self.corrs[ijones]].interpolate(l,m,freq=self.freqs,freqaxis=1)
+                jones[it0:it1,:,0,:,ix,iy] = bj.reshape((it1-it0,ndir,-1))
         return jones
 
-
-
-
-
-
-
+    def evaluateBeam (self, t0, ra, dec):
+        """Evaluates beam at time t0, in directions ra, dec.
+        Inputs: t0 is a single time. ra, dec are Ndir vectors of directions.
+        Output: a complex array of shape [Ndir,Nant,Nfreq,2,2] giving the Jones matrix per antenna, direction and frequency
+        """
+        # NB: the same Jones applies to every antenna. In principle we could compute
+        # a parangle per antenna. When we have pointing error, it's also going to be per
+        # antenna
+        jones = self.evaluateBeams([t0], ra, dec)[0]
+        return numpy.broadcast_to(jones, (jones.shape[0],self.ms.na)+jones.shape[2:])
@@ -690,27 +690,34 @@ class ClassJones():
         pBAR= ProgressBar(Title="  Init E-Jones ")#, HeaderSize=10,TitleSize=13)
         if not progressBar: pBAR.disable()
         pBAR.render(0, Tm.size)
-        for itime in range(Tm.size):
-            DicoBeam["t0"][itime]=T0s[itime]
-            DicoBeam["t1"][itime]=T1s[itime]
-            DicoBeam["tm"][itime]=Tm[itime]
-            ThisTime=Tm[itime]
-            Beam=self.GiveInstrumentBeam(ThisTime,RA,DEC)
-            #
+        DicoBeam["t0"][:]=T0s
+        DicoBeam["t1"][:]=T1s
+        DicoBeam["tm"][:]=Tm
+        # FITS beams can be evaluated for all times at once, and are the same for all antennas
+        if hasattr(self.BeamMachine, "evaluateBeams"):
+            Beam=self.BeamMachine.evaluateBeams(Tm,RA,DEC)
             if self.GD["Beam"]["CenterNorm"]==1:
-                Beam0=self.GiveInstrumentBeam(ThisTime,np.array([rac]),np.array([decc]))
-                Beam0inv= ModLinAlg.BatchInverse(Beam0)
-                nd,_,_,_,_=Beam.shape
-                Ones=np.ones((nd, 1, 1, 1, 1),np.float32)
-                Beam0inv=Beam0inv*Ones
-                Beam= ModLinAlg.BatchDot(Beam0inv, Beam)
-                
- 
-            DicoBeam["Jones"][itime]=Beam
-            NDone=itime+1
-            pBAR.render(NDone,Tm.size)
-
-            DicoBeam["Jones"][itime] = Beam
+                Beam0=self.BeamMachine.evaluateBeams(Tm,np.array([rac]),np.array([decc]))
+                Beam0inv=np.broadcast_to(ModLinAlg.BatchInverse(Beam0),Beam.shape)
+                Beam=ModLinAlg.BatchDot(np.ascontiguousarray(Beam0inv),Beam)
+            DicoBeam["Jones"][...]=Beam
+            pBAR.render(Tm.size,Tm.size)
+        else:
+            for itime in range(Tm.size):
+                ThisTime=Tm[itime]
+                Beam=self.GiveInstrumentBeam(ThisTime,RA,DEC)
+                #
+                if self.GD["Beam"]["CenterNorm"]==1:
+                    Beam0=self.GiveInstrumentBeam(ThisTime,np.array([rac]),np.array([decc]))
+                    Beam0inv= ModLinAlg.BatchInverse(Beam0)
+                    nd,_,_,_,_=Beam.shape
+                    Ones=np.ones((nd, 1, 1, 1, 1),np.float32)
+                    Beam0inv=Beam0inv*Ones
+                    Beam= ModLinAlg.BatchDot(Beam0inv, Beam)
+
+                DicoBeam["Jones"][itime]=Beam
+                NDone=itime+1
+                pBAR.render(NDone,Tm.size)
 
         nt, nd, na, nch, _, _ = DicoBeam["Jones"].shape
 
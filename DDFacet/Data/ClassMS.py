@@ -52,6 +52,26 @@ from DDFacet.Other.progressbar import ProgressBar
 #     print>>log, ModColor.Str("Could not import lofar.stationresponse")
 
 
+def GiveBaselineTimeSortIndex(A0, A1, times):
+    """
+    Returns the row index that puts rows in (A0, A1, time) order. np.lexsort is stable, so rows with
+    identical keys stay in MS order, i.e. this is identical to sorting (A0, A1, time, row) tuples.
+    """
+    return np.lexsort((times, A1, A0))
+
+def GatherRows(out, src, sort_index, chunk_rows=1000000):
+    """
+    Fills out[i] = src[sort_index[i]] along the first axis. Uses np.take into the destination
+    array, a chunk of rows at a time, so no temporary copy of src is made.
+    """
+    nrow = sort_index.size
+    for i0 in xrange(0, nrow, chunk_rows):
+        i1 = min(i0 + chunk_rows, nrow)
+        # mode="clip" disables the bounds-check buffering that mode="raise" does with out=
+        np.take(src, sort_index[i0:i1], axis=0, out=out[i0:i1], mode="clip")
+    return out
+
+
 class ClassMS():
     def __init__(self,MSname,Col="DATA",zero_flag=True,ReOrder=False,EqualizeFlag=False,DoPrint=True,DoReadData=True,
                  TimeChunkSize=None,GetBeam=False,RejectAutoCorr=False,SelectSPW=None,DelStationList=None,
@@ -599,9 +619,8 @@ class ClassMS():
 
             # @o-smirnov: why not that?
             # cache_key = dict(data=self.GD["Data"])
-            cache_key = dict(data=self.GD["Data"],
-                             selection=self.GD["Selection"],
-                             Comp=self.GD["Comp"])
+            cache_key = dict(data={key: self.GD["Data"][key] for key in ("ChunkHours", "Sort")},
+                             selection=self.GD["Selection"])
             metadata_path, metadata_valid = self.cache.checkCache("A0A1UVWT.npz", cache_key, ignore_key=(use_cache=="force"))
         else:
             metadata_valid = False
@@ -627,8 +646,7 @@ class ClassMS():
             if sort_by_baseline:
                 # make sort index
                 print>>log,"sorting by baseline-time"
-                sortby = sorted(zip(A0, A1, time_all, range(nRowRead)))
-                sort_index = np.array([ s[3] for s in sortby ])
+                sort_index = GiveBaselineTimeSortIndex(A0, A1, time_all)
                 print>>log,"applying sort index to metadata rows"
                 A0 = A0[sort_index]
                 A1 = A1[sort_index]
@@ -636,7 +654,7 @@ class ClassMS():
                 time_all = time_all[sort_index]
             else:
                 sort_index = None
-            time_uniq = np.array(sorted(set(time_all)))
+            time_uniq = np.unique(time_all)
             dot_uvw = None
 
         if ReadWeight:
@@ -653,13 +671,18 @@ class ClassMS():
         if read_data:
             # check cache for visibilities
             if use_cache:
-                datapath, datavalid = self.cache.checkCache("Data.npy", dict(time=self._start_time), ignore_key=(use_cache=="force"))
+                datapath, datavalid = self.cache.checkCache("Data", dict(time=self._start_time), ignore_key=(use_cache=="force"))
             else:
                 datavalid = False
             # read from cache if available, else from MS
             if datavalid:
+                # the cache is a disk-backed SharedArray, so this streams it in from the page cache without
+                # making an intermediate copy. Visibilities are modified in place (residuals), so we can't
+                # simply map the cache file the way we do with flags below.
                 print>> log, "reading cached visibilities from %s" % datapath
-                visdata[...] = np.load(datapath)
+                cached_data = NpShared.GiveArray(self.cache.getCacheURL("Data"))
+                np.copyto(visdata, cached_data)
+                del cached_data
                 #self.RotateType=["uvw"]
             else:
                 print>> log, "reading MS visibilities from column %s" % self.ColName
@@ -668,7 +691,7 @@ class ClassMS():
                     visdata1 = np.ndarray(shape=datashape, dtype=np.complex64)
                     table_all.getcolslicenp(self.ColName, visdata1, self.cs_tlc, self.cs_brc, self.cs_inc, row0, nRowRead)
                     print>>log,"sorting visibilities"
-                    visdata[...] = visdata1[sort_index]
+                    GatherRows(visdata, visdata1, sort_index)
                     del visdata1
                 else:
                     table_all.getcolslicenp(self.ColName, visdata, self.cs_tlc, self.cs_brc, self.cs_inc, row0, nRowRead)
@@ -680,26 +703,28 @@ class ClassMS():
 
                 if use_cache:
                     print>> log, "caching visibilities to %s" % datapath
-                    np.save(datapath, visdata)
-                    self.cache.saveCache("Data.npy")
-        # create flag array (if flagbuf is not None, array uses memory of buffer)
-        flags = DATA.addSharedArray("flags", shape=datashape, dtype=np.bool)
+                    NpShared.ToShared(self.cache.getCacheURL("Data"), visdata)
+                    self.cache.saveCache("Data")
         # check cache for flags
         if use_cache:
-            flagpath, flagvalid = self.cache.checkCache("Flags.npy", dict(time=self._start_time), ignore_key=(use_cache=="force"))
+            flagpath, flagvalid = self.cache.checkCache("Flags", dict(time=self._start_time), ignore_key=(use_cache=="force"))
         else:
             flagvalid = False
         # read from cache if available, else from MS
         if flagvalid:
-            print>> log, "reading cached flags from %s" % flagpath
-            flags[...] = np.load(flagpath)
+            # flags are final once cached (nothing downstream modifies them), so the cache file itself
+            # becomes the backing store of the shared array, and no copy is made
+            print>> log, "attaching cached flags from %s" % flagpath
+            flags = DATA.addLinkedSharedArray("flags", flagpath)
         else:
+            flags = DATA.addSharedArray("flags", shape=datashape, dtype=np.bool)
             print>> log, "reading MS flags from column FLAG"
             table_all = table_all or self.GiveMainTable()
             if sort_index is not None:
-                flags1 = table_all.getcolslice("FLAG", self.cs_tlc, self.cs_brc, self.cs_inc, row0, nRowRead)
+                flags1 = np.ndarray(shape=datashape, dtype=np.bool)
+                table_all.getcolslicenp("FLAG", flags1, self.cs_tlc, self.cs_brc, self.cs_inc, row0, nRowRead)
                 print>> log, "sorting flags"
-                flags[...] = flags1[sort_index]
+                GatherRows(flags, flags1, sort_index)
                 del flags1
 
             else:
@@ -707,8 +732,8 @@ class ClassMS():
             self.UpdateFlags(flags, uvw, visdata, A0, A1, time_all)
             if use_cache:
                 print>> log, "caching flags to %s" % flagpath
-                np.save(flagpath, flags)
-                self.cache.saveCache("Flags.npy")
+                NpShared.ToShared(self.cache.getCacheURL("Flags"), flags)
+                self.cache.saveCache("Flags")
         if table_all:
             table_all.close()
 
@@ -20,7 +20,6 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import numpy as np
 import math
-import itertools
 from DDFacet.Other import MyLogger
 from DDFacet.Array import NpShared
 log = MyLogger.getLogger("ClassSmearMapping")
@@ -38,21 +37,31 @@ class SmearMappingMachine (object):
         self._job_counter = APP.createJobCounter(self.name)
         self._data = self._blockdict = self._sizedict = None
 
-    def _smearmapping_worker(self, DATA, blockdict, sizedict, a0, a1, dPhi, l, channel_mapping, mode):
+    def _smearmapping_worker(self, DATA, groups, blockdict, sizedict, ijob, ibl0, ibl1, dPhi, l, channel_mapping, mode):
+        """Computes the mappings of baselines ibl0:ibl1 (as enumerated in the groups dict), and stores them
+        as flat int32 arrays under key ijob"""
         t = ClassTimeIt.ClassTimeIt()
         t.disable()
-        if mode == 1:
-            BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL_old(a0, a1, DATA, dPhi, l, channel_mapping)
-        elif mode == 2:
-            BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, channel_mapping)
-        else:
+        if mode not in (1, 2):
             raise ValueError("unknown BDAMode setting %d"%mode)
-
+        rows, BL_A0, BL_A1, BL_start, BL_end = \
+            groups["rows"], groups["A0"], groups["A1"], groups["start"], groups["end"]
+        ListBlocksRows = []
+        ListBlocksSizes = []
+        for ibl in xrange(ibl0, ibl1):
+            a0, a1 = BL_A0[ibl], BL_A1[ibl]
+            if mode == 1:
+                BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL_old(a0, a1, DATA, dPhi, l, channel_mapping)
+            else:
+                BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, channel_mapping,
+                                                                          row_index=rows[BL_start[ibl]:BL_end[ibl]])
+            if BlocksRowsListBL is not None:
+                ListBlocksRows.append(np.asarray(BlocksRowsListBL, np.int32))
+                ListBlocksSizes.append(np.asarray(BlocksSizesBL, np.int32))
         t.timeit('compute')
-        if BlocksRowsListBL is not None:
-            key = "%d:%d" % (a0,a1)
-            sizedict[key]  = np.array(BlocksSizesBL)
-            blockdict[key] = np.array(BlocksRowsListBL)
+        if ListBlocksSizes:
+            sizedict[ijob]  = np.concatenate(ListBlocksSizes)
+            blockdict[ijob] = np.concatenate(ListBlocksRows)
             t.timeit('store')
 
     def computeSmearMappingInBackground (self, base_job_id, MS, DATA, radiusDeg, Decorr, channel_mapping, mode):
@@ -62,17 +71,40 @@ class SmearMappingMachine (object):
         self._outdict = shared_dict.create("%s:%s:tmp" %(DATA.path, self.name))
         blockdict = self._outdict.addSubdict("blocks")
         sizedict  = self._outdict.addSubdict("sizes")
-        self._nbl = 0
-        for a0 in xrange(MS.na):
-            for a1 in xrange(MS.na):
-                if a0 != a1:
-                    self._nbl += 1
-                    APP.runJob("%s:%s:%d:%d" % (base_job_id, self.name, a0, a1), self._smearmapping_worker,
-                               counter=self._job_counter, collect_result=False,
-                               args=(DATA.readonly(), blockdict.writeonly(), sizedict.writeonly(), a0, a1, dPhi, l,
-                                     channel_mapping, mode))
-
-
+        groups    = self._outdict.addSubdict("groups")
+        # group rows by baseline in a single pass: a stable sort on the baseline number keeps rows of each
+        # baseline in their original (time) order, exactly as a per-baseline np.where() would
+        A0, A1 = DATA["A0"], DATA["A1"]
+        blnum = A0.astype(np.int64) * MS.na + A1
+        rows = np.argsort(blnum, kind="mergesort").astype(np.int32)
+        blnum = blnum[rows]
+        start = np.concatenate(([0], np.where(blnum[1:] != blnum[:-1])[0] + 1)) if rows.size else np.array([], int)
+        end = np.concatenate((start[1:], [rows.size])) if rows.size else np.array([], int)
+        # skip autocorrelations
+        bl_a0, bl_a1 = A0[rows[start]], A1[rows[start]]
+        cross = bl_a0 != bl_a1
+        start, end, bl_a0, bl_a1 = start[cross], end[cross], bl_a0[cross], bl_a1[cross]
+        groups["rows"] = rows
+        groups["A0"] = bl_a0
+        groups["A1"] = bl_a1
+        groups["start"] = start
+        groups["end"] = end
+        # split baselines into contiguous ranges of roughly equal row counts, a few per CPU. Results are keyed by
+        # range number, so collectSmearMapping() assembles them in baseline order.
+        nbl = start.size
+        njobs = min(nbl, APP.ncpu * 4)
+        if njobs:
+            cumrows = np.cumsum(end - start)
+            cuts = np.searchsorted(cumrows, cumrows[-1] * np.arange(1, njobs) / float(njobs), side="right")
+            cuts = np.unique(np.concatenate(([0], cuts, [nbl])))
+        else:
+            cuts = np.array([0])
+        self._nbl = cuts.size - 1
+        for ijob in xrange(cuts.size - 1):
+            APP.runJob("%s:%s:%d" % (base_job_id, self.name, ijob), self._smearmapping_worker,
+                       counter=self._job_counter, collect_result=False,
+                       args=(DATA.readonly(), groups.readonly(), blockdict.writeonly(), sizedict.writeonly(),
+                             ijob, cuts[ijob], cuts[ijob + 1], dPhi, l, channel_mapping, mode))
 
     def collectSmearMapping (self, DATA, field):
         APP.awaitJobCounter(self._job_counter, progress="Mapping %s"%self.name, total=self._nbl, timeout=1)
@@ -80,12 +112,13 @@ class SmearMappingMachine (object):
         blockdict = self._outdict["blocks"]
         sizedict  = self._outdict["sizes"]
         # process worker results
-        # for each map (each array returned from worker), BlockSizes[MapName] will
-        # contain a list of BlocksSizesBL entries returned from that worker
+        # for each baseline range, sizedict/blockdict contain the concatenated BlocksSizesBL and
+        # BlocksRowsListBL of the baselines in that range
         NTotBlocks = 0
         NTotRows = 0
 
-        for key in sizedict.iterkeys():
+        keys = sorted(sizedict.keys())
+        for key in keys:
             bsz = sizedict[key]
             NTotBlocks += len(bsz)
             NTotRows += bsz.sum()
@@ -102,20 +135,18 @@ class SmearMappingMachine (object):
         iii = 0
         jjj = 0
 
-        # now go through each per-baseline mapping, sorted by baseline
-        for key in sizedict.iterkeys():
+        # now go through each per-range mapping, sorted by baseline
+        for key in keys:
             BlocksSizesBL = sizedict[key]
             BlocksRowsListBL = blockdict[key]
 
             FinalMapping[iii:iii+BlocksRowsListBL.size] = BlocksRowsListBL[:]
             iii += BlocksRowsListBL.size
 
-            # print "IdWorker,AppendId",IdWorker,AppendId,BlocksSizesBL
-            # MM=np.concatenate((MM,BlocksSizesBL))
             FinalMappingSizes[jjj:jjj+BlocksSizesBL.size] = BlocksSizesBL[:]
             jjj += BlocksSizesBL.size
 
-        NVis = np.where(DATA["A0"] != DATA["A1"])[0].size * DATA["freqs"].size
+        NVis = np.count_nonzero(DATA["A0"] != DATA["A1"]) * DATA["freqs"].size
         #print>>log, "  Number of blocks:         %i"%NTotBlocks
         #print>>log, "  Number of 4-Visibilities: %i"%NVis
         fact = (100.*(NVis-NTotBlocks)/float(NVis))
@@ -338,11 +369,18 @@ class ClassSmearMapping():
         return OutputMapping, fact
 
 
-def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, GridChanMapping):
+def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, GridChanMapping, row_index=None):
+    """
+    Computes the BDA blocks of baseline a0:a1. If row_index (the rows of that baseline, in time order) is not
+    supplied, it is looked up in DATA.
 
-    A0 = DATA["A0"]
-    A1 = DATA["A1"]
-    row_index = np.where((A0 == a0) & (A1 == a1))[0]
+    Returns BlocksRowsListBL, BlocksSizesBL, NBlocksTotBL, where BlocksRowsListBL is a flat int32 array
+    of [ch0, ch1, row, row, ...] blocks, and BlocksSizesBL is an int32 array of block lengths.
+    """
+    if row_index is None:
+        A0 = DATA["A0"]
+        A1 = DATA["A1"]
+        row_index = np.where((A0 == a0) & (A1 == a1))[0]
     nrows = row_index.size
     if not nrows:
         return None, None, None
@@ -376,8 +414,8 @@ def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, GridChanMapping):
 
     duvw = uvwlmn.copy()
     duvw[:-1,:] = uvwlmn[1:,:] - uvwlmn[:-1,:]
-    # last delta copied from previous row
-    duvw[-1,:] = duvw[-2,:]
+    # last delta copied from previous row (a single-row baseline has no delta)
+    duvw[-1,:] = duvw[-2,:] if nrows > 1 else 0
     # max delta phase is just the length of the delta-vector
     delta_phase = np.sqrt((duvw**2).sum(1))*(np.pi*nu0/C)
 
@@ -401,28 +439,28 @@ def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, GridChanMapping):
             # now, every position in the array where roll!=rowblock is a starting position for a block.
             # conveniently (and by construction, thanks to the -1 at the end), this always includes the 0 and the nrows position.
             blockcut = np.where(np.roll(rowblock,1) != rowblock)[0]
-            nblocks = len(blockcut)
-            # make list of rows slices for each time block. The where() statement above gives us a list of rows at
-            # which the block index has changed, i.e. [0 N1 N2 Nrows]. Convert this into slice objects representing
-            # [0,N1), [N1,N2), ..., [Nx,Nrows)
-            block_slices = [ slice(blockcut[i],blockcut[i+1]) for i in xrange(nblocks-1) ]
         else:
-            block_slices = [ slice(i,i+1) for i in xrange(nrows) ]
+            blockcut = np.arange(nrows+1)
     else:   # slow-style, more like Cyril used to do it
-        block_slices = []
-        dphtot = row0 = 0
-        # row0 is start of current block; delta_phase[i] is distance of row i+1 wrt row i
+        blockcut = [0]
+        dphtot = 0
+        # delta_phase[i] is distance of row i+1 wrt row i
         for row, dph in enumerate(delta_phase):
             dphtot += dph
             if dphtot > dPhi:  # if more than critical, then block is [row0,row+1)
-                block_slices.append(slice(row0, row+1))
+                blockcut.append(row+1)
                 dphtot = 0
-                row0 = row+1
         # add last block
-        block_slices.append(slice(row0,nrows))
+        if blockcut[-1] != nrows:
+            blockcut.append(nrows)
+        blockcut = np.array(blockcut)
+    # blockcut is a list of rows at which the time block changes, i.e. [0 N1 N2 Nrows], so time block i
+    # is [blockcut[i],blockcut[i+1])
+    tblock_start = blockcut[:-1]
+    tblock_size = np.diff(blockcut)
 
     # now find the minimum (fractional) channel block size for each time block. If this is <1, set to 1
-    fracsizeChanBlockMin = np.array([ max(fracsizeChanBlock[slc].min(), 1) for slc in block_slices ])
+    fracsizeChanBlockMin = np.maximum(np.minimum.reduceat(fracsizeChanBlock, tblock_start), 1)
 
     # convert that into an integer number of channel blocks for each time block
     numChanBlocks = np.ceil(NChan/fracsizeChanBlockMin)
@@ -433,10 +471,9 @@ def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, GridChanMapping):
 
     # now, we only have a small set of possible sizeChanBlock values across all time blocks, and the split into channel
     # blocks needs to be computed separately for each such channelization
-    uniqueChannelBlockSizes = np.array(list(set(sizeChanBlock)))
+    # channelization_num maps each time block to its channelization number
+    uniqueChannelBlockSizes, channelization_num = np.unique(sizeChanBlock, return_inverse=True)
     num_bs = uniqueChannelBlockSizes.size
-    # reverse mapping: from unique block size, to channelization number
-    channelization_num = dict([ (sz,i) for i,sz in enumerate(uniqueChannelBlockSizes) ])
 
     # now make a mapping: for each possible block size, we have a list of integer (chanblock_number,grid_number) pairs, one per channel.
     # we make chanpairs: a (Nblocksize,Nchan+1,2) array to hold these. We include +1 at the end to form up cuts (below),
@@ -452,26 +489,36 @@ def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, GridChanMapping):
     # changes will be a (NBlocksize, NChan+1) array with True at every "cut block" position, including always at 0 and NChan
     changes = (chanpairs != np.roll(chanpairs,1,axis=1)).any(axis=2)
 
-    # list of lists: for each blocksize, lists channels where to cut for that blocksize
-    changes_where = [ np.where(changes[bs,:])[0] for bs in xrange(num_bs) ]
-
-    # list of lists: for each blocksize, lists (ch0,ch1) pairs indicating the blocks
-    channel_cuts = [ [ (chwh[i], chwh[i+1]) for i in xrange(len(chwh)-1) ] for chwh in changes_where ]
+    # for each blocksize, the channels where to cut for that blocksize, padded to a (num_bs, max_cuts+1) array.
+    # Blocksize bs has num_cuts[bs] channel blocks, [cut_ch[bs,i], cut_ch[bs,i+1]).
+    num_cuts = changes.sum(axis=1) - 1
+    cut_ch = np.zeros((num_bs, num_cuts.max()+1), np.int32)
+    for bs in xrange(num_bs):
+        cut_ch[bs, :num_cuts[bs]+1] = np.where(changes[bs,:])[0]
 
     # ok, now to form up the list in grand Cyril format: for each time block, for each channel block in that
     # time block, we need to make a list of [ch0,ch1,rows]
-
-    blocklists = [ [ch0, ch1] + list(row_index[block_slices[iblock]]) for iblock, sz in enumerate(sizeChanBlock)
-                                                                      for ch0, ch1 in channel_cuts[channelization_num[sz]] ]
-
-#    print>> log, "baseline %d:%d blocklists %s" % (a0, a1, " ".join([",".join(map(str,bl)) for bl in blocklists]))
+    # first, the time block and channel block number of each output block, in that order
+    nchanblocks = num_cuts[channelization_num]
+    NBlocksTotBL = int(nchanblocks.sum())
+    out_tblock = np.repeat(np.arange(tblock_size.size), nchanblocks)
+    out_chblock = np.arange(NBlocksTotBL) - np.repeat(np.cumsum(nchanblocks) - nchanblocks, nchanblocks)
+    out_bs = channelization_num[out_tblock]
 
     # list of blocklist sizes, per block
-    BlocksSizesBL = [ len(bl) for bl in blocklists ]
-    # total number of blocks
-    NBlocksTotBL = len(BlocksSizesBL)
-    # and concatenate all blocks into a single mega-list
-    BlocksRowsListBL = list(itertools.chain(*blocklists))
+    BlocksSizesBL = np.int32(tblock_size[out_tblock] + 2)
+    # and fill in all blocks into a single mega-list. Position of each entry within its block is pos-block_offset,
+    # with 0 and 1 being the channel range, and 2.. being the rows of the time block
+    block_offset = np.cumsum(BlocksSizesBL) - BlocksSizesBL
+    BlocksRowsListBL = np.empty(int(BlocksSizesBL.sum()), np.int32)
+    BlocksRowsListBL[block_offset] = cut_ch[out_bs, out_chblock]
+    BlocksRowsListBL[block_offset + 1] = cut_ch[out_bs, out_chblock + 1]
+    entry_block = np.repeat(np.arange(NBlocksTotBL), BlocksSizesBL)
+    entry_row = np.arange(BlocksRowsListBL.size) - block_offset[entry_block] - 2
+    is_row = entry_row >= 0
+    BlocksRowsListBL[is_row] = row_index[tblock_start[out_tblock[entry_block[is_row]]] + entry_row[is_row]]
+
+#    print>> log, "baseline %d:%d blocklists %s" % (a0, a1, str(BlocksRowsListBL))
 
     return BlocksRowsListBL, BlocksSizesBL, NBlocksTotBL
 
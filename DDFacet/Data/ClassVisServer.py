@@ -26,19 +26,22 @@ import ClassMS
 from DDFacet.Data.ClassStokes import ClassStokes
 from DDFacet.Other import ModColor
 from DDFacet.Other import MyLogger
+from DDFacet.Other import Tracing
 from functools import reduce
 MyLogger.setSilent(["NpShared"])
 import ClassSmearMapping
 import ClassJones
 from DDFacet.Array import shared_dict
 from DDFacet.Other.AsyncProcessPool import APP
-import DDFacet.cbuild.Gridder._pyGridderSmearPols as _pyGridderSmearPols
 import copy
 
 log = MyLogger.getLogger("ClassVisServer")
 
 _cc = 299792458
 
+# cell keys of the (sparse) weighting grid are band*SPAN**2 + v*SPAN + u + SPAN/2, in units of uv-cells
+_WGRID_SPAN = 2**24
+
 
 def test():
     MSName = "/media/tasse/data/killMS_Pack/killMS2/Test/0000.MS"
@@ -87,6 +90,7 @@ class ClassVisServer():
             self._use_data_cache = None
         self.DATA = None
         self._saved_data = None  # vis data saved here for single-chunk mode
+        self._retired_chunks = []  # data dicts of previous chunks still in use by background jobs (pipeline mode)
         self.obs_detail = None
         self.Init()
 
@@ -169,6 +173,13 @@ class ClassVisServer():
 
         print>>log,"Main caching directory is %s"%self.maincache.dirname
 
+        # evict least recently used cache elements, if caches have grown over the limit
+        if self.GD["Cache"]["MaxSize"]:
+            from DDFacet.Other.CacheManager import CacheManager
+            CacheManager.enforceSizeLimit([os.path.dirname(cache.dirname) for cache in
+                                           [self.maincache] + [MS.maincache for MS in self.ListMS]],
+                                          int(self.GD["Cache"]["MaxSize"]*2**30))
+
 
 
         # Assume the correlation layout of the first measurement set for now
@@ -387,7 +398,8 @@ class ClassVisServer():
 
     def collectPutColumnResults(self):
         if self._put_vis_column_job_id:
-            APP.awaitJobResults(self._put_vis_column_job_id, progress="Writing %s" % self._put_vis_column_label)
+            with Tracing.stage("write-back", chunk=self._put_vis_column_label):
+                APP.awaitJobResults(self._put_vis_column_job_id, progress="Writing %s" % self._put_vis_column_label)
             self._put_vis_column_job_id = None
 
     def startChunkLoadInBackground(self):
@@ -429,10 +441,14 @@ class ClassVisServer():
                            io=0)#,serial=True)
             return self._next_chunk_label
 
-    def collectLoadedChunk(self, start_next=True):
-        # previous data dict can now be discarded from shm
+    def collectLoadedChunk(self, start_next=True, release_previous=True):
+        # previous data dict can now be discarded from shm. If the caller still has jobs running on it, it asks
+        # for it to be retired instead, and releases it later via releaseRetiredChunks()
         if self.nTotalChunks > 1 and self.DATA is not None:
-            self.DATA.delete()
+            if release_previous:
+                self.DATA.delete()
+            else:
+                self._retired_chunks.append(self.DATA)
             self.DATA = None
         # if no next chunk scheduled, we're at end
         if not self._next_chunk_name:
@@ -443,7 +459,8 @@ class ClassVisServer():
             np.copyto(self.DATA["data"], self._saved_data)
         else:
             # await completion of data loading jobs (which, presumably, includes smear mapping)
-            APP.awaitJobResults(self._next_chunk_name, timing="Reading %s"%self._next_chunk_label )
+            with Tracing.stage("read", chunk=self._next_chunk_label):
+                APP.awaitJobResults(self._next_chunk_name, timing="Reading %s"%self._next_chunk_label )
             # reload the data dict -- background thread will now have populated it
             self.DATA = shared_dict.attach(self._next_chunk_name)
             self.DATA["label"] = self._next_chunk_label
@@ -462,6 +479,14 @@ class ClassVisServer():
         if self.DATA is not None:
             self.DATA.delete()
             self.DATA = None
+        self.releaseRetiredChunks()
+
+    def releaseRetiredChunks(self):
+        """Releases data dicts of previous chunks retired by collectLoadedChunk(release_previous=False).
+        Caller must make sure no jobs are still using them."""
+        for DATA in self._retired_chunks:
+            DATA.delete()
+        self._retired_chunks = []
 
 
     def _handler_LoadVisChunk(self, dictname, iMS, iChunk):
@@ -535,7 +560,8 @@ class ClassVisServer():
             data += (self.AddNoiseJy/np.sqrt(2.))*(np.random.randn(*data.shape)+1j*np.random.randn(*data.shape))
 
         # load results of smear mapping computation
-        self.collectBDA(dictname, DATA)
+        with Tracing.stage("BDA", chunk="%d.%d" % (iMS+1, iChunk+1)):
+            self.collectBDA(dictname, DATA)
 
     def setFacetMachine(self, FacetMachine):
         self.FacetMachine = FacetMachine
@@ -566,47 +592,50 @@ class ClassVisServer():
 
     def computeBDAInBackground(self, base_job_id, ms, DATA, ChanMappingGridding=None, ChanMappingDeGridding=None):
 
-        GD=copy.deepcopy(self.GD)
-        CriticalCacheParms=dict(Data=GD["Data"],
-                                Compression=GD["Comp"],
-                                Freq=GD["Freq"],
-                                DataSelection=GD["Selection"],
-                                Sorting=GD["Data"]["Sort"])
-        del CriticalCacheParms["Data"]["ColName"],CriticalCacheParms["DataSelection"]["FlagAnts"]
-        
+        # the BDA mappings depend on the rows selected into the chunk, and on the parameters of the mapping itself
+        # (FoV, decorrelation factor and channel mapping), so use only those as cache keys. In particular,
+        # changing e.g. the data column or the image size (with the facet size unchanged) leaves them valid.
+        SelectionParms = copy.deepcopy(self.GD["Selection"])
+        del SelectionParms["FlagAnts"]
+        CommonCacheParms = dict(DataSelection=SelectionParms,
+                                ChunkHours=self.GD["Data"]["ChunkHours"],
+                                Sorting=self.GD["Data"]["Sort"],
+                                BDAMode=self.GD["Comp"]["BDAMode"])
 
         if True: # always True for now, non-BDA gridder is not maintained # if self.GD["Comp"]["CompGridMode"]:
-            self._bda_grid_cachename, valid = self.cache.checkCache("BDA.Grid",CriticalCacheParms)
+            FOV = self._BDAFoV(self.GD["Comp"]["GridFoV"])
+            CacheParms = dict(CommonCacheParms, FoV=FOV, Decorr=self.GD["Comp"]["GridDecorr"],
+                              ChanMapping=ChanMappingGridding)
+            self._bda_grid_cachename, valid = self.cache.checkCache("BDA.Grid", CacheParms)
             if valid:
                 print>> log, "  using cached BDA mapping %s" % self._bda_grid_cachename
                 DATA["BDA.Grid"] = np.load(self._bda_grid_cachename)
             else:
-                if self.GD["Comp"]["GridFoV"] == "Facet":
-                    _, _, nx, ny = self.FacetShape
-                elif self.GD["Comp"]["GridFoV"] == "Full":
-                    _, _, nx, ny = self.FullImShape
-                mode = self.GD["Comp"]["BDAMode"]
-                FOV = self.CellSizeRad * nx * (np.sqrt(2.) / 2.) * 180. / np.pi
                 self._smm_grid.computeSmearMappingInBackground(base_job_id, ms, DATA, FOV,
                                                           (1. - self.GD["Comp"]["GridDecorr"]),
-                                                          ChanMappingGridding, mode)
+                                                          ChanMappingGridding, self.GD["Comp"]["BDAMode"])
 
         if True: # always True for now, non-BDA gridder is not maintained # if self.GD["Comp"]["CompDeGridMode"]:
-            self._bda_degrid_cachename, valid = self.cache.checkCache("BDA.Degrid",CriticalCacheParms)
+            FOV = self._BDAFoV(self.GD["Comp"]["DegridFoV"])
+            CacheParms = dict(CommonCacheParms, FoV=FOV, Decorr=self.GD["Comp"]["DegridDecorr"],
+                              ChanMapping=ChanMappingDeGridding)
+            self._bda_degrid_cachename, valid = self.cache.checkCache("BDA.Degrid", CacheParms)
 
             if valid:
                 print>> log, "  using cached BDA mapping %s" % self._bda_degrid_cachename
                 DATA["BDA.Degrid"] = np.load(self._bda_degrid_cachename)
             else:
-                if self.GD["Comp"]["DegridFoV"] == "Facet":
-                    _, _, nx, ny = self.FacetShape
-                elif self.GD["Comp"]["DegridFoV"] == "Full":
-                    _, _, nx, ny = self.FullImShape
-                mode = self.GD["Comp"]["BDAMode"]
-                FOV = self.CellSizeRad * nx * (np.sqrt(2.) / 2.) * 180. / np.pi
                 self._smm_degrid.computeSmearMappingInBackground(base_job_id, ms, DATA, FOV,
                                                           (1. - self.GD["Comp"]["DegridDecorr"]),
-                                                          ChanMappingDeGridding, mode)
+                                                          ChanMappingDeGridding, self.GD["Comp"]["BDAMode"])
+
+    def _BDAFoV(self, fov_mode):
+        """Returns FoV (in degrees) over which BDA decorrelation is computed, for the given --Comp-GridFoV mode"""
+        if fov_mode == "Facet":
+            _, _, nx, ny = self.FacetShape
+        elif fov_mode == "Full":
+            _, _, nx, ny = self.FullImShape
+        return self.CellSizeRad * nx * (np.sqrt(2.) / 2.) * 180. / np.pi
 
     def GetVisWeights(self, iMS, iChunk):
         """
@@ -621,6 +650,9 @@ class ClassVisServer():
         self.awaitWeights()
         if self.VisWeights[iMS][iChunk]["null"]:
             return None
+        # in ConserveMemory mode, weights are not stored, but computed as needed
+        if self.VisWeights["ondemand"]:
+            return self._computeChunkWeights(iMS, iChunk)
         path = self.VisWeights[iMS][iChunk]["cachepath"]
         if not os.path.getsize(path):
             return None
@@ -635,7 +667,8 @@ class ClassVisServer():
     def awaitWeights(self):
         if self.VisWeights is None:
             # ensure the background calculation is complete
-            APP.awaitEvents(self._calcweights_event)
+            with Tracing.stage("weights"):
+                APP.awaitEvents(self._calcweights_event)
             # load shared dict prepared in background thread
             self.VisWeights = shared_dict.attach("VisWeights")
             # check for errors
@@ -659,14 +692,35 @@ class ClassVisServer():
     def CalcWeightsBackground(self):
         """Starts parallel jobs to load weights in the background"""
         self.VisWeights = None
-        if self.GD["Misc"]["ConserveMemory"]:
-            APP.runJob("VisWeights", self._CalcWeights_serial, io=0, singleton=True, event=self._calcweights_event)
-        else:
-            APP.runJob("VisWeights", self._CalcWeights_handler, io=0, singleton=True, event=self._calcweights_event)
+        APP.runJob("VisWeights", self._CalcWeights_handler, io=0, singleton=True, event=self._calcweights_event)
         # APP.awaitEvents(self._calcweights_event)
 
+    def _weightGridCell(self):
+        """Returns the uv-cell size (in wavelengths) and the number of bands of the weighting grid,
+        or None, None in natural mode"""
+        if self.Weighting == "natural":
+            return None, None
+        nch, npol, npixIm, _ = self.FullImShape
+        FOV = self.CellSizeRad * npixIm
+        cell = 1. / (self.Super * FOV)
+        if self.MFSWeighting or self.NFreqBands < 2:
+            return cell, 1
+        return cell, self.NFreqBands
+
     def _CalcWeights_handler(self):
+        """
+        Computes imaging weights with a single pass over the MSs. Each LoadWeights job reads the UVWs, flags and
+        weights of a chunk, and bins the weights onto the uv-cells of the weighting grid. The grid is sparse
+        (only occupied cells are kept), so its extent need not be known in advance. The per-chunk cell histograms
+        are then merged into the weighting grid, and FinalizeWeights jobs divide the weights by the density of their
+        cells, and save them to the cache.
+
+        In ConserveMemory mode, chunks are read one at a time, and only the weighting grid is kept (and cached).
+        The weights of a chunk are then computed on the fly when the chunk is loaded, see GetVisWeights().
+        """
+        ondemand = bool(self.GD["Misc"]["ConserveMemory"])
         self._weight_dict = shared_dict.create("VisWeights")
+        self._weight_dict["ondemand"] = ondemand
         # check for wmax in cache
         cache_keys = dict([(section, self.GD[section]) for section
               in ("Data", "Selection", "Freq", "Image", "Weight")])
@@ -675,10 +729,15 @@ class ClassVisServer():
             self._weight_dict["wmax"] = cPickle.load(open(wmax_path))
         # check cache first
         have_all_weights = wmax_valid
+        if ondemand:
+            grid_path, grid_valid = self.maincache.checkCache("ImagingWeightGrid.npz", cache_keys)
+            have_all_weights = have_all_weights and grid_valid
         for iMS, MS in enumerate(self.ListMS):
             msweights = self._weight_dict.addSubdict(iMS)
             for ichunk, (row0, row1) in enumerate(MS.getChunkRow0Row1()):
                 msw = msweights.addSubdict(ichunk)
+                if ondemand:
+                    continue
                 path, valid = MS.getChunkCache(row0, row1).checkCache("ImagingWeights.npy", cache_keys)
                 have_all_weights = have_all_weights and valid
                 msw["cachepath"] = path
@@ -686,89 +745,62 @@ class ClassVisServer():
                     msw["null"] = not os.path.getsize(path)
         # if every weight is in cache, then we're done here
         if have_all_weights:
+            if ondemand:
+                self._loadWeightGrid(grid_path)
             print>> log, "all imaging weights, and wmax, are available in cache"
             return
-        # spawn parallel jobs to load weights
-        for ims,ms in enumerate(self.ListMS):
-            msweights = self._weight_dict[ims]
-            for ichunk in xrange(len(ms.getChunkRow0Row1())):
-                msw = msweights[ichunk]
-                APP.runJob("LoadWeights:%d:%d"%(ims,ichunk), self._loadWeights_handler,
-                           args=(msw.writeonly(), ims, ichunk, self._ignore_vis_weights),
-                           counter=self._weightjob_counter, collect_result=False)
-        # wait for results
-        APP.awaitJobCounter(self._weightjob_counter, progress="Load weights")
+        cell, nbands = self._weightGridCell()
+        if ondemand:
+            # read chunks one by one, keeping only their uv-cell histograms
+            for ims, ms in enumerate(self.ListMS):
+                for ichunk in xrange(len(ms.getChunkRow0Row1())):
+                    print>> log, "loading weights %d.%d" % (ims, ichunk)
+                    self._loadWeights_handler(self._weight_dict[ims][ichunk], ims, ichunk,
+                                              self._ignore_vis_weights, cell, nbands, keep_weights=False)
+        else:
+            # spawn parallel jobs to load weights
+            for ims,ms in enumerate(self.ListMS):
+                msweights = self._weight_dict[ims]
+                for ichunk in xrange(len(ms.getChunkRow0Row1())):
+                    msw = msweights[ichunk]
+                    APP.runJob("LoadWeights:%d:%d"%(ims,ichunk), self._loadWeights_handler,
+                               args=(msw.writeonly(), ims, ichunk, self._ignore_vis_weights, cell, nbands),
+                               counter=self._weightjob_counter, collect_result=False)
+            # wait for results
+            APP.awaitJobCounter(self._weightjob_counter, progress="Load weights")
         self._weight_dict.reload()
         wmax = self._uvmax = 0
-        # now work out weight grid sizes, etc.
         for ims, ms in enumerate(self.ListMS):
             msweights = self._weight_dict[ims]
             for ichunk in xrange(len(ms.getChunkRow0Row1())):
                 msw = msweights[ichunk]
                 if "error" in msw:
                     raise msw["error"]
-                wmax = max(wmax, msw["wmax"])
-                self._uvmax = max(self._uvmax, msw["uvmax_wavelengths"])
+                wmax = max(wmax, msw.get("wmax", 0))
+                self._uvmax = max(self._uvmax, msw.get("uvmax_wavelengths", 0))
         # save wmax to cache
         cPickle.dump(wmax,open(wmax_path, "w"))
         self.maincache.saveCache("wmax")
         self._weight_dict["wmax"] = wmax
+        print>>log,"overall max W is %.2f meters"%wmax
         if self._ignore_vis_weights:
             return
         if not self._uvmax:
             raise RuntimeError("data appears to be fully flagged: can't compute imaging weights")
-        # in natural mode, leave the weights as is. In other modes, setup grid for calculations
-        self._weight_grid = shared_dict.create("VisWeights.Grid")
-        cell = npix = npixx = nbands = xymax = None
-        if self.Weighting != "natural":
-            nch, npol, npixIm, _ = self.FullImShape
-            FOV = self.CellSizeRad * npixIm
-            nbands = self.NFreqBands
-            cell = 1. / (self.Super * FOV)
-            if self.MFSWeighting or self.NFreqBands < 2:
-                nbands = 1
-                print>> log, "initializing weighting grid for single band (or MFS weighting)"
-            else:
-                print>> log, "initializing weighting grids for %d bands" % nbands
-            # find max grid extent by considering _unflagged_ UVs
-            xymax = int(math.floor(self._uvmax / cell)) + 1
-            # grid will be from [-xymax,xymax] in U and [0,xymax] in V
-            npixx = xymax * 2 + 1
-            npixy = xymax + 1
-            npix = npixx * npixy
-            print>> log, "Calculating imaging weights on an [%i,%i]x%i grid with cellsize %g" % (npixx, npixy, nbands, cell)
-            grid0 = self._weight_grid.addSharedArray("grid", (nbands, npix), np.float64)
-            # now run parallel jobs to accumulate weights
-            for ims, ms in enumerate(self.ListMS):
-                for ichunk in xrange(len(ms.getChunkRow0Row1())):
-                    if "weight" in self._weight_dict[ims][ichunk]:
-                        APP.runJob("AccumWeights:%d:%d" % (ims, ichunk), self._accumulateWeights_handler,
-                                   args=(self._weight_grid.readonly(),
-                                         self._weight_dict[ims][ichunk].readwrite(),
-                                         ims, ichunk, ms.ChanFreq, cell, npix, npixx, nbands, xymax),
-                                   counter=self._weightjob_counter, collect_result=False)
-            # wait for results
-            APP.awaitJobCounter(self._weightjob_counter, progress="Accumulate weights")
-            if self.Weighting == "briggs" or self.Weighting == "robust":
-                numeratorSqrt = 5.0 * 10 ** (-self.Robust)
-                grid0 = self._weight_grid["grid"]
-                for band in range(nbands):
-                    grid1 = grid0[band, :]
-                    avgW = (grid1 ** 2).sum() / grid1.sum()
-                    sSq = numeratorSqrt ** 2 / avgW
-                    grid1[...] = 1 + grid1 * sSq
+        # in natural mode, leave the weights as is. In other modes, merge the chunks' histograms into the grid
+        if cell is not None:
+            self._makeWeightGrid()
+        if ondemand:
+            self._saveWeightGrid(grid_path)
+            self.maincache.saveCache("ImagingWeightGrid.npz")
+            return
         # launch jobs to finalize weights and save them to the cache
         for ims, ms in enumerate(self.ListMS):
             for ichunk in xrange(len(ms.getChunkRow0Row1())):
                 APP.runJob("FinalizeWeights:%d:%d" % (ims, ichunk), self._finalizeWeights_handler,
-                           args=(self._weight_grid.readonly(),
-                                 self._weight_dict[ims][ichunk].readwrite(),
-                                 ims, ichunk, ms.ChanFreq, cell, npix, npixx, nbands, xymax),
+                           args=(self._weight_dict[ims][ichunk].readwrite(), ims, ichunk),
                            counter=self._weightjob_counter, collect_result=False)
         APP.awaitJobCounter(self._weightjob_counter, progress="Finalize weights")
-        # delete stuff
-        if self._weight_grid is not None:
-            self._weight_grid.delete()
         # check for errors
         self._weight_dict.reload()
         for ims, ms in enumerate(self.ListMS):
@@ -780,142 +812,195 @@ class ClassVisServer():
             for ichunk, (row0, row1) in enumerate(ms.getChunkRow0Row1()):
                 ms.getChunkCache(row0, row1).saveCache("ImagingWeights.npy")
 
-    def _loadWeights_handler(self, msw, ims, ichunk, wmax_only=False, reraise=False):
-        """If wmax_only is True, then don't actually read or compute weighs -- only read UVWs
-        and FLAGs to get wmax"""
+    def _readWeights(self, ims, ichunk, wmax_only=False):
+        """
+        Reads UVWs, flags and weights of the given chunk. Flagged points get zero weight.
+
+        Returns None for an empty chunk, else a tuple of wmax, uvmax (in wavelengths), uv, weight. The latter
+        two are None if wmax_only is set, or if the chunk is fully flagged or has zero weights.
+        """
+        ms = self.ListMS[ims]
+        row0, row1 = ms.getChunkRow0Row1()[ichunk]
+        msfreqs = ms.ChanFreq
+        nrows = row1 - row0
+        chanslice = ms.ChanSlice
+        if not nrows:
+            return None
+        tab = ms.GiveMainTable()
+        uvw = tab.getcol("UVW", row0, nrows)
+        flags = np.empty((nrows, len(ms.ChanFreq), len(ms.CorrelationIds)), np.bool)
+        tab.getcolslicenp("FLAG", flags, ms.cs_tlc, ms.cs_brc, ms.cs_inc, row0, nrows)
+        if ms._reverse_channel_order:
+            flags = flags[:,::-1,:]
+        # if any polarization is flagged, flag all 4 correlations. Shape
+        # of flags becomes nrow,nchan
+        flags = flags.max(axis=2)
+        valid = ~flags
+        # if all channels are flagged, flag whole row. Shape of flags becomes nrow
+        rowflags = flags.min(axis=1)
+        # if everything is flagged, skip this entry
+        if rowflags.all():
+            return 0, 0, None, None
+        # max of |u|, |v| in wavelengths
+        uv = uvw[:, :2]
+        uvmax_wavelengths = abs(uv[~rowflags,:]).max() * msfreqs.max() / _cc
+        # max w
+        wmax = abs(uvw[~rowflags,2]).max()
+        del uvw
+        if wmax_only:
+            return wmax, uvmax_wavelengths, None, None
+        # now read the weights
+        weight = np.empty((nrows, ms.Nchan), np.float32)
+        weight_col = self.GD["Weight"]["ColName"]
+        if weight_col == "WEIGHT_SPECTRUM":
+            w = tab.getcol(weight_col, row0, nrows)[:, chanslice]
+            if ms._reverse_channel_order:
+                w = w[:, ::-1, :]
+            # take mean weight across correlations and apply this to all
+            weight[...] = w.mean(axis=2)
+        elif weight_col == "None" or weight_col == None:
+            weight.fill(1)
+        elif weight_col == "WEIGHT":
+            w = tab.getcol(weight_col, row0, nrows)
+            # take mean weight across correlations, and expand to have frequency axis
+            weight[...] = w.mean(axis=1)[:, np.newaxis]
+        else:
+            # in all other cases (i.e. IMAGING_WEIGHT) assume a column
+            # of shape NRow,NFreq to begin with, check for this:
+            w = tab.getcol(weight_col, row0, nrows)[:, chanslice]
+            if w.shape != valid.shape:
+                raise TypeError("weights column expected to have shape of %s" %
+                    (valid.shape,))
+            weight[...] = w
+        # flagged points get zero weight
+        weight *= valid
+        if not weight.any():
+            return wmax, uvmax_wavelengths, None, None
+        return wmax, uvmax_wavelengths, uv, weight
+
+    def _uvCellKeys(self, ims, uv, weight, cell, nbands):
+        """
+        Helper method: returns the keys of the weighting grid cells of the visibilities with non-zero weight,
+        in the order of weight[weight!=0]. A key encodes the band, and the v and u cell numbers.
+        """
+        freqs = self.ListMS[ims].ChanFreq.ravel()
+        irow, ichan = np.nonzero(weight)
+        # only the top half of the uv-plane is gridded: flip the sign of points with negative v
+        sign = np.where(uv[irow, 1] < 0, -1., 1.)
+        # convert u/v to lambda, and then to cell numbers
+        x = np.floor(uv[irow, 0] * sign * freqs[ichan] / _cc / cell).astype(np.int64)
+        y = np.floor(uv[irow, 1] * sign * freqs[ichan] / _cc / cell).astype(np.int64)
+        if len(x) and (abs(x).max() >= _WGRID_SPAN/2 or y.max() >= _WGRID_SPAN):
+            raise ValueError("uv-coordinates out of range of the weighting grid (cell size %g)" % cell)
+        keys = y * _WGRID_SPAN + x + _WGRID_SPAN/2
+        # if we're in per-band weighting mode, then adjust the key to refer to each band's grid
+        if nbands > 1:
+            keys += self.DicoMSChanMapping[ims][ichan] * _WGRID_SPAN**2
+        return keys
+
+    def _loadWeights_handler(self, msw, ims, ichunk, wmax_only=False, cell=None, nbands=None, keep_weights=True):
+        """
+        Reads weights of a chunk into msw. If wmax_only is True, then don't actually read or compute weighs -- only
+        read UVWs and FLAGs to get wmax. If cell is given, the weights are also binned onto the weighting grid,
+        giving the sorted keys of the occupied cells ("cells") and the sum of weights per cell ("cellsum").
+        If keep_weights is True, the weights ("weight") and the index of each non-zero weight into the cells
+        ("cellindex") are kept for _finalizeWeights_handler().
+        """
         msname = "MS %d chunk %d"%(ims, ichunk)
+        msw["null"] = True
         try:
             ms = self.ListMS[ims]
             msname = "%s chunk %d"%(ms.MSName, ichunk)
-            row0, row1 = ms.getChunkRow0Row1()[ichunk]
-            msfreqs = ms.ChanFreq
-            nrows = row1 - row0
-            chanslice = ms.ChanSlice
-            if not nrows:
-    #            print>> log, "  0 rows: empty chunk"
+            result = self._readWeights(ims, ichunk, wmax_only)
+            if result is None:
                 return
-            tab = ms.GiveMainTable()
-    #        print>>log,"  %d.%d reading %s UVW" % (ims+1, ichunk+1, ms.MSName)
-            uvw = tab.getcol("UVW", row0, nrows)
-            flags = np.empty((nrows, len(ms.ChanFreq), len(ms.CorrelationIds)), np.bool)
-            # print>>log,(ms.cs_tlc,ms.cs_brc,ms.cs_inc,flags.shape)
-    #        print>>log,"  reading FLAG"
-            tab.getcolslicenp("FLAG", flags, ms.cs_tlc, ms.cs_brc, ms.cs_inc, row0, nrows)
-            if ms._reverse_channel_order:
-                flags = flags[:,::-1,:]
-            # if any polarization is flagged, flag all 4 correlations. Shape of flags becomes nrow,nchan
-    #        print>>log,"  adjusting flags"
-            # if any polarization is flagged, flag all 4 correlations. Shape
-            # of flags becomes nrow,nchan
-            flags = flags.max(axis=2)
-            valid = ~flags
-            # if all channels are flagged, flag whole row. Shape of flags becomes nrow
-            rowflags = flags.min(axis=1)
-            # if everything is flagged, skip this entry
-            if rowflags.all():
-    #            print>> log, "  all flagged: marking as null"
-                msw["wmax"] = 0
-                msw["uvmax_wavelengths"] = 0
+            msw["wmax"], msw["uvmax_wavelengths"], uv, weight = result
+            if weight is None:
                 return
-            # max of |u|, |v| in wavelengths
-            uv = uvw[:, :2]
-            uvmax_wavelengths = abs(uv[~rowflags,:]).max() * msfreqs.max() / _cc
-            # adjust max uv (in wavelengths) and max w
-            msw["wmax"] = abs(uvw[~rowflags,2]).max()
-            msw["uvmax_wavelengths"] = uvmax_wavelengths
-            del uvw
-            if wmax_only:
-                return
-            msw["uv"] = uv
-            msw["flags"] = rowflags
-            # now read the weights
-            weight = msw.addSharedArray("weight", (nrows, ms.Nchan), np.float32)
-            weight_col = self.GD["Weight"]["ColName"]
-            if weight_col == "WEIGHT_SPECTRUM":
-                w = tab.getcol(weight_col, row0, nrows)[:, chanslice]
-    #            print>> log, "  reading column %s for the weights, shape is %s" % (weight_col, w.shape)
-                if ms._reverse_channel_order:
-                    w = w[:, ::-1, :]
-                # take mean weight across correlations and apply this to all
-                weight[...] = w.mean(axis=2)
-            elif weight_col == "None" or weight_col == None:
-    #            print>> log, "  Selected weights columns is None, filling weights with ones"
-                weight.fill(1)
-            elif weight_col == "WEIGHT":
-                w = tab.getcol(weight_col, row0, nrows)
-    #            print>> log, "  reading column %s for the weights, shape is %s, will expand frequency axis" % (weight_col, w.shape)
-                # take mean weight across correlations, and expand to have frequency axis
-                weight[...] = w.mean(axis=1)[:, np.newaxis]
-            else:
-                # in all other cases (i.e. IMAGING_WEIGHT) assume a column
-                # of shape NRow,NFreq to begin with, check for this:
-                w = tab.getcol(weight_col, row0, nrows)[:, chanslice]
-    #            print>> log, "  reading column %s for the weights, shape is %s" % (weight_col, w.shape)
-                if w.shape != valid.shape:
-                    raise TypeError("weights column expected to have shape of %s" %
-                        (valid.shape,))
-                weight[...] = w
-            # flagged points get zero weight
-            weight *= valid
-            nullweight = (weight==0).all()
-            if nullweight:
-                msw.delete_item("weight")
-                msw.delete_item("uv")
-                msw.delete_item("flags")
-            else:
-                msw["bandmap"] = self.DicoMSChanMapping[ims]
+            msw["null"] = False
+            if cell is not None:
+                cells, cellindex = np.unique(self._uvCellKeys(ims, uv, weight, cell, nbands), return_inverse=True)
+                msw["cells"] = cells
+                msw["cellsum"] = np.bincount(cellindex, weights=weight[weight != 0])
+                if keep_weights:
+                    msw["cellindex"] = cellindex.astype(np.int32)
+            if keep_weights:
+                msw["weight"] = weight
         except Exception,exc:
             print>> log, ModColor.Str("Error loading weights from %s:"%msname)
             for line in traceback.format_exc().split("\n"):
                 print>>log,ModColor.Str("  "+line)
             msw["error"] = exc
-            msw.delete_item("weight")
-            msw.delete_item("uv")
-            msw.delete_item("flags")
-
-    def _uv_to_index(self, ims, uv, weights, freqs, cell, npix, npixx, nbands, xymax):
-        """Helper method: converts UV coordinates to indices into a UV-grid"""
-        # flip sign of negative v values -- we'll only grid the top half of the plane
-        uv[uv[:, 1] < 0] *= -1
-        # convert u/v to lambda, and then to pixel offset
-        uv = uv[..., np.newaxis] * freqs[np.newaxis, np.newaxis, :] / _cc
-        uv = np.floor(uv / cell).astype(int)
-        # u is offset, v isn't since it's the top half
-        x = uv[:, 0, :]
-        y = uv[:, 1, :]
-        x += xymax  # offset, since X grid starts at -xymax
-        # convert to index array -- this gives the number of the uv-bin on the grid
-        #index = msw.addSharedArray("index", (uv.shape[0], len(freqs)), np.int64)
-        index = np.zeros((uv.shape[0], len(freqs)), np.int64)
-        index[...] = y * npixx + x
-        # if we're in per-band weighting mode, then adjust the index to refer to each band's grid
-        if nbands > 1:
-            index += self.DicoMSChanMapping[ims][np.newaxis, :] * npix
-        # zero weight refers to zero cell (otherwise it may end up outside the grid, since grid is
-        # only big enough to accommodate the *unflagged* uv-points)
-        index[weights == 0] = 0
-        return index
+            for field in "weight", "cellindex", "cells", "cellsum":
+                if field in msw:
+                    msw.delete_item(field)
 
-    def _accumulateWeights_handler (self, wg, msw, ims, ichunk, freqs, cell, npix, npixx, nbands, xymax):
-        msname = "MS %d chunk %d"%(ims, ichunk)
-        try:
-            ms = self.ListMS[ims]
-            msname = "%s chunk %d"%(ms.MSName, ichunk)
-            weights = msw["weight"]
-            index = self._uv_to_index(ims, msw["uv"], weights, freqs, cell, npix, npixx, nbands, xymax)
-            msw.delete_item("flags")
-            _pyGridderSmearPols.pyAccumulateWeightsOntoGrid(wg["grid"], weights.ravel(), index.ravel())
-        except Exception,exc:
-            print>> log, ModColor.Str("Error accumulating weights from %s:"%msname)
-            for line in traceback.format_exc().split("\n"):
-                print>>log,ModColor.Str("  "+line)
-            msw["error"] = exc
-            os.unlink(msw["cachepath"])
-            msw.delete_item("weight")
-            msw.delete_item("uv")
-            msw.delete_item("flags")
+    def _makeWeightGrid(self):
+        """
+        Merges the uv-cell histograms of all chunks into the weighting grid, which is stored in the weights dict
+        as the sorted keys of the occupied cells ("gridkeys"), and the weight density per cell ("griddensity").
+        The latter includes the Briggs adjustment, if robust weighting is used. Each chunk then gets the density
+        of its own cells ("celldensity"), in place of its histogram.
+        """
+        chunks = [self._weight_dict[ims][ichunk] for ims, ms in enumerate(self.ListMS)
+                  for ichunk in xrange(len(ms.getChunkRow0Row1()))]
+        chunks = [msw for msw in chunks if "cells" in msw]
+        keys, inverse = np.unique(np.concatenate([msw["cells"] for msw in chunks]), return_inverse=True)
+        grid = np.bincount(inverse, weights=np.concatenate([msw["cellsum"] for msw in chunks]))
+        print>> log, "Calculating imaging weights on %d occupied uv-cells with cellsize %g" % (len(keys), self._weightGridCell()[0])
+        # adjust uv-grid for robust weighting
+        if self.Weighting == "briggs" or self.Weighting == "robust":
+            numeratorSqrt = 5.0 * 10 ** (-self.Robust)
+            bands = keys // _WGRID_SPAN**2
+            for band in np.unique(bands):
+                inband = bands == band
+                grid1 = grid[inband]
+                avgW = (grid1 ** 2).sum() / grid1.sum()
+                sSq = numeratorSqrt ** 2 / avgW
+                grid[inband] = 1 + grid1 * sSq
+        self._weight_dict["gridkeys"] = keys
+        self._weight_dict["griddensity"] = grid
+        # the chunks' cells are consecutive slices of the merged list
+        i0 = 0
+        for msw in chunks:
+            ncells = len(msw["cells"])
+            msw["celldensity"] = grid[inverse[i0:i0+ncells]]
+            i0 += ncells
+            msw.delete_item("cells")
+            msw.delete_item("cellsum")
+
+    def _saveWeightGrid(self, path):
+        """Saves the weighting grid, and the null status of each chunk, to the given cache path"""
+        null = [self._weight_dict[ims][ichunk]["null"] for ims, ms in enumerate(self.ListMS)
+                for ichunk in xrange(len(ms.getChunkRow0Row1()))]
+        grid = dict([(key, self._weight_dict[key]) for key in "gridkeys", "griddensity" if key in self._weight_dict])
+        np.savez(file(path, "w"), null=np.array(null, bool), **grid)
+
+    def _loadWeightGrid(self, path):
+        """Loads the weighting grid saved by _saveWeightGrid()"""
+        cached = np.load(path)
+        for key in "gridkeys", "griddensity":
+            if key in cached.files:
+                self._weight_dict[key] = cached[key]
+        null = iter(cached["null"])
+        for ims, ms in enumerate(self.ListMS):
+            for ichunk in xrange(len(ms.getChunkRow0Row1())):
+                self._weight_dict[ims][ichunk]["null"] = bool(null.next())
 
-    def _finalizeWeights_handler(self, wg, msw, ims, ichunk, freqs, cell, npix, npixx, nbands, xymax):
+    def _computeChunkWeights(self, ims, ichunk):
+        """Computes imaging weights of a chunk on the fly from the weighting grid (ConserveMemory mode).
+        Returns None if the chunk is empty or fully flagged."""
+        result = self._readWeights(ims, ichunk)
+        if result is None or result[3] is None:
+            return None
+        _, _, uv, weight = result
+        if "gridkeys" in self.VisWeights:
+            cell, nbands = self._weightGridCell()
+            keys = self._uvCellKeys(ims, uv, weight, cell, nbands)
+            weight[weight != 0] /= self.VisWeights["griddensity"][np.searchsorted(self.VisWeights["gridkeys"], keys)]
+        return weight
+
+    def _finalizeWeights_handler(self, msw, ims, ichunk):
         msname = "MS %d chunk %d"%(ims, ichunk)
         try:
             ms = self.ListMS[ims]
@@ -924,21 +1009,12 @@ class ClassVisServer():
             if "weight" in msw:
                 weight = msw["weight"]
                 # renormalize to density, for uniform/briggs
-                if self.Weighting != "natural":
-                    index = self._uv_to_index(ims, msw["uv"], weight, freqs, cell, npix, npixx, nbands, xymax)
-                    grid = wg["grid"].reshape((wg["grid"].size,))
-                    #weight /= grid[msw["index"]]
-                    index[index>=len(grid)]=0
-                    weight /= grid[index]
-    #                import pdb; pdb.set_trace()
-
+                if "celldensity" in msw:
+                    weight[weight != 0] /= msw["celldensity"][msw["cellindex"]]
                 np.save(msw["cachepath"], weight)
-                msw.delete_item("weight")
-                msw.delete_item("uv")
-                if "flags" in msw:
-                    msw.delete_item("flags")
-                if "index" in msw:
-                    msw.delete_item("index")
+                for field in "weight", "cellindex", "celldensity":
+                    if field in msw:
+                        msw.delete_item(field)
                 msw["null"] = False
             elif "error" in msw:
                 msw["null"] = True
@@ -954,140 +1030,3 @@ class ClassVisServer():
             msw["error"] = exc
             msw["success"] = False
             os.unlink(msw["cachepath"])
-
-    def _CalcWeights_serial(self):
-        self._weight_dict = shared_dict.create("VisWeights")
-        # check for wmax in cache
-        cache_keys = dict([(section, self.GD[section]) for section
-                           in ("Data", "Selection", "Freq", "Image", "Weight")])
-        wmax_path, wmax_valid = self.maincache.checkCache("wmax", cache_keys)
-        if wmax_valid:
-            self._weight_dict["wmax"] = cPickle.load(open(wmax_path))
-        # check cache first
-        have_all_weights = wmax_valid
-        for iMS, MS in enumerate(self.ListMS):
-            msweights = self._weight_dict.addSubdict(iMS)
-            for ichunk, (row0, row1) in enumerate(MS.getChunkRow0Row1()):
-                msw = msweights.addSubdict(ichunk)
-                path, valid = MS.getChunkCache(row0, row1).checkCache("ImagingWeights.npy", cache_keys)
-                have_all_weights = have_all_weights and valid
-                msw["cachepath"] = path
-                if valid:
-                    msw["null"] = not os.path.getsize(path)
-        # if every weight is in cache, then we're done here
-        if have_all_weights:
-            print>> log, "all imaging weights, and wmax, are available in cache"
-            return
-
-        wmax = self._uvmax = 0
-
-        # scan through MSs to determine uv-max
-        for ims, ms in enumerate(self.ListMS):
-            ms = self.ListMS[ims]
-            max_freq = ms.ChanFreq.max()
-            for ichunk in xrange(len(ms.getChunkRow0Row1())):
-                print>> log, "scanning UVWs %d.%d" % (ims, ichunk)
-                row0, row1 = ms.getChunkRow0Row1()[ichunk]
-                nrows = row1 - row0
-                if not nrows:
-                    continue
-                tab = ms.GiveMainTable()
-                uvw = tab.getcol("UVW", row0, nrows)
-                rowflags = tab.getcol("FLAG_ROW", row0, nrows)
-                # max of |u|, |v| in wavelengths
-                uvmax_wavelengths = abs(uvw[~rowflags, :2]).max() * max_freq / _cc
-                self._uvmax = max(self._uvmax, uvmax_wavelengths)
-
-        # setup uv-grid for non-natural weights
-        if self.Weighting != "natural":
-            self._weight_grid = shared_dict.create("VisWeights.Grid")
-            nch, npol, npixIm, _ = self.FullImShape
-            FOV = self.CellSizeRad * npixIm
-            nbands = self.NFreqBands
-            cell = 1. / (self.Super * FOV)
-            if self.MFSWeighting or self.NFreqBands < 2:
-                nbands = 1
-                print>> log, "initializing weighting grid for single band (or MFS weighting)"
-            else:
-                print>> log, "initializing weighting grids for %d bands" % nbands
-            # find max grid extent by considering _unflagged_ UVs
-            xymax = int(math.floor(self._uvmax / cell)) + 1
-            # grid will be from [-xymax,xymax] in U and [0,xymax] in V
-            npixx = xymax * 2 + 1
-            npixy = xymax + 1
-            npix = npixx * npixy
-            print>> log, "Calculating imaging weights on an [%i,%i]x%i grid with cellsize %g" % (npixx, npixy, nbands, cell)
-            self._weight_grid.addSharedArray("grid", (nbands, npix), np.float64)
-
-        # scan through MSs one by one
-        for ims, ms in enumerate(self.ListMS):
-            msweights = self._weight_dict[ims]
-            for ichunk in xrange(len(ms.getChunkRow0Row1())):
-                msw = msweights[ichunk]
-                print>>log,"loading weights %d.%d"%(ims, ichunk)
-                self._loadWeights_handler(msw, ims, ichunk, self._ignore_vis_weights)
-
-                # if nothing in MS, handler will not return a "weight" field. Mark this chunk as null then, and truncate the cache
-                msw["null"] = "weight" not in msw
-                if "error" in msw:
-                    raise RuntimeError("weights computation failed for one or more MSs")
-                if "weight" not in msw:
-                    continue
-
-                wmax = max(wmax, msw["wmax"])
-                self._uvmax = max(self._uvmax, msw["uvmax_wavelengths"])
-
-                # in Natural mode, we're done: dump weights out
-                if self.Weighting == "natural":
-                    self._finalizeWeights_handler(None, msw, ims, ichunk, 0, reraise=True)
-                # else accumulate onto uv grid
-                else:
-                    self._accumulateWeights_handler(self._weight_grid, msw,
-                                         ims, ichunk, ms.ChanFreq, cell, npix, npixx, nbands, xymax, reraise=True)
-                    # delete to save memory
-                    for field in "weight", "uv", "flags", "index":
-                        if field in msw:
-                            msw.delete_item(field)
-
-        # save wmax to cache
-        cPickle.dump(wmax, open(wmax_path, "w"))
-        self.maincache.saveCache("wmax")
-        self._weight_dict["wmax"] = wmax
-        print>>log,"overall max W is %.2f meters"%wmax
-        if self._ignore_vis_weights:
-            return
-        if not self._uvmax:
-            raise RuntimeError("data appears to be fully flagged: can't compute imaging weights")
-
-        if self.Weighting != "natural":
-            # adjust uv-grid for robust weighting
-            if self.Weighting == "briggs" or self.Weighting == "robust":
-                numeratorSqrt = 5.0 * 10 ** (-self.Robust)
-                grid0 = self._weight_grid["grid"]
-                for band in range(nbands):
-                    grid1 = grid0[band, :]
-                    avgW = (grid1 ** 2).sum() / grid1.sum()
-                    sSq = numeratorSqrt ** 2 / avgW
-                    grid1[...] = 1 + grid1 * sSq
-
-            # rescan through MSs one by one to re-adjust the weights
-            for ims, ms in enumerate(self.ListMS):
-                msweights = self._weight_dict[ims]
-                for ichunk in xrange(len(ms.getChunkRow0Row1())):
-                    msw = msweights[ichunk]
-                    if msw["null"]:
-                        print>> log, "skipping weights %d.%d (null)" % (ims, ichunk)
-                        continue
-                    print>> log, "reloading weights %d.%d" % (ims, ichunk)
-                    self._loadWeights_handler(msw, ims, ichunk, self._ignore_vis_weights)
-                    self._finalizeWeights_handler(self._weight_grid, msw,
-                                                      ims, ichunk, ms.ChanFreq, cell, npix, npixx, nbands, xymax, reraise=True)
-
-            if self._weight_grid is not None:
-                self._weight_grid.delete()
-
-        # mark caches as valid
-        for ims, ms in enumerate(self.ListMS):
-            for ichunk, (row0, row1) in enumerate(ms.getChunkRow0Row1()):
-                ms.getChunkCache(row0, row1).saveCache("ImagingWeights.npy")
-
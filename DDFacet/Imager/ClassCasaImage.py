@@ -31,6 +31,9 @@ from astropy.io import fits
 from astropy.wcs import WCS
 from DDFacet.report_version import report_version
 
+# images are streamed to FITS files in blocks of at most this many bytes
+FITS_WRITE_BLOCK_SIZE = 2**26
+
 def FileToArray(FileName,CorrT):
     """ Read a FITS FileName file to an array """
     hdu=fits.open(FileName)
@@ -131,26 +134,58 @@ class ClassCasaimage():
             self.header['RESTFRQ'] = self.fmean
 
     def setdata(self, dataIn, CorrT=False):
+        """Sets the image data. No copy is made: the data is flipped and transposed (if CorrT) as it is written
+        out by ToFits(), so must not be modified until then."""
         #print>>log, "  ----> put data in casa image %s"%self.ImageName
-
-        data=dataIn.copy()
-        if CorrT:
-            nch,npol,_,_=dataIn.shape
-            for ch in range(nch):
-                for pol in range(npol):
-                    #Need to place stokes data in increasing order because of the linear spacing assumption used in FITS
-                    stokes_slice_id = self.Stokes.index(self.sorted_stokes[pol])
-                    data[ch,pol]=dataIn[ch][stokes_slice_id][::-1].T
         self.imageFlipped = CorrT
-        self.data = data
+        self.data = dataIn
+
+    def _fitsHeader(self):
+        """Returns the full FITS header (mandatory keywords included) for a float32 image of our shape"""
+        nch, npol, nx, ny = self.data.shape
+        header = fits.Header()
+        header['SIMPLE'] = True
+        header['BITPIX'] = -32
+        header['NAXIS'] = 4
+        # with CorrT, the x and y axes are swapped on output
+        header['NAXIS1'] = nx if self.imageFlipped else ny
+        header['NAXIS2'] = ny if self.imageFlipped else nx
+        header['NAXIS3'] = npol
+        header['NAXIS4'] = nch
+        header.extend(self.header)
+        return header
 
     def ToFits(self):
+        """Writes the image out as a float32 FITS file. The header is written first, then the data section is
+        memory-mapped, and filled in blocks of rows (flipped and transposed on the fly, if CorrT), so memory use
+        is bounded by FITS_WRITE_BLOCK_SIZE regardless of the size of the image."""
         FileOut=self.ImageName+".fits"
-        hdu = fits.PrimaryHDU(header=self.header,data=self.data)
         if os.path.exists(FileOut):
             os.unlink(FileOut)
         print>>log, "  ----> Save image data as FITS file %s"%FileOut
-        hdu.writeto(FileOut)
+        header = self._fitsHeader()
+        nch, npol = self.data.shape[:2]
+        shape = (nch, npol, header['NAXIS2'], header['NAXIS1'])
+        header.tofile(FileOut)
+        offset = os.path.getsize(FileOut)
+        # pad data section to a whole number of FITS blocks
+        datasize = int(np.prod(shape))*4
+        with open(FileOut, "r+b") as fobj:
+            fobj.truncate(offset + ((datasize + 2879)//2880)*2880)
+        out = np.memmap(FileOut, dtype=">f4", mode="r+", offset=offset, shape=shape)
+        nrows = max(FITS_WRITE_BLOCK_SIZE//(shape[3]*4), 1)
+        for ch in range(nch):
+            for pol in range(npol):
+                if self.imageFlipped:
+                    #Need to place stokes data in increasing order because of the linear spacing assumption used in FITS
+                    stokes_slice_id = self.Stokes.index(self.sorted_stokes[pol])
+                    plane = self.data[ch, stokes_slice_id][::-1].T
+                else:
+                    plane = self.data[ch, pol]
+                for row0 in range(0, shape[2], nrows):
+                    out[ch, pol, row0:row0+nrows] = plane[row0:row0+nrows]
+        out.flush()
+        del out
 
     def setBeam(self,beam,beamcube=None):
         """
@@ -444,13 +444,17 @@ class ClassDDEGridMachine():
     _global_fftw_machines = {}
 
     @staticmethod
-    def _getGlobalFFTWMachine (FFTMachineType, GridShape, dtype):
+    def _getGlobalFFTWMachine (FFTMachineType, GridShape, dtype, WisdomDir=None):
         """Returns an FFTWMachine matching the arguments.
         Makes sure an FFTW machine is initialized only once per process, and only as needed.
         """
         machine = ClassDDEGridMachine._global_fftw_machines.get((GridShape, dtype))
         if machine is None:
             if FFTMachineType=="FFTW":
+                # import the wisdom learned by ClassFacetMachine.setWisdom(), so that this process does not
+                # measure its plans all over again. The plans themselves are kept by ModFFTW.
+                if WisdomDir:
+                    ModFFTW.loadWisdom(ModFFTW.giveWisdomFile(WisdomDir))
                 # use single-core FFT because we parallelize by facet instead
                 ClassDDEGridMachine._global_fftw_machines[(GridShape, dtype)] = machine = ModFFTW.FFTW_2Donly(GridShape, dtype,ncores=1)
             elif FFTMachineType=="LAPACK":
@@ -461,7 +465,8 @@ class ClassDDEGridMachine():
     def getFFTWMachine(self):
         """Returns an fftw_machine for the grid. Makes sure it is initialized once per process."""
         if self._fftw_machine is None:
-            self._fftw_machine = self._getGlobalFFTWMachine(self.GD["RIME"]["FFTMachine"], self.GridShape, self.dtype)
+            self._fftw_machine = self._getGlobalFFTWMachine(self.GD["RIME"]["FFTMachine"], self.GridShape, self.dtype,
+                                                            self.GD["Cache"]["DirWisdomFFTW"])
         return self._fftw_machine
 
     @staticmethod
@@ -882,11 +887,15 @@ class ClassDDEGridMachine():
         if TranformModelInput == "FT":
             if np.max(np.abs(ModelImage)) == 0:
                 return vis
-            if self.GD["RIME"]["Precision"]=="S": 
-                Cast=np.complex64
-            elif self.GD["RIME"]["Precision"]=="D": 
-                Cast=np.complex128
-            Grid = np.complex64(self.getFFTWMachine().fft(Cast(ModelImage)))
+            if self.GD["RIME"]["RealFFT"]:
+                # the model image is real, so a real-to-complex FFT will do
+                Grid = np.complex64(self.getFFTWMachine().fft_real(ModelImage))
+            else:
+                if self.GD["RIME"]["Precision"]=="S": 
+                    Cast=np.complex64
+                elif self.GD["RIME"]["Precision"]=="D": 
+                    Cast=np.complex128
+                Grid = np.complex64(self.getFFTWMachine().fft(Cast(ModelImage)))
 
         if freqs.size > 1:
             df = freqs[1::] - freqs[0:-1]
@@ -1052,6 +1061,10 @@ class ClassDDEGridMachine():
 
     def GridToIm(self, Grid):
         Grid *= (self.WTerm.OverS)**2
-        Dirty = self.getFFTWMachine().ifft(Grid)
+        # only the real part of the dirty image (or PSF) is ever used
+        if self.GD["RIME"]["RealFFT"]:
+            Dirty = self.getFFTWMachine().ifft_real(Grid)
+        else:
+            Dirty = self.getFFTWMachine().ifft(Grid)
 
         return Dirty
@@ -46,6 +46,7 @@ import DDFacet.Data.ClassBeamMean as ClassBeamMean
 from DDFacet.Imager import ClassMaskMachine
 from DDFacet.Array import shared_dict
 from DDFacet.Other import ClassTimeIt
+from DDFacet.Other import Tracing
 import numexpr
 from DDFacet.Imager import ClassImageNoiseMachine
 from DDFacet.Data import ClassStokes
@@ -122,6 +123,7 @@ class ClassImagerDeconv():
         self.PSFFacets = self.GD["Facets"]["PSFFacets"]
         self.HasDeconvolved=False
         self.Parallel = self.GD["Parallel"]["NCPU"] != 1
+        self.Pipeline = self.GD["Parallel"]["Pipeline"]
         self.ModConstructor = ClassModModelMachine(self.GD)
 
         self.PredictMode = self.GD["RIME"]["ForwardMode"]
@@ -506,14 +508,19 @@ class ClassImagerDeconv():
 
             while True:
                 # note that collectLoadedChunk() will destroy the current DATA dict, so we must make sure
-                # the gridding jobs of the previous chunk are finished
-                self.FacetMachinePSF.collectGriddingResults()
+                # the gridding jobs of the previous chunk are finished. In pipeline mode, the current DATA dict
+                # is retired instead, and only the chunk before it needs to be done with.
+                if self.Pipeline:
+                    self.FacetMachinePSF.collectPreviousGriddingResults()
+                    self.VS.releaseRetiredChunks()
+                else:
+                    self.FacetMachinePSF.collectGriddingResults()
                 # Polarization psfs is not going to be supported. We can only make dirty maps
                 if self.VS.StokesConverter.RequiredStokesProducts() != ['I']:
                     raise RuntimeError("Unsupported: Polarization PSF creation is not defined")
                 # get loaded chunk from I/O thread, schedule next chunk
                 # self.VS.startChunkLoadInBackground()
-                DATA = self.VS.collectLoadedChunk(start_next=True)
+                DATA = self.VS.collectLoadedChunk(start_next=True, release_previous=not self.Pipeline)
                 if type(DATA) is str:
                     print>> log, ModColor.Str("no more data: %s" % DATA, col="red")
                     break
@@ -524,6 +531,7 @@ class ClassImagerDeconv():
                 self.FacetMachinePSF.putChunkInBackground(DATA)
 
             self._finalizeComputedPSF(self.FacetMachinePSF,cachepath=writecache and cachepath)
+            self.VS.releaseRetiredChunks()
 
         self._fitAndSavePSF(self.FacetMachinePSF)
 
@@ -606,15 +614,22 @@ class ClassImagerDeconv():
             iloop = 0
             while True:
                 # note that collectLoadedChunk() will destroy the current DATA dict, so we must make sure
-                # the gridding jobs of the previous chunk are finished
-                if not dirty_valid:
-                    self.FacetMachine.collectGriddingResults()
-                if psf and not psf_valid and self.FacetMachinePSF is not None:
-                    self.FacetMachinePSF.collectGriddingResults()
+                # the gridding jobs of the previous chunk are finished. In pipeline mode, the current DATA dict
+                # is retired instead, and only the chunk before it needs to be done with.
+                if self.Pipeline:
+                    self.FacetMachine.collectPreviousGriddingResults()
+                    if self.FacetMachinePSF is not None:
+                        self.FacetMachinePSF.collectPreviousGriddingResults()
+                    self.VS.releaseRetiredChunks()
+                else:
+                    if not dirty_valid:
+                        self.FacetMachine.collectGriddingResults()
+                    if psf and not psf_valid and self.FacetMachinePSF is not None:
+                        self.FacetMachinePSF.collectGriddingResults()
 
                 # get loaded chunk from I/O thread, schedule next chunk
                 # self.VS.startChunkLoadInBackground()
-                DATA = self.VS.collectLoadedChunk(start_next=True)
+                DATA = self.VS.collectLoadedChunk(start_next=True, release_previous=not self.Pipeline)
 
                 if type(DATA) is str:
                     print>>log,ModColor.Str("no more data: %s"%DATA, col="red")
@@ -650,7 +665,8 @@ class ClassImagerDeconv():
                         print>> log, "reusing model image from previous chunk"
                     if not dirty_valid:
                         self.FacetMachine.getChunkInBackground(DATA)
-                        self.FacetMachine.collectDegriddingResults()
+                        with Tracing.stage("degrid", chunk=DATA["label"]):
+                            self.FacetMachine.collectDegriddingResults()
 
                     if predict_colname:
                         predict -= visdata
@@ -712,6 +728,10 @@ class ClassImagerDeconv():
             if psf and not psf_valid:
                 self._finalizeComputedPSF(self.FacetMachinePSF, psf_writecache and psf_cachepath)
 
+            # the above have collected all grid jobs, so any retired chunks can go
+            self.FacetMachine.collectGriddingResults()
+            self.VS.releaseRetiredChunks()
+
         # self.SaveDirtyProducts()
 
         # This call needs to be here to attach the cached smooth beam to FacetMachine if it exists
@@ -852,6 +872,10 @@ class ClassImagerDeconv():
 
         current_model_freqs = np.array([])
         ModelImage = None
+        # model images (and the facet grids derived from them) are kept across chunks and MSs, keyed on frequencies
+        cache_models = self.GD["Predict"]["CacheModels"]
+        min_facet_flux = self.GD["Predict"]["FacetFluxThreshold"]
+        degrid_stats0 = self.FacetMachine.giveDegridStats()
 
         self.FacetMachine.awaitInitCompletion()
         self.FacetMachine.BuildFacetNormImage()
@@ -875,10 +899,18 @@ class ClassImagerDeconv():
             if FixedModelImage is None:
                 ## redo model image if needed
                 if not np.array_equal(model_freqs, current_model_freqs):
-                    ModelImage = self.FacetMachine.setModelImage(self.ModelMachine.GiveModelImage(model_freqs))
+                    cache_key = tuple(model_freqs) if cache_models else None
+                    ModelImage = None
+                    if cache_key is not None:
+                        ModelImage = self.FacetMachine.useCachedModelImage(cache_key)
+                    if ModelImage is not None:
+                        print>> log, "reusing model image @%s MHz" % str(model_freqs / 1e6)
+                    else:
+                        ModelImage = self.FacetMachine.setModelImage(self.ModelMachine.GiveModelImage(model_freqs),
+                                                                     cache_key=cache_key, min_facet_flux=min_facet_flux)
+                        print>> log, "model image @%s MHz (min,max) = (%f, %f)" % (
+                        str(model_freqs / 1e6), ModelImage.min(), ModelImage.max())
                     current_model_freqs = model_freqs
-                    print>> log, "model image @%s MHz (min,max) = (%f, %f)" % (
-                    str(model_freqs / 1e6), ModelImage.min(), ModelImage.max())
                 else:
                     print>> log, "reusing model image from previous chunk"
             else:
@@ -899,7 +931,9 @@ class ClassImagerDeconv():
                                                       Fits=True,
                                                       Freqs=model_freqs,
                                                       Stokes=self.VS.StokesConverter.RequiredStokesProducts())
-                    ModelImage = self.FacetMachine.setModelImage(ThisChFixedModelImage)
+                    ModelImage = self.FacetMachine.setModelImage(ThisChFixedModelImage,
+                                                                 cache_key="FromImage" if cache_models else None,
+                                                                 min_facet_flux=min_facet_flux)
 
 
             if self.GD["Predict"]["MaskSquare"]:
@@ -954,7 +988,8 @@ class ClassImagerDeconv():
                 mb_machine.close()
             else:
                 raise ValueError("Invalid PredictMode '%s'" % self.PredictMode)
-            self.FacetMachine.collectDegriddingResults()
+            with Tracing.stage("degrid", chunk=DATA["label"]):
+                self.FacetMachine.collectDegriddingResults()
             if not subtract:
                 predict *= -1   # model was subtracted from (zero) data, so need to invert sign
             # run job in I/O thread
@@ -964,6 +999,15 @@ class ClassImagerDeconv():
             # and wait for it to finish (we don't want DATA destroyed, which collectLoadedChunk() above will)
             self.VS.collectPutColumnResults()
 
+        # report on degridding work avoided
+        stats = self.FacetMachine.giveDegridStats()
+        total, skipped, empty, reused = [stats[key]-degrid_stats0[key] for key in ("total", "skipped", "empty", "reused")]
+        if total:
+            print>>log, "predict: %d facet degrids skipped and %d found empty out of %d (%.1f%% of degridding work saved)" % (
+                skipped, empty, total, 100.*(skipped+empty)/total)
+            print>>log, "predict: %d facet model grids reused from previous chunks" % reused
+        self.FacetMachine.releaseModelImage()
+
 
 
             # #Convert to radians
@@ -1080,7 +1124,8 @@ class ClassImagerDeconv():
 
             self.DeconvMachine.Update(self.DicoDirty)
 
-            repMinor, continue_deconv, update_model = self.DeconvMachine.Deconvolve()
+            with Tracing.stage("minor cycle", major_cycle=iMajor):
+                repMinor, continue_deconv, update_model = self.DeconvMachine.Deconvolve()
             try:
                 self.FacetMachine.ToCasaImage(self.DeconvMachine.LabelIslandsImage,
                                               ImageName="%s.labelIslands%2.2i"%(self.BaseName,iMajor),Fits=True,
@@ -1164,14 +1209,22 @@ class ClassImagerDeconv():
             HasWrittenModel=False
             while True:
                 # note that collectLoadedChunk() will destroy the current DATA dict, so we must make sure
-                # the gridding jobs of the previous chunk are finished
-                self.FacetMachine.collectGriddingResults()
-                if self.FacetMachinePSF is not None:
-                    self.FacetMachinePSF.collectGriddingResults()
+                # the gridding jobs of the previous chunk are finished. In pipeline mode, the current DATA dict
+                # is retired instead, so that its gridding overlaps with degridding of the next chunk, and only
+                # the chunk before it needs to be done with.
+                if self.Pipeline:
+                    self.FacetMachine.collectPreviousGriddingResults()
+                    if self.FacetMachinePSF is not None:
+                        self.FacetMachinePSF.collectPreviousGriddingResults()
+                    self.VS.releaseRetiredChunks()
+                else:
+                    self.FacetMachine.collectGriddingResults()
+                    if self.FacetMachinePSF is not None:
+                        self.FacetMachinePSF.collectGriddingResults()
                 self.VS.collectPutColumnResults()  # if these were going on
                 # get loaded chunk from I/O thread, schedule next chunk
                 # note that if we're writing predict data out, DON'T schedule until we're done writing this one
-                DATA = self.VS.collectLoadedChunk(start_next=not predict_colname)
+                DATA = self.VS.collectLoadedChunk(start_next=not predict_colname, release_previous=not self.Pipeline)
                 if type(DATA) is str:
                     print>>log,ModColor.Str("no more data: %s"%DATA, col="red")
                     break
@@ -1225,7 +1278,8 @@ class ClassImagerDeconv():
                     raise ValueError("Invalid PredictMode '%s'" % self.PredictMode)
 
                 if predict_colname:
-                    self.FacetMachine.collectDegriddingResults()
+                    with Tracing.stage("degrid", chunk=DATA["label"]):
+                        self.FacetMachine.collectDegriddingResults()
                     # predict had original data -- subtract residuals to arrive at model
                     predict -= visdata
                     # schedule jobs for saving visibilities, then start reading next chunk (both are on io queue)
@@ -1239,8 +1293,10 @@ class ClassImagerDeconv():
                 if do_psf:
                     self.FacetMachinePSF.putChunkInBackground(DATA)
 
-            # wait for gridding to finish
-            self.FacetMachine.collectGriddingResults()
+            # wait for gridding to finish. In pipeline mode, FacetsToIm() below does this, overlapping the
+            # tail end of the gridding with the FFTs
+            if not self.Pipeline:
+                self.FacetMachine.collectGriddingResults()
             self.VS.collectPutColumnResults()  # if these were going on
             # release model image from memory
             ModelImage = None
@@ -1255,6 +1311,8 @@ class ClassImagerDeconv():
                 self._finalizeComputedPSF(self.FacetMachinePSF, cachepath=None)
                 self._fitAndSavePSF(self.FacetMachinePSF, cycle=iMajor)
                 deconvmachine_init = False  # force re-init above
+            # all grid jobs are now collected, so any retired chunks can go
+            self.VS.releaseRetiredChunks()
 
             # if we reached a sparsification of 1, we shan't be re-making the PSF
             if sparsify <= 1:
@@ -1403,7 +1461,8 @@ class ClassImagerDeconv():
 
             # Ensure degridding and subtraction has finished before firing up
             # gridding
-            self.FacetMachine.collectDegriddingResults()
+            with Tracing.stage("degrid", chunk=DATA["label"]):
+                self.FacetMachine.collectDegriddingResults()
 
             # Grid residue vis
             self.StokesFacetMachine.awaitInitCompletion()
@@ -1649,6 +1708,35 @@ class ClassImagerDeconv():
  #               print>>log, "releasing %s image" % field
                 sd.delete_item(field)
 
+    def _runSaveJob(self, job_id, args, kwargs):
+        """Runs a _saveImage_worker job. Saves run concurrently on the compute workers (ToFits() streams each image out
+        in bounded blocks), so the image is marked as pending until the job completes."""
+        sd, field = args
+        key = sd.path, field
+        self._pending_saves[key] = self._pending_saves.get(key, 0) + 1
+        self._save_jobs.append(job_id)
+        APP.runJob(job_id, self._saveImage_worker, args=args, kwargs=kwargs,
+                   when_complete=lambda:self._onSaveComplete(key))
+
+    def _onSaveComplete(self, key):
+        """Called in the parent when a save job completes. Issues any deletes that were waiting on that image."""
+        self._pending_saves[key] -= 1
+        if not self._pending_saves[key]:
+            del self._pending_saves[key]
+        deferred, self._deferred_dels = self._deferred_dels, []
+        for job_id, args in deferred:
+            self._runDelJob(job_id, args)
+
+    def _runDelJob(self, job_id, args):
+        """Runs a _delSharedImage_worker job on the I/O queue, or defers it until all pending saves of the images
+        it deletes have completed."""
+        sd = args[0]
+        if any([(sd.path, field) in self._pending_saves for field in args[1:]]):
+            self._deferred_dels.append((job_id, args))
+        else:
+            self._del_jobs.append(job_id)
+            APP.runJob(job_id, self._delSharedImage_worker, io=0, args=args)
+
 
 
     
@@ -1767,6 +1855,11 @@ class ClassImagerDeconv():
         # after we don't need them anymore.
 
         _images = shared_dict.create("OutputImages")
+        # bookkeeping for _runSaveJob() and _runDelJob()
+        self._pending_saves = {}
+        self._deferred_dels = []
+        self._save_jobs = []
+        self._del_jobs = []
         _final_RMS = {}
         def sqrtnorm():
             label = 'sqrtnorm'
@@ -2023,50 +2116,50 @@ class ClassImagerDeconv():
         # norm
         if havenorm and ("S" in self._saveims or "s" in self._saveims):
             sqrtnorm()
-            APP.runJob("save:sqrtnorm", self._saveImage_worker, io=0, args=( _images.readonly(), "sqrtnorm",),
+            self._runSaveJob("save:sqrtnorm", args=( _images.readonly(), "sqrtnorm",),
                             kwargs=dict( ImageName="%s.fluxscale"%(self.BaseName),
                                           Fits=True,Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
         # apparent-flux residuals
         if "r" in self._saveims:
             appres()
-            APP.runJob("save:appres", self._saveImage_worker, io=0, args=( self.DicoDirty.readonly(), "MeanImage",),
+            self._runSaveJob("save:appres", args=( self.DicoDirty.readonly(), "MeanImage",),
                             kwargs=dict( ImageName="%s.app.residual"%(self.BaseName),
                                           Fits=True,Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
         # intrinsic-flux residuals
         if havenorm and "R" in self._saveims:
             intres()
-            APP.runJob("save:intres", self._saveImage_worker, io=0, args=( _images.readonly(), "intres",),
+            self._runSaveJob("save:intres", args=( _images.readonly(), "intres",),
                             kwargs=dict(ImageName="%s.int.residual"%(self.BaseName),Fits=True,
                                           Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
         # apparent-flux model
         if "m" in self._saveims:
             appmodel()
-            APP.runJob("save:appmodel", self._saveImage_worker, io=0, args=(_images.readonly(), "appmodel",),
+            self._runSaveJob("save:appmodel", args=(_images.readonly(), "appmodel",),
                        kwargs=dict(ImageName="%s.app.model" % self.BaseName, Fits=True,
                                    Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
         # intrinsic-flux model
         if havenorm and "M" in self._saveims:
             intmodel()
-            APP.runJob("save:intmodel", self._saveImage_worker, io=0, args=(_images.readonly(), "intmodel",),
+            self._runSaveJob("save:intmodel", args=(_images.readonly(), "intmodel",),
                        kwargs=dict(ImageName="%s.int.model" % self.BaseName, Fits=True,
                                    Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
         # convolved-model image in apparent flux
         if "c" in self._saveims:
             appconvmodel()
-            APP.runJob("save:appconvmodel", self._saveImage_worker, io=0, args=(_images.readonly(), "appconvmodel",),
+            self._runSaveJob("save:appconvmodel", args=(_images.readonly(), "appconvmodel",),
                        kwargs=dict(ImageName="%s.app.convmodel" % self.BaseName, Fits=True,
                                    beam=self.FWHMBeamAvg, Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
         # convolved-model image in intrinsic flux
         if havenorm and "C" in self._saveims:
             intconvmodel()
-            APP.runJob("save:intconvmodel", self._saveImage_worker, io=0, args=(_images.readonly(), "intconvmodel",),
+            self._runSaveJob("save:intconvmodel", args=(_images.readonly(), "intconvmodel",),
                        kwargs=dict(ImageName="%s.int.convmodel" % self.BaseName, Fits=True,
                                    beam=self.FWHMBeamAvg, Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
 
         # norm cube
         if havenorm and ("S" in self._savecubes or "s" in self._savecubes):
             sqrtnormcube()
-            APP.runJob("save:sqrtnormcube", self._saveImage_worker, io=0, args=(_images.readonly(), "sqrtnormcube",),
+            self._runSaveJob("save:sqrtnormcube", args=(_images.readonly(), "sqrtnormcube",),
                        kwargs=dict(ImageName="%s.cube.fluxscale" % (self.BaseName), Fits=True,
                                    Freqs=self.VS.FreqBandCenters,
                                    Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
@@ -2074,14 +2167,14 @@ class ClassImagerDeconv():
         if "i" in self._saveims:
             _images["apprestored"] = appres()
             _images["apprestored"] += appconvmodel()
-            APP.runJob("save:apprestored", self._saveImage_worker, io=0, args=(_images.readonly(), "apprestored",),
+            self._runSaveJob("save:apprestored", args=(_images.readonly(), "apprestored",),
                        kwargs=dict(ImageName="%s.app.restored" % self.BaseName, Fits=True,
                                    beam=self.FWHMBeamAvg, Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
         # intrinsic-flux restored image
         if havenorm and "I" in self._saveims:
             _images["intrestored"] = intres()
             _images["intrestored"] += intconvmodel()
-            APP.runJob("save:intrestored", self._saveImage_worker, io=0, args=(_images.readonly(), "intrestored",),
+            self._runSaveJob("save:intrestored", args=(_images.readonly(), "intrestored",),
                        kwargs=dict(ImageName="%s.int.restored" % self.BaseName, Fits=True,
                                    beam=self.FWHMBeamAvg, Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
 
@@ -2107,7 +2200,7 @@ class ClassImagerDeconv():
                    (appres(), appconvmodel())
             out = _images.addSharedArray('mixrestored', a.shape, a.dtype)
             numexpr.evaluate('a+b', out=out)
-            APP.runJob("save:mixrestored", self._saveImage_worker, io=0, args=(_images.readwrite(), "mixrestored",),
+            self._runSaveJob("save:mixrestored", args=(_images.readwrite(), "mixrestored",),
                        kwargs=dict(
                            ImageName="%s.restored" % self.BaseName, Fits=True, delete=True,
                            beam=self.FWHMBeamAvg, Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
@@ -2122,42 +2215,41 @@ class ClassImagerDeconv():
             #     Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
             # ##############################
             _images['alphamap'] = alphamap()
-            APP.runJob("save:alpha", self._saveImage_worker, io=0, args=(_images.readwrite(), 'alphamap',), kwargs=dict(
+            self._runSaveJob("save:alpha", args=(_images.readwrite(), 'alphamap',), kwargs=dict(
                 ImageName="%s.alpha" % self.BaseName, Fits=True, delete=True, beam=self.FWHMBeamAvg,
                 Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
 
         #  done saving images -- schedule a job to delete them all from the dict to save RAM
-        APP.runJob("del:images", self._delSharedImage_worker, io=0, args=[_images.readwrite()] + list(_images.keys()))
+        self._runDelJob("del:images", args=[_images.readwrite()] + list(_images.keys()))
 
         # now form up cubes
         # apparent-flux model cube
         if "m" in self._savecubes:
             appmodelcube()
-            APP.runJob("save:appmodelcube", self._saveImage_worker, io=0, args=(_images.readonly(), "appmodelcube", ),
+            self._runSaveJob("save:appmodelcube", args=(_images.readonly(), "appmodelcube", ),
                        kwargs=dict(ImageName="%s.cube.app.model" % self.BaseName, Fits=True,
                                    Freqs=self.VS.FreqBandCenters,
                                    Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
         # intrinsic-flux model cube
         if havenorm and "M" in self._savecubes:
             intmodelcube()
-            APP.runJob("save:intmodelcube", self._saveImage_worker, io=0, args=(_images.readonly(), "intmodelcube",),
+            self._runSaveJob("save:intmodelcube", args=(_images.readonly(), "intmodelcube",),
                        kwargs=dict(ImageName="%s.cube.int.model" % self.BaseName, Fits=True,
                                    Freqs=self.VS.FreqBandCenters,
                                    Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
         # convolved-model cube in apparent flux
         if "c" in self._savecubes:
             appconvmodelcube()
-            APP.runJob("save:appconvmodelcube", self._saveImage_worker, io=0,
-                       args=(_images.readonly(), "appconvmodelcube",),
+            self._runSaveJob("save:appconvmodelcube", args=(_images.readonly(), "appconvmodelcube",),
                        kwargs=dict(ImageName="%s.cube.app.convmodel" % self.BaseName, Fits=True,
                                    beam=self.FWHMBeamAvg, beamcube=self.FWHMBeam, Freqs=self.VS.FreqBandCenters,
                                    Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
         #  can delete this one now
-        APP.runJob("del:appmodelcube", self._delSharedImage_worker, io=0, args=[_images.readwrite(), "appmodelcube"])
+        self._runDelJob("del:appmodelcube", args=[_images.readwrite(), "appmodelcube"])
         # convolved-model cube in intrinsic flux
         if havenorm and "C" in self._savecubes:
             intconvmodelcube()
-            APP.runJob("save:intconvmodelcube", self._saveImage_worker, io=0, args=( _images.readwrite(), "intconvmodelcube",), kwargs=dict(ImageName="%s.cube.int.convmodel"%self.BaseName,Fits=True,
+            self._runSaveJob("save:intconvmodelcube", args=( _images.readwrite(), "intconvmodelcube",), kwargs=dict(ImageName="%s.cube.int.convmodel"%self.BaseName,Fits=True,
                 beam=self.FWHMBeamAvg,beamcube=self.FWHMBeam,Freqs=self.VS.FreqBandCenters,
                 Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
 
@@ -2167,18 +2259,17 @@ class ClassImagerDeconv():
             a, b = intrescube(), intconvmodelcube()
             out = _images.addSharedArray('intrestoredcube', a.shape, a.dtype)
             numexpr.evaluate('a+b', out=out)
-            APP.runJob("save:intrestoredcube", self._saveImage_worker, io=0,
-                       args=(_images.readwrite(), "intrestoredcube",), kwargs=dict(
+            self._runSaveJob("save:intrestoredcube", args=(_images.readwrite(), "intrestoredcube",), kwargs=dict(
                     ImageName="%s.cube.int.restored" % self.BaseName, Fits=True, delete=True,
                     beam=self.FWHMBeamAvg, beamcube=self.FWHMBeam, Freqs=self.VS.FreqBandCenters,
                     Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
-        APP.runJob("del:intcubes", self._delSharedImage_worker, io=0, args=[_images.readwrite(), "intconvmodelcube", "intrestoredcube"])
+        self._runDelJob("del:intcubes", args=[_images.readwrite(), "intconvmodelcube", "intrestoredcube"])
 
         #  can delete this one now
-        APP.runJob("del:intmodelcube", self._delSharedImage_worker, io=0, args=[_images.readwrite(), "intmodelcube"])
+        self._runDelJob("del:intmodelcube", args=[_images.readwrite(), "intmodelcube"])
         # apparent-flux residual cube
         if "r" in self._savecubes:
-            APP.runJob("save:apprescube", self._saveImage_worker, io=0, args=( self.DicoDirty.readonly(), "ImageCube",),
+            self._runSaveJob("save:apprescube", args=( self.DicoDirty.readonly(), "ImageCube",),
                        kwargs=dict(ImageName="%s.cube.app.residual"%(self.BaseName),Fits=True,
                                 Freqs=self.VS.FreqBandCenters,Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
         # apparent-flux restored image cube
@@ -2186,23 +2277,27 @@ class ClassImagerDeconv():
             a, b = apprescube(), appconvmodelcube()
             out = _images.addSharedArray('apprestoredcube', a.shape, a.dtype)
             numexpr.evaluate('a+b', out=out)
-            APP.runJob("save:apprestoredcube", self._saveImage_worker, io=0,
-                       args=(_images.readwrite(), "apprestoredcube",), kwargs=dict(
+            self._runSaveJob("save:apprestoredcube", args=(_images.readwrite(), "apprestoredcube",), kwargs=dict(
                     ImageName="%s.cube.app.restored" % self.BaseName, Fits=True, delete=True,
                     beam=self.FWHMBeamAvg, beamcube=self.FWHMBeam, Freqs=self.VS.FreqBandCenters,
                     Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
         #  can delete this one now
-        APP.runJob("del:appcubes", self._delSharedImage_worker, io=0, args=[_images.readwrite(), "appconvmodelcube", "apprescube"])
+        self._runDelJob("del:appcubes", args=[_images.readwrite(), "appconvmodelcube", "apprescube"])
         # intrinsic-flux residual cube
         if havenorm and "R" in self._savecubes:
             intrescube()
-            APP.runJob("save:intrescube", self._saveImage_worker, io=0, args=( _images.readonly(), "intrescube",),
+            self._runSaveJob("save:intrescube", args=( _images.readonly(), "intrescube",),
                        kwargs=dict(ImageName="%s.cube.int.residual"%(self.BaseName),Fits=True,
                                    Freqs=self.VS.FreqBandCenters,Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
         #  can delete this one now
-        APP.runJob("del:sqrtnormcube", self._delSharedImage_worker, io=0, args=[_images.readwrite(), "sqrtnormcube"])
-
-        APP.awaitJobResults(["save:*", "del:*"])
+        self._runDelJob("del:sqrtnormcube", args=[_images.readwrite(), "sqrtnormcube"])
+
+        # saves complete out of order, so deletes are issued as the saves they depend on complete
+        if self._save_jobs:
+            APP.awaitJobResults(self._save_jobs)
+        if self._deferred_dels:
+            raise RuntimeError("deferred image deletes were never issued. This is a bug.")
+        APP.awaitJobResults(self._del_jobs)
 
     def testDegrid(self):
         import pylab
@@ -28,7 +28,9 @@ from DDFacet.Other import ClassTimeIt
 from DDFacet.Other import MyLogger
 from DDFacet.Other.progressbar import ProgressBar
 import cPickle
+import collections
 import atexit
+import time
 import traceback
 from matplotlib.path import Path
 import numpy.random
@@ -38,6 +40,7 @@ from DDFacet.Array import shared_dict
 from DDFacet.ToolsDir import ModFFTW
 from DDFacet.Other import ClassTimeIt
 from DDFacet.Other import Multiprocessing
+from DDFacet.Other import Tracing
 from DDFacet.Other import ModColor
 from DDFacet.ToolsDir.ModToolBox import EstimateNpix
 from DDFacet.ToolsDir.GiveEdges import GiveEdges
@@ -47,13 +50,15 @@ from DDFacet.Data.ClassStokes import ClassStokes
 #from DDFacet.Array import NpParallel
 from DDFacet.Other import MyLogger
 log=MyLogger.getLogger("ClassFacetMachine")
+
+# max number of model images retained by setModelImage(cache_key=...)
+MODEL_CACHE_SIZE = 4
 from DDFacet.Other.AsyncProcessPool import APP
 import numexpr
 MyLogger.setSilent("MyLogger")
 from DDFacet.cbuild.Gridder import _pyGridderSmearPols
 from DDFacet.Other import ModColor
 MyLogger.setSilent("MyLogger")
-import cpuinfo
 from DDFacet.ToolsDir import ModFFTW
 import scipy.ndimage
 
@@ -130,7 +135,16 @@ class ClassFacetMachine():
 
         self._facet_grids = self._CF = self.DATA = None
         self._grid_job_id = self._fft_job_id = self._degrid_job_id = None
+        # per-facet job timings of the previous chunk, used to schedule the most expensive facets first
+        self._facet_job_times = dict(grid={}, degrid={})
         self._smooth_job_label=None
+        # pipeline mode: rather than waiting on all facets of a chunk, a facet's next grid job (or its FFT) is
+        # launched from the completion callback of its previous grid job
+        self._pipeline = bool(self.GD["Parallel"]["Pipeline"])
+        self._grid_busy = set()         # facets with a grid job in flight
+        self._grid_deferred = {}        # iFacet -> (job_id, args) of grid job waiting on the facet's previous one
+        self._fft_deferred = set()      # facets whose FFT waits on their last grid job
+        self._prev_grid_batch = None    # (job_id, label, iMS) of previous chunk's grid jobs, if still uncollected
 
         # create semaphores if not already created
         if not ClassFacetMachine._degridding_semaphores:
@@ -141,6 +155,13 @@ class ClassFacetMachine():
 
         # this is used to store model images in shared memory, for the degridder
         self._model_dict = None
+        # per-model info used by the degridder: facets to skip, whether to cache model grids, etc.
+        self._model_info = None
+        # cache_key -> (model dict, model info) of model images retained by setModelImage(cache_key=...)
+        self._model_cache = collections.OrderedDict()
+        self._model_cache_count = 0
+        # counts of degrid jobs run, skipped, found empty, and run with a reused model grid
+        self._degrid_stats = dict(total=0, skipped=0, empty=0, reused=0)
         # this is used to store NormImage in shared memory, for the degridder
         self._norm_dict = None
 
@@ -551,64 +572,24 @@ class ClassFacetMachine():
 
     def setWisdom(self):
         """
-        Set fft wisdom
+        Set fft wisdom. Wisdom for the facet FFTs is learned (if not already in the wisdom file) and saved
+        here; the worker processes import it from the file before planning their first FFT, see
+        ClassDDEGridMachine.getFFTWMachine().
         """
-        import socket, os
-        from os.path import expanduser
         if self.GD["RIME"]["FFTMachine"]!="FFTW": return
-        self.wisdom_cache_path = self.GD["Cache"]["DirWisdomFFTW"]
-        #hostname=socket.gethostname()
-        cpuname=cpuinfo.get_cpu_info()["brand"].replace(" ","")
-        if "~" in self.wisdom_cache_path:
-            home = expanduser("~")        
-            self.wisdom_cache_path=self.wisdom_cache_path.replace("~",home)
-        self.wisdom_cache_path_host = "/".join([self.wisdom_cache_path,cpuname])
-        self.wisdom_cache_file =  "/".join([self.wisdom_cache_path_host,"Wisdom.pickle"])
-        #self.wisdom_cache_path_host="'%s'"%self.wisdom_cache_path_host
-        #self.wisdom_cache_file="'%s'"%self.wisdom_cache_file
-        
+        self.wisdom_cache_file = ModFFTW.giveWisdomFile(self.GD["Cache"]["DirWisdomFFTW"])
 
+        if self.GD["RIME"]["Precision"]=="S":
+            dtype = np.complex64
+        elif self.GD["RIME"]["Precision"]=="D":
+            dtype = np.complex128
+        kinds = ("rfft", "irfft") if self.GD["RIME"]["RealFFT"] else ("fft", "ifft")
+        WisdomTypes = []
+        for NPixPadded in sorted(set([self.DicoImager[iFacet]["NpixFacetPadded"] for iFacet in self.DicoImager.keys()])):
+            WisdomTypes += [(NPixPadded, dtype, kind) for kind in kinds]
+        WisdomTypes.append((self.OutImShape[-1], np.float32, "interfaces"))
 
-        if not os.path.isdir(self.wisdom_cache_path_host):
-            print>>log, "Wisdom file %s does not exist, create it" % (self.wisdom_cache_path_host)
-            os.makedirs(self.wisdom_cache_path_host)
-
-        if os.path.isfile(self.wisdom_cache_file):
-            print>>log, "Loading wisdom file %s" % (self.wisdom_cache_file)
-            DictWisdom = cPickle.load(file(self.wisdom_cache_file))
-            pyfftw.import_wisdom(DictWisdom["Wisdom"])
-            WisdomTypes=DictWisdom["WisdomTypes"]
-        else:
-            WisdomTypes=[]
-
-        HasTouchedWisdomFile = False
-        T=ClassTimeIt.ClassTimeIt("setWisdom")
-        T.disable()
-        for iFacet in sorted(self.DicoImager.keys()):
-            NPixPadded=self.DicoImager[iFacet]["NpixFacetPadded"]
-            if self.GD["RIME"]["Precision"]=="S":
-                TypeKey=(NPixPadded,np.complex64)
-            elif self.GD["RIME"]["Precision"]=="D":
-                TypeKey=(NPixPadded,np.complex128)
-
-            if TypeKey not in WisdomTypes:
-                HasTouchedWisdomFile = True
-                ModFFTW.learnFFTWWisdom(*TypeKey)
-                WisdomTypes.append(TypeKey)
-
-        NOut = self.OutImShape[-1]
-        TypeKey=(NOut,np.float32)
-        if TypeKey not in WisdomTypes:
-            HasTouchedWisdomFile = True
-            ModFFTW.learnFFTWWisdom(*TypeKey)
-            WisdomTypes.append(TypeKey)
-        self.FFTW_Wisdom = pyfftw.export_wisdom()
-        DictWisdom={"Wisdom":self.FFTW_Wisdom,
-                    "WisdomTypes":WisdomTypes}
-
-        if HasTouchedWisdomFile:
-            print>>log, "Saving wisdom file to %s"%self.wisdom_cache_file
-            cPickle.dump(DictWisdom, file(self.wisdom_cache_file, "w"))
+        ModFFTW.learnWisdom(self.wisdom_cache_file, WisdomTypes, reset=self.GD["Cache"]["ResetWisdom"])
 
 
     def initCFInBackground (self, other_fm=None):
@@ -632,10 +613,11 @@ class ClassFacetMachine():
 
         if self.GD["Cache"]["CacheCF"]:
             cachekey = dict(ImagerCF=self.GD["CF"], 
-                            ImagerMainFacet=self.GD["Image"], 
+                            ImagerMainFacet={key: self.GD["Image"][key] for key in ("NPix", "Cell", "PhaseCenterRADEC")},
                             Facets=self.GD["Facets"], 
-                            RIME=self.GD["RIME"],
-                            DDESolutions={"DDSols":self.GD["DDESolutions"]["DDSols"]})
+                            RIME={key: self.GD["RIME"][key] for key in ("Precision", "DecorrMode", "DecorrLocation")},
+                            DDESolutions={"DDSols":self.GD["DDESolutions"]["DDSols"]},
+                            wmax=wmax)
             cachename = self._cf_cachename = "CF"
             # in oversize-PSF mode, make separate cache for PSFs
             if self.DoPSF and self.Oversize != 1:
@@ -818,21 +800,74 @@ class ClassFacetMachine():
         self.SetLogModeSubModules("Loud")
 
 
-    def setModelImage(self, ModelImage):
-        """Sets current model image. Copies it to a shared dict and returns shared array version of image."""
+    def setModelImage(self, ModelImage, cache_key=None, min_facet_flux=0.):
+        """Sets current model image. Copies it to a shared dict and returns shared array version of image.
+
+        If cache_key is given, the model image is retained (see useCachedModelImage()), along with the FFTed model
+        grids of its facets, as they are computed by the degridder. Facets whose absolute model flux is at most
+        min_facet_flux times the total are not degridded (0 skips only facets with no model flux at all)."""
         if self.DoPSF:
             raise RuntimeError("Can't call getChunk on a PSF mode FacetMachine. This is a bug!")
-        self._model_dict = shared_dict.create("Model")
+        if cache_key is None:
+            self._releaseModelCache()
+            self._model_dict = shared_dict.create("Model")
+        else:
+            while len(self._model_cache) >= MODEL_CACHE_SIZE:
+                _, (model_dict, _) = self._model_cache.popitem(last=False)
+                model_dict.delete()
+            self._model_dict = shared_dict.create("Model:%d" % self._model_cache_count)
+            self._model_cache_count += 1
         self._model_dict["Image"] = ModelImage
         for iFacet in range(self.NFacets):
             self._model_dict.addSubdict(iFacet)
+        self._model_info = dict(cache_grids=cache_key is not None,
+                                skip=self._findEmptyFacets(self._model_dict["Image"], min_facet_flux))
+        if cache_key is not None:
+            self._model_cache[cache_key] = self._model_dict, self._model_info
+        return self._model_dict["Image"]
+
+    def useCachedModelImage(self, cache_key):
+        """Makes a model image previously set with that cache_key current again. Returns the shared array version
+        of the image, or None if no such image is cached."""
+        if cache_key not in self._model_cache:
+            return None
+        self._model_dict, self._model_info = self._model_cache.pop(cache_key)
+        self._model_cache[cache_key] = self._model_dict, self._model_info
         return self._model_dict["Image"]
 
+    def _findEmptyFacets(self, ModelImage, min_facet_flux):
+        """Returns set of facets whose (padded) footprint on the model image has an absolute flux of at most
+        min_facet_flux times the total. These will not be degridded."""
+        nch, npol, NPixOut, _ = ModelImage.shape
+        AbsModel = np.abs(ModelImage).sum(axis=(0, 1))
+        threshold = min_facet_flux*AbsModel.sum()
+        skip = set()
+        for iFacet in self.DicoImager.keys():
+            N1 = self.DicoImager[iFacet]["NpixFacetPadded"]
+            xc, yc = self.DicoImager[iFacet]["pixCentral"]
+            Aedge, _ = GiveEdges((xc, yc), NPixOut, (N1/2, N1/2), N1)
+            x0d, x1d, y0d, y1d = Aedge
+            if AbsModel[x0d:x1d, y0d:y1d].sum() <= threshold:
+                skip.add(iFacet)
+        print>>log, "%d/%d facets have no significant model flux, and will not be degridded" % (len(skip), len(self.DicoImager))
+        return skip
+
+    def _releaseModelCache(self):
+        for model_dict, _ in self._model_cache.itervalues():
+            model_dict.delete()
+        self._model_cache.clear()
+
     def releaseModelImage(self):
         """Deletes current model image from SHM. USe to save RAM."""
         if self._model_dict is not None:
             self._model_dict.delete()
             self._model_dict = None
+        self._releaseModelCache()
+
+    def giveDegridStats(self):
+        """Returns dict of degrid job counts: total, skipped (no model flux in facet), empty (facet model found to
+        be empty by the degridder), reused (model grid reused from a previous chunk)"""
+        return self._degrid_stats.copy()
 
     def _buildFacetSlice_worker(self, iFacet, facet_grids, facetdict, cfdict, sumjonesnorm, sumweights, W):
         # first normalize by spheroidals - these
@@ -920,13 +955,19 @@ class ClassFacetMachine():
             "SumWeights" = sum of visibility weights used in normalizing the gridded correlations
             "WeightChansImages" = normalized weights
         """
+        # in pipeline mode, FFT jobs are scheduled before waiting on outstanding grid jobs, so that
+        # each facet is transformed as soon as its own gridding is done
+        if not self.HasFourierTransformed:
+            self.fourierTransformInBackground()
         # wait for any outstanding grid jobs to finish
-        self.collectGriddingResults()
+        with Tracing.stage("grid", psf=self.DoPSF):
+            self.collectGriddingResults()
 
         if not self.HasFourierTransformed:
-            self.fourierTransformInBackground()
-            self.collectFourierTransformResults()
+            with Tracing.stage("FFT", psf=self.DoPSF):
+                self.collectFourierTransformResults()
             self.HasFourierTransformed = True
+        t0_stitch = time.time()
         _, npol, Npix, Npix = self.OutImShape
         DicoImages = shared_dict.create("%s_AllImages"%self._app_id)
         DicoImages["freqs"] = {}
@@ -1085,6 +1126,7 @@ class ClassFacetMachine():
             # print>>log,"copying dictPSF"
             # DicoImages.reload()
             self._psf_dict = DicoImages
+            Tracing.recordStage("stitch", t0_stitch, psf=True)
             return DicoImages
 
         # else build Dirty (residual) image
@@ -1113,6 +1155,7 @@ class ClassFacetMachine():
             DicoImages["MeanImage"] = MeanResidual
             DicoImages["FacetNorm"] = FacetNorm  # grid-correcting map
             DicoImages["JonesNorm"] = JonesNorm
+            Tracing.recordStage("stitch", t0_stitch, psf=False)
             return DicoImages
 
     def getNormDict(self): return self._norm_dict
@@ -1362,6 +1405,7 @@ class ClassFacetMachine():
             #print>> log, "applying sparsification factor of %f to %d BDA degrid blocks, left with %d" % (factor, num_blocks, DATA["Sparsification.Degrid"].sum())
 
     def _grid_worker(self, iFacet, DATA, cf_dict, griddict):
+        t0 = time.time()
         T = ClassTimeIt.ClassTimeIt()
         T.disable()
 
@@ -1425,6 +1469,8 @@ class ClassFacetMachine():
                         sparsification=DATA.get("Sparsification.Grid")
                         )
         T.timeit("put %s" % iFacet)
+        Tracing.annotate(facet=iFacet, chunk=DATA["label"],
+                         bytes=visThis.nbytes+flagsThis.nbytes+W.nbytes+griddict[iFacet].nbytes)
 
         T.timeit("Grid")
         Sw = GridMachine.SumWeigths.copy()
@@ -1432,7 +1478,25 @@ class ClassFacetMachine():
         SumJonesChan = GridMachine.SumJonesChan.copy()
         
 
-        return {"iFacet": iFacet, "Weights": Sw, "SumJones": SumJones, "SumJonesChan": SumJonesChan}
+        return {"iFacet": iFacet, "Weights": Sw, "SumJones": SumJones, "SumJonesChan": SumJonesChan,
+                "Time": time.time() - t0}
+
+    def giveFacetSchedule(self, kind):
+        """
+        Returns list of facet IDs ordered by decreasing expected cost of a "grid" or "degrid" job. Jobs are
+        taken off the compute queue in order, so submitting the most expensive facets first means the
+        last few big facets don't leave the other cores idle at the end of a chunk.
+
+        The cost of a facet is its job time in the previous chunk. Facets without a timing yet (e.g. on the
+        first chunk) are estimated from their padded grid size.
+        """
+        timings = self._facet_job_times[kind]
+        sizes = dict([(iFacet, float(self.DicoImager[iFacet]["NpixFacetPadded"])**2) for iFacet in self.DicoImager.keys()])
+        # time per grid pixel of the facets that have been timed, to put the size estimate on the same scale
+        timed = [iFacet for iFacet in sizes.iterkeys() if iFacet in timings]
+        scale = sum([timings[iFacet] for iFacet in timed]) / sum([sizes[iFacet] for iFacet in timed]) if timed else 1
+        cost = dict([(iFacet, timings[iFacet] if iFacet in timings else sizes[iFacet]*scale) for iFacet in sizes.iterkeys()])
+        return sorted(cost.iterkeys(), key=lambda iFacet:(-cost[iFacet], iFacet))
 
     def gridChunkInBackground(self, DATA):
         """
@@ -1442,22 +1506,62 @@ class ClassFacetMachine():
         """
         # wait for any init to finish
         self.awaitInitCompletion()
-        # wait for any previous gridding/degridding jobs to finish, if still active
-        self.collectGriddingResults()
-        self.collectDegriddingResults()
+        if self._pipeline:
+            # degridding of this chunk makes the residual visibilities, so it must be done. The previous
+            # chunk can still be gridding: its jobs are left running, and the facets that are still busy get
+            # their new grid job launched from the completion callback. At most one previous chunk is kept in flight.
+            self.collectDegriddingResults()
+            self.collectPreviousGriddingResults()
+            if self._grid_job_id is not None:
+                self._prev_grid_batch = self._grid_job_id, self._grid_job_label, self._grid_iMS
+                self._grid_job_id = None
+        else:
+            # wait for any previous gridding/degridding jobs to finish, if still active
+            self.collectGriddingResults()
+            self.collectDegriddingResults()
         # run new set of jobs
         self._grid_iMS, self._grid_iChunk = DATA["iMS"], DATA["iChunk"]
         self._grid_job_label = DATA["label"]
         self._grid_job_id = "%s.Grid.%s:" % (self._app_id, self._grid_job_label)
-        for iFacet in self.DicoImager.keys():
-            APP.runJob("%sF%d" % (self._grid_job_id, iFacet), self._grid_worker,
-                            args=(iFacet, DATA.readonly(), self._CF[iFacet].readonly(),
-                                  self._facet_grids.readonly()))
+        for iFacet in self.giveFacetSchedule("grid"):
+            args = (iFacet, DATA.readonly(), self._CF[iFacet].readonly(), self._facet_grids.readonly())
+            if iFacet in self._grid_busy:
+                self._grid_deferred[iFacet] = self._grid_job_id, args
+            else:
+                self._runGridJob(iFacet, self._grid_job_id, args)
+
+    def _runGridJob(self, iFacet, job_id, args):
+        self._grid_busy.add(iFacet)
+        APP.runJob("%sF%d" % (job_id, iFacet), self._grid_worker, args=args,
+                   when_complete=lambda: self._onGridJobComplete(iFacet))
+
+    def _onGridJobComplete(self, iFacet):
+        """Called in the main process when a grid job has completed. Launches the jobs that were waiting
+        on this facet: the facet's grid job for the next chunk, if any, else its FFT, if scheduled."""
+        self._grid_busy.discard(iFacet)
+        if iFacet in self._grid_deferred:
+            job_id, args = self._grid_deferred.pop(iFacet)
+            self._runGridJob(iFacet, job_id, args)
+        elif iFacet in self._fft_deferred:
+            self._fft_deferred.discard(iFacet)
+            self._runFFTJob(iFacet)
 
     # ##############################################
     # ##### Smooth beam ############################
-    def _SmoothAverageBeam_worker(self, DATA, iDir):
-        self.AverageBeamMachine.StackBeam(DATA, iDir)
+    def _StackBeamWeights_worker(self, DATA):
+        self.AverageBeamMachine.StackBeamWeights(DATA)
+
+    def _SmoothAverageBeam_worker(self, DATA, ListDir):
+        self.AverageBeamMachine.StackBeam(DATA, ListDir)
+
+    def _runStackBeamJobs(self, DATA, JobName):
+        """Called in the main process once the StackBeamWeights job of a chunk is done. Runs the StackBeam jobs
+        on blocks of directions."""
+        NDir = self.AverageBeamMachine.NDir
+        for iBlock, ListDir in enumerate(np.array_split(np.arange(NDir), min(NDir, APP.ncpu))):
+            APP.runJob("%sF%d" % (JobName, iBlock),
+                       self._SmoothAverageBeam_worker,
+                       args=(DATA.readonly(), ListDir.tolist()))
 
     def StackAverageBeam(self, DATA):
         # the FacetMachinePSF does not have an AverageBeamMachine
@@ -1468,16 +1572,17 @@ class ClassFacetMachine():
             return
         # wait for any init to finish
         self.awaitInitCompletion()
-        # wait for any previous gridding/degridding jobs to finish, if still active
-        self.collectGriddingResults()
+        # wait for any previous gridding/degridding jobs to finish, if still active. In pipeline mode,
+        # gridding is left running, and only the previous stacking jobs need to be done.
+        if not self._pipeline:
+            self.collectGriddingResults()
         self.collectDegriddingResults()
+        self._collectStackBeamResults()
         # run new set of jobs
         self._smooth_job_label=DATA["label"]
-        JobName="StackBeam%sF"%self._smooth_job_label
-        for iDir in range(self.AverageBeamMachine.NDir):
-            APP.runJob("%s%d" % (JobName,iDir), 
-                       self._SmoothAverageBeam_worker,
-                       args=(DATA.readonly(), iDir))
+        JobName="StackBeam%s"%self._smooth_job_label
+        APP.runJob(JobName+"W", self._StackBeamWeights_worker, args=(DATA.readonly(),),
+                   when_complete=lambda: self._runStackBeamJobs(DATA, JobName))
 
 
     def finaliseSmoothBeam(self):
@@ -1534,31 +1639,55 @@ class ClassFacetMachine():
                 self.DicoImager[iFacet]["SumJones"]
                 self.DicoImager[iFacet]["SumJonesChan"][DATA["iMS"]]
         """
+        # the previous chunk's jobs must be collected first, since their completion callbacks
+        # launch any deferred jobs of the current chunk
+        self.collectPreviousGriddingResults()
+        # stacking jobs use the chunk's data too, so make sure they're done
+        self._collectStackBeamResults()
         # if this is set to None, then results already collected
         if self._grid_job_id is None:
             return
+        self._collectGridBatch(self._grid_job_id, self._grid_job_label, self._grid_iMS)
+        self._grid_job_id = None
+
+        return True
+
+    def collectPreviousGriddingResults(self):
+        """
+        In pipeline mode, waits for the grid jobs of the chunk before the current one (if still active) and
+        collects their results, leaving the current chunk's jobs running. Otherwise does nothing.
+        """
+        if self._prev_grid_batch is None:
+            return
+        self._collectGridBatch(*self._prev_grid_batch)
+        self._prev_grid_batch = None
+        return True
+
+    def _collectGridBatch(self, job_id, label, iMS):
         # collect results of grid workers
-        results = APP.awaitJobResults(self._grid_job_id+"*",progress=
-                            ("Grid PSF %s" if self.DoPSF else "Grid %s") % self._grid_job_label)
+        results = APP.awaitJobResults(job_id+"*",progress=
+                            ("Grid PSF %s" if self.DoPSF else "Grid %s") % label)
 
         for DicoResult in results:
             # if we hit a returned exception, raise it again
             if isinstance(DicoResult, Exception):
                 raise DicoResult
             iFacet = DicoResult["iFacet"]
+            self._facet_job_times["grid"][iFacet] = DicoResult["Time"]
             self.DicoImager[iFacet]["SumWeights"] += DicoResult["Weights"]
             self.DicoImager[iFacet]["SumJones"] += DicoResult["SumJones"]
-            self.DicoImager[iFacet]["SumJonesChan"][self._grid_iMS] += DicoResult["SumJonesChan"]
-        self._grid_job_id = None
+            self.DicoImager[iFacet]["SumJonesChan"][iMS] += DicoResult["SumJonesChan"]
 
+    def _collectStackBeamResults(self):
         if self.AverageBeamMachine is not None and \
            self.AverageBeamMachine.SmoothBeam is None and\
            self._smooth_job_label is not None:
-            JobName="StackBeam%sF"%self._smooth_job_label
-            APP.awaitJobResults(JobName+"*",
+            JobName="StackBeam%s"%self._smooth_job_label
+            # the StackBeam jobs are launched once the weights job completes
+            APP.awaitJobResults(JobName+"W")
+            APP.awaitJobResults(JobName+"F*",
                                 progress=("Stack Beam %s" % self._smooth_job_label))
-
-        return True
+        self._smooth_job_label = None
 
     def _fft_worker(self, iFacet, cf_dict, griddict):
         """
@@ -1580,14 +1709,23 @@ class ClassFacetMachine():
         Fourier transforms the individual facet grids in-place.
         Runs background jobs for this.
         '''
-        # wait for any previous gridding jobs to finish, if still active
-        self.collectGriddingResults()
+        # wait for any previous gridding jobs to finish, if still active. In pipeline mode, the FFT of a
+        # facet that is still being gridded is launched by the completion callback of its last grid job
+        if not self._pipeline:
+            self.collectGriddingResults()
         # run FFT jobs
         self._fft_job_id = "%s.FFT:" % self._app_id
-        for iFacet in self.DicoImager.keys():
-            APP.runJob("%sF%d" % (self._fft_job_id, iFacet), self._fft_worker,
-                            args=(iFacet, self._CF[iFacet].readonly(), self._facet_grids.readonly()),
-                            )
+        # biggest FFTs first
+        for iFacet in sorted(self.DicoImager.keys(), key=lambda iFacet:-self.DicoImager[iFacet]["NpixFacetPadded"]):
+            if iFacet in self._grid_busy:
+                self._fft_deferred.add(iFacet)
+            else:
+                self._runFFTJob(iFacet)
+
+    def _runFFTJob(self, iFacet):
+        APP.runJob("%sF%d" % (self._fft_job_id, iFacet), self._fft_worker,
+                        args=(iFacet, self._CF[iFacet].readonly(), self._facet_grids.readonly()),
+                        )
         # APP.awaitJobResults(self._fft_job_id+"*", progress=("FFT PSF" if self.DoPSF else "FFT"))
 
     def collectFourierTransformResults (self):
@@ -1718,8 +1856,19 @@ class ClassFacetMachine():
     # #####################################################"
 
     # DeGrid worker that is called by Multiprocessing.Process
-    def _degrid_worker(self, iFacet, DATA, cf_dict, ChanSel, modeldict):
-        ModelGrid = self._set_model_grid_worker(iFacet, modeldict, cf_dict, ChanSel)
+    def _degrid_worker(self, iFacet, DATA, cf_dict, ChanSel, modeldict, cache_grid=False):
+        t0 = time.time()
+        facetdict = modeldict[iFacet]
+        # FFTed model grid retained from a previous chunk? This is kept apart from the image-plane "FacetGrid"
+        # set by _set_model_grid_worker()
+        reused = cache_grid and "FacetGridFT" in facetdict and np.array_equal(facetdict["ChanSelFT"], ChanSel)
+        if reused:
+            ModelGrid = facetdict["FacetGridFT"]
+        else:
+            ModelGrid = self._set_model_grid_worker(iFacet, modeldict, cf_dict, ChanSel)
+            # nothing to degrid
+            if not ModelGrid.any():
+                return {"iFacet": iFacet, "Time": time.time() - t0, "Empty": True, "Reused": False}
 
         # Create a new GridMachine
         GridMachine = self._createGridMachine(iFacet, cf_dict=cf_dict,
@@ -1761,15 +1910,30 @@ class ClassFacetMachine():
                                   lm_min=lm_min,
                                   lm_PhaseCenter=DATA["lm_PhaseCenter"])
 
+        TranformModelInput = "FT"
+        if cache_grid and not reused:
+            # FFT the model here rather than in get(), so that the grid can be retained for subsequent chunks
+            if self.GD["RIME"]["RealFFT"]:
+                ModelGrid = np.complex64(GridMachine.getFFTWMachine().fft_real(ModelGrid))
+            else:
+                Cast = np.complex128 if self.GD["RIME"]["Precision"] == "D" else np.complex64
+                ModelGrid = np.complex64(GridMachine.getFFTWMachine().fft(Cast(ModelGrid)))
+            facetdict["FacetGridFT"] = ModelGrid
+            facetdict["ChanSelFT"] = np.array(ChanSel)
+        if cache_grid:
+            TranformModelInput = ""
+
         GridMachine.get(times, uvwThis, visThis, flagsThis, A0A1,
                           ModelGrid, ImToGrid=False,
                           DicoJonesMatrices=DicoJonesMatrices,
-                          freqs=freqs, TranformModelInput="FT",
+                          freqs=freqs, TranformModelInput=TranformModelInput,
                           ChanMapping=ChanMapping,
                           sparsification=DATA.get("Sparsification.Degrid")
                         )
 
-        return {"iFacet": iFacet}
+        Tracing.annotate(facet=iFacet, chunk=DATA["label"], bytes=visThis.nbytes+flagsThis.nbytes+ModelGrid.nbytes,
+                         reused=reused)
+        return {"iFacet": iFacet, "Time": time.time() - t0, "Empty": False, "Reused": reused}
 
     def degridChunkInBackground (self, DATA):
         """
@@ -1799,10 +1963,21 @@ class ClassFacetMachine():
         self._degrid_job_label = DATA["label"]
         self._degrid_job_id = "%s.Degrid.%s:" % (self._app_id, self._degrid_job_label)
 
-        for iFacet in self.DicoImager.keys():
+        skip = self._model_info["skip"]
+        cache_grids = self._model_info["cache_grids"]
+        njobs = 0
+        for iFacet in self.giveFacetSchedule("degrid"):
+            self._degrid_stats["total"] += 1
+            if iFacet in skip:
+                self._degrid_stats["skipped"] += 1
+                continue
             APP.runJob("%sF%d" % (self._degrid_job_id, iFacet), self._degrid_worker,
                             args=(iFacet, DATA.readonly(), self._CF[iFacet].readonly(),
-                                  ChanSel, self._model_dict.readonly()))#,serial=True)
+                                  ChanSel, self._model_dict.readonly(), cache_grids))#,serial=True)
+            njobs += 1
+        # nothing to collect
+        if not njobs:
+            self._degrid_job_id = None
         #APP.awaitJobResults(self._degrid_job_id + "*", progress="Degrid %s" % self._degrid_job_label)
 
 
@@ -1815,7 +1990,15 @@ class ClassFacetMachine():
         if self._degrid_job_id is None:
             return
         # collect results of degrid workers
-        APP.awaitJobResults(self._degrid_job_id + "*", progress="Degrid %s" % self._degrid_job_label)
+        results = APP.awaitJobResults(self._degrid_job_id + "*", progress="Degrid %s" % self._degrid_job_label)
+        for DicoResult in results:
+            if DicoResult["Empty"]:
+                self._degrid_stats["empty"] += 1
+                # don't bother with this facet in subsequent chunks
+                self._model_info["skip"].add(DicoResult["iFacet"])
+            else:
+                self._facet_job_times["degrid"][DicoResult["iFacet"]] = DicoResult["Time"]
+            self._degrid_stats["reused"] += DicoResult["Reused"]
         self._degrid_job_id = None
         return True
 
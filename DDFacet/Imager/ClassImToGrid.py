@@ -235,7 +235,10 @@ class ClassImToGrid():
         if ToGrid:
             ModelIm*=(self.OverS*N1)**2
             if SumFlux!=0:
-                Grid=np.complex64(self.FFTWMachine.fft(np.complex64(ModelIm),ChanList=CSel))
+                if self.GD["RIME"]["RealFFT"]:
+                    Grid=np.complex64(self.FFTWMachine.fft_real(ModelIm,ChanList=CSel))
+                else:
+                    Grid=np.complex64(self.FFTWMachine.fft(np.complex64(ModelIm),ChanList=CSel))
             else:
                 Grid=np.complex64(ModelIm)
             
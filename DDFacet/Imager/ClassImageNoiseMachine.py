@@ -23,11 +23,15 @@ from DDFacet.Other import ModColor
 log=MyLogger.getLogger("MaskMachine")
 from pyrap.images import image
 import scipy.special
+import scipy.ndimage
 import copy
 from DDFacet.Imager.ModModelMachine import ClassModModelMachine
 
 from DDFacet.ToolsDir import ModFFTW
 
+# size (in decimated pixels) of the tiles in which the min-stat noise map is incrementally updated
+NOISE_TILE_SIZE = 64
+
 class ClassImageNoiseMachine():
     def __init__(self, GD, ExternalModelMachine=None, DegridFreqs=None, GridFreqs=None, MainCache=None):
         self.GD = copy.deepcopy(GD)
@@ -37,6 +41,7 @@ class ClassImageNoiseMachine():
         self.NoiseMapRestored=None
         self.NoiseMapReShape=None
         self._id_InputMap=None
+        self._MinStatState=None
         self.ExternalModelMachine=ExternalModelMachine
         self.DegridFreqs = DegridFreqs
         self.GridFreqs = GridFreqs
@@ -107,6 +112,49 @@ class ClassImageNoiseMachine():
             raise NotImplementedError("Mode %s not compatible with automasking" % self.GD["Deconv"]["Mode"])
 
 
+    def _minStatFilter(self, Acopy, SBox, Tol):
+        """Returns the minimum filter of the decimated image, and the reference image it is exactly the minimum
+        filter of. If it was computed before (for the same shape and box), only the tiles affected by pixels that
+        differ from the previous reference image by more than Tol are recomputed, so that the returned filter is
+        always within Tol of that of Acopy"""
+        state = self._MinStatState
+        if state is None or state["RefImage"].shape != Acopy.shape or state["SBox"] != SBox:
+            print>>log, "    computing full minimum filter"
+            return scipy.ndimage.filters.minimum_filter(Acopy, SBox), Acopy
+        nx, ny = Acopy.shape
+        T = NOISE_TILE_SIZE
+        ntx, nty = (nx+T-1)//T, (ny+T-1)//T
+        # find tiles containing changed pixels
+        Changed = np.zeros((ntx*T, nty*T), np.bool)
+        Changed[:nx, :ny] = np.abs(Acopy-state["RefImage"]) > Tol
+        TileChanged = Changed.reshape((ntx, T, nty, T)).any(axis=(1, 3))
+        # a changed pixel affects the filter output within a box's distance, so dilate the map of changed tiles
+        ndil = (max(SBox)+T-1)//T
+        TileRecompute = scipy.ndimage.filters.maximum_filter(TileChanged, 2*ndil+1)
+        nchanged = TileRecompute.sum()
+        if nchanged > TileRecompute.size/2:
+            print>>log, "    %d/%d tiles have changed, computing full minimum filter"%(nchanged, TileRecompute.size)
+            return scipy.ndimage.filters.minimum_filter(Acopy, SBox), Acopy
+        print>>log, "    updating minimum filter in %d/%d tiles"%(nchanged, TileRecompute.size)
+        # The reference image takes the new pixel values only where all the tiles depending on them are recomputed
+        # (this includes all the changed tiles), and keeps its old values elsewhere. The recomputed tiles are filtered
+        # from the new reference, so that small changes left out of it accumulate until they exceed Tol, rather than
+        # being lost
+        TileRefresh = scipy.ndimage.filters.minimum_filter(TileRecompute, 2*ndil+1)
+        Refresh = np.repeat(np.repeat(TileRefresh, T, axis=0), T, axis=1)[:nx, :ny]
+        RefImage = np.where(Refresh, Acopy, state["RefImage"])
+        MinFilter = state["MinFilter"].copy()
+        # halo wide enough to cover the filter footprint on either side
+        hx, hy = SBox[0]//2+1, SBox[1]//2+1
+        for itx, ity in zip(*np.where(TileRecompute)):
+            x0, x1 = itx*T, min((itx+1)*T, nx)
+            y0, y1 = ity*T, min((ity+1)*T, ny)
+            X0, X1 = max(x0-hx, 0), min(x1+hx, nx)
+            Y0, Y1 = max(y0-hy, 0), min(y1+hy, ny)
+            Tile = scipy.ndimage.filters.minimum_filter(RefImage[X0:X1, Y0:Y1], SBox)
+            MinFilter[x0:x1, y0:y1] = Tile[x0-X0:x1-X0, y0-Y0:y1-Y0]
+        return MinFilter, RefImage
+
     def giveMinStatNoiseMap(self,Image):
         Box,Step=self.GD["Noise"]["MinStats"]
         box=(Box,Box)
@@ -121,26 +169,28 @@ class ClassImageNoiseMachine():
         F=1.-(1.-f)**n
         ratio=np.abs(np.interp(0.5,F,x))
 
-        Noise=-scipy.ndimage.filters.minimum_filter(Acopy,SBox)/ratio
+        # tolerance is relative to the noise level of the previous map
+        Tol=0.
+        if self._MinStatState is not None:
+            Tol=self.GD["Noise"]["MinStatsTol"]*self._MinStatState["NoiseMed"]
+        MinFilter,RefImage=self._minStatFilter(Acopy,SBox,Tol)
+        Noise=-MinFilter/ratio
 
         NPixStats=10000
         IndStats=np.int64(np.linspace(0,Noise.size-1,NPixStats))
         NoiseMed=np.std(Noise.ravel()[IndStats])
         #NoiseMed=np.median(Noise)
         Noise[Noise<NoiseMed]=NoiseMed
+        self._MinStatState=dict(RefImage=RefImage,SBox=SBox,MinFilter=MinFilter,NoiseMed=NoiseMed)
 
-        LargeNoise=np.zeros_like(Image[0,0])
-        for i in range(Boost):
-            for j in range(Boost):
-                s00,s01=Noise.shape
-                s10,s11=LargeNoise[i::Boost,j::Boost].shape
-                s0,s1=min(s00,s10),min(s10,s11)
-                LargeNoise[i::Boost,j::Boost][0:s0,0:s1]=Noise[:,:][0:s0,0:s1]
-        ind=np.where(LargeNoise==0.)
-        LargeNoise[ind]=NoiseMed
-
-
+        # upsample: every Boost x Boost block of the big map takes the value of its decimated pixel
         _,_,nx,ny=Image.shape
+        s0,s1=Noise.shape
+        LargeNoise=np.empty((s0,Boost,s1,Boost),Image.dtype)
+        LargeNoise[...]=Noise[:,np.newaxis,:,np.newaxis]
+        LargeNoise=LargeNoise.reshape((s0*Boost,s1*Boost))[:nx,:ny]
+        LargeNoise[LargeNoise==0.]=NoiseMed
+
         self.NoiseMap=LargeNoise
         self.NoiseMapReShape=self.NoiseMap.reshape((1,1,nx,ny))
         return self.NoiseMapReShape
@@ -256,7 +306,8 @@ class ClassImageNoiseMachine():
         # # ModelConv=scipy.signal.convolve2d(ModelImage,G,mode="same")
 
         ModelConv=ModFFTW.ConvolveGaussian({0:Model},0,0,0, CellSizeRad=self.DicoDirty["ImageInfo"]["CellSizeRad"],
-                                           GaussPars_ch=self.DicoVariablePSF["EstimatesAvgPSF"][1])
+                                           GaussPars_ch=self.DicoVariablePSF["EstimatesAvgPSF"][1],
+                                           AllowDirect=True)
 
         #GaussPar=[i*5 for i in self.DicoVariablePSF["EstimatesAvgPSF"][1]]
         #ModelConv+=ModFFTW.ConvolveGaussian(Model, CellSizeRad=self.DicoDirty["ImageInfo"]["CellSizeRad"],
@@ -102,6 +102,7 @@ class ClassImageDeconvMachine():
         self.CurrentNegMask = None
         self._NoiseMap = None
         self._PNRStop = None  # in _peakMode "sigma", provides addiitonal stopping criterion
+        self._PeakIndex = None  # per-tile maxima of the PeakMap, built by Deconvolve() and updated by SubStep()
 
 
     def Init(self, **kwargs):
@@ -164,6 +165,7 @@ class ClassImageDeconvMachine():
 
     def SetDirty(self,DicoDirty):
         self.DicoDirty=DicoDirty
+        self._PeakIndex = None
         self._Dirty = self.DicoDirty["ImageCube"]
         self._MeanDirty = self.DicoDirty["MeanImage"]
 
@@ -214,6 +216,9 @@ class ClassImageDeconvMachine():
         if self.MultiFreqMode:  #If multiple frequencies are present construct the weighted mean
             W=np.mean(np.float32(self.DicoDirty["WeightChansImages"]),axis=1)  #Get the weights (assuming they stay relatively the same over stokes terms)
             self._MeanDirty[0,:,x0d:x1d,y0d:y1d]-=np.sum(LocalSM[:,:,x0p:x1p,y0p:y1p]*W.reshape((W.size,1,1,1)),axis=0) #Sum over frequency
+        #Update the maxima of the PeakMap tiles we touched
+        if self._PeakIndex is not None:
+            self._PeakIndex.update(x0d,x1d,y0d,y1d)
 
     def setChannel(self,ch=0):
         """
@@ -276,8 +281,10 @@ class ClassImageDeconvMachine():
 
         Fluxlimit_RMS = self.RMSFactor*RMS
 
-        #Find position and intensity of first peak
-        x,y,MaxDirty=NpParallel.A_whereMax(PeakMap,NCPU=self.NCPU,DoAbs=DoAbs,Mask=self.MaskArray)
+        #Find position and intensity of first peak. The PeakMap is indexed by tile, so that each iteration only
+        #rescans the tiles touched by SubStep()
+        self._PeakIndex=NpParallel.WhereMaxIndex(PeakMap,DoAbs=DoAbs,Mask=self.MaskArray)
+        x,y,MaxDirty=self._PeakIndex.whereMax()
 
         #Get peak factor stopping criterion
         Fluxlimit_Peak = MaxDirty*self.PeakFactor
@@ -322,10 +329,7 @@ class ClassImageDeconvMachine():
         try:
             for i in range(self._niter+1,self.MaxMinorIter+1):
                 self._niter = i
-                #grab a new peakmap
-                PeakMap = self.Dirty[0, :, :]
-
-                x,y,ThisFlux=NpParallel.A_whereMax(PeakMap,NCPU=self.NCPU,DoAbs=DoAbs,Mask=self.MaskArray)
+                x,y,ThisFlux=self._PeakIndex.whereMax()
 
                 # deprecated?
                 self.GainMachine.SetFluxMax(ThisFlux)
@@ -128,6 +128,13 @@ class ClassImageDeconvMachine():
             self._peakMode = "weighted"
 
         self._prevPeak = None
+        # per-tile maxima of self._PeakSearchImage, built by Deconvolve() and kept up to date by SubStep()
+        self._PeakIndex = None
+        # batched ("Clark-style") minor cycle: number of components to fit and subtract per iteration
+        self._BatchSize = max(self.GD["HMP"]["BatchSubtract"] or 1, 1)
+        self._BatchPeakFactor = self.GD["HMP"]["BatchPeakFactor"]
+        # maps facet number to the key of its basis functions in self.facetcache
+        self._FacetCacheKey = {}
 
     def setNCPU(self,NCPU):
         self.NCPU=NCPU
@@ -225,12 +232,42 @@ class ClassImageDeconvMachine():
         MSMachine.MakeBasisMatrix()
         del MSMachine
 
+    def _giveMSMachine(self, cachedict, iFacet, SideLobeLevel, OffsetSideLobe, verbose=False):
+        """Makes a multiscale machine for facet iFacet, with basis functions taken from (or, if not there yet,
+        computed into) cachedict. self.PSFServer must be set."""
+        self.PSFServer.setFacet(iFacet)
+        MSMachine = ClassMultiScaleMachine.ClassMultiScaleMachine(self.GD, cachedict,
+                                                                  self.GainMachine, NFreqBands=self.NFreqBands)
+        MSMachine.setModelMachine(self.ModelMachine)
+        MSMachine.setSideLobeLevel(SideLobeLevel, OffsetSideLobe)
+        MSMachine.SetFacet(iFacet)
+        MSMachine.SetPSF(self.PSFServer)  # ThisPSF,ThisMeanPSF)
+        MSMachine.FindPSFExtent(verbose=verbose)
+        MSMachine.MakeMultiScaleCube(verbose=verbose)
+        MSMachine.MakeBasisMatrix()
+        return MSMachine
+
+    def _fitLocalSM_handler(self, fcdict, psfdict, dirtydict, outdict, ListFits, SideLobeLevel, OffsetSideLobe):
+        """Fits components for the batched minor cycle. ListFits is a list of (iPeak, iFacet, CacheKey, x, y, Fpol)
+        tuples. The convolved image and solution of each component go into outdict[iPeak]."""
+        self.SetPSF(psfdict, quiet=True)
+        DicoMSMachine = {}
+        for iPeak, iFacet, CacheKey, x, y, Fpol in ListFits:
+            MSMachine = DicoMSMachine.get(CacheKey)
+            if MSMachine is None:
+                MSMachine = DicoMSMachine[CacheKey] = self._giveMSMachine(fcdict[CacheKey], iFacet,
+                                                                          SideLobeLevel, OffsetSideLobe)
+                MSMachine.SetDirty(dirtydict)
+            LocalSM, Sol = MSMachine.fitLocalSM((x, y), Fpol)
+            outdict[iPeak] = dict(LocalSM=LocalSM, Sol=Sol)
+
     def InitMSMF(self, approx=False, cache=True, facetcache=None):
         """Initializes MSMF basis functions. If approx is True, then uses the central facet's PSF for
         all facets.
         Populates the self.facetcache dict, unless facetcache is supplied
         """
         self.DicoMSMachine = {}
+        self._FacetCacheKey = {}
         valid = True
         if facetcache is not None:
             print>> log, "HMP basis functions pre-initialized"
@@ -256,18 +293,11 @@ class ClassImageDeconvMachine():
         centralFacet = self.PSFServer.DicoVariablePSF["CentralFacet"]
         if approx:
             print>>log, "HMP approximation mode: using PSF of central facet (%d)" % centralFacet
-            self.PSFServer.setFacet(centralFacet)
-            MSMachine = ClassMultiScaleMachine.ClassMultiScaleMachine(self.GD, self.facetcache.addSubdict(0),
-                                                                      self.GainMachine, NFreqBands=self.NFreqBands)
-            MSMachine.setModelMachine(self.ModelMachine)
-            MSMachine.setSideLobeLevel(self.SideLobeLevel, self.OffsetSideLobe)
-            MSMachine.SetFacet(centralFacet)
-            MSMachine.SetPSF(self.PSFServer)  # ThisPSF,ThisMeanPSF)
-            MSMachine.FindPSFExtent(verbose=True)
-            MSMachine.MakeMultiScaleCube(verbose=True)
-            MSMachine.MakeBasisMatrix()
+            MSMachine = self._giveMSMachine(self.facetcache.addSubdict(0), centralFacet,
+                                            self.SideLobeLevel, self.OffsetSideLobe, verbose=True)
             for iFacet in xrange(self.PSFServer.NFacets):
                 self.DicoMSMachine[iFacet] = MSMachine
+                self._FacetCacheKey[iFacet] = 0
         else:
             # if no facet cache, init in parallel
             if self.facetcache is None:
@@ -295,17 +325,11 @@ class ClassImageDeconvMachine():
                 self.facetcache.reload()
             #        t = ClassTimeIt.ClassTimeIt()
             for iFacet in xrange(self.PSFServer.NFacets):
-                self.PSFServer.setFacet(iFacet)
-                MSMachine = ClassMultiScaleMachine.ClassMultiScaleMachine(self.GD, self.facetcache[iFacet],
-                                                                          self.GainMachine, NFreqBands=self.NFreqBands)
-                MSMachine.setModelMachine(self.ModelMachine)
-                MSMachine.setSideLobeLevel(self.SideLobeLevel, self.OffsetSideLobe)
-                MSMachine.SetFacet(iFacet)
-                MSMachine.SetPSF(self.PSFServer)  # ThisPSF,ThisMeanPSF)
-                MSMachine.FindPSFExtent(verbose=(iFacet==centralFacet))  # only print to log for central facet
-                MSMachine.MakeMultiScaleCube(verbose=(iFacet==centralFacet))
-                MSMachine.MakeBasisMatrix()
-                self.DicoMSMachine[iFacet] = MSMachine
+                # only print to log for central facet
+                self.DicoMSMachine[iFacet] = self._giveMSMachine(self.facetcache[iFacet], iFacet,
+                                                                 self.SideLobeLevel, self.OffsetSideLobe,
+                                                                 verbose=(iFacet==centralFacet))
+                self._FacetCacheKey[iFacet] = iFacet
 
             # write cache to disk, unless in a mode where we explicitly don't want it
             if facetcache is None and not valid and cache and not approx:
@@ -330,6 +354,7 @@ class ClassImageDeconvMachine():
         #     self.PSF=PSF
 
         self.DicoDirty = DicoDirty
+        self._PeakIndex = None
         # self.DicoPSF=DicoPSF
         # self.DicoVariablePSF=DicoVariablePSF
 
@@ -553,6 +578,9 @@ class ClassImageDeconvMachine():
             a, b = self._MeanDirty[:, :, x0d:x1d, y0d:y1d], self._peakWeightImage[:, :, x0d:x1d, y0d:y1d]
             numexpr.evaluate("a*b", out=self._PeakSearchImage[:, :, x0d:x1d, y0d:y1d])
 
+        if self._PeakIndex is not None:
+            self._PeakIndex.update(x0d, x1d, y0d, y1d)
+
                 # pylab.subplot(1,3,3,sharex=ax,sharey=ax)
         # pylab.imshow(self._MeanDirty[0,0,x0d:x1d,y0d:y1d],interpolation="nearest",vmin=vmin,vmax=vmax)#,vmin=vmin,vmax=vmax)
         # pylab.colorbar()
@@ -590,6 +618,46 @@ class ClassImageDeconvMachine():
     def setMask(self,Mask):
         self.CurrentNegMask=Mask
 
+    def _fitLocalSMBatch(self, ListPeaks):
+        """
+        Fits components at a list of (x,y) peaks against the current residuals, and appends them to the model.
+        With more than one peak (and in parallel mode), the fits are run as APP jobs. Returns a list of the
+        convolved images of the components (LocalSM), in the same order as ListPeaks.
+        """
+        nch, npol, _, _ = self._CubeDirty.shape
+        ListFits = []
+        for iPeak, (x, y) in enumerate(ListPeaks):
+            Fpol = np.float32(self._CubeDirty[:, :, x, y].reshape((nch, npol, 1, 1)).copy())
+            self.PSFServer.setLocation(x, y)
+            iFacet = self.PSFServer.iFacet
+            ListFits.append((iPeak, self.DicoMSMachine[iFacet].iFacet, self._FacetCacheKey[iFacet], x, y, Fpol))
+
+        Parallel = self.ParallelMode and len(ListFits) > 1 and all(
+            [type(D) is shared_dict.SharedDict for D in (self.facetcache, self.DicoVariablePSF, self.DicoDirty)])
+        if not Parallel:
+            ListLocalSM = []
+            for iPeak, _, _, x, y, Fpol in ListFits:
+                self.PSFServer.setLocation(x, y)
+                ListLocalSM.append(self.DicoMSMachine[self.PSFServer.iFacet].GiveLocalSM((x, y), Fpol))
+            return ListLocalSM
+
+        outdict = shared_dict.create("HMPBatchFits")
+        NJobs = min(APP.ncpu, len(ListFits))
+        for iJob in xrange(NJobs):
+            APP.runJob("HMPFit:%d" % iJob, self._fitLocalSM_handler,
+                       args=(self.facetcache.readonly(), self.DicoVariablePSF.readonly(), self.DicoDirty.readonly(),
+                             outdict.writeonly(), ListFits[iJob::NJobs], self.SideLobeLevel, self.OffsetSideLobe))
+        APP.awaitJobResults("HMPFit:*")
+        outdict.reload()
+        ListLocalSM = []
+        for iPeak, _, _, x, y, _ in ListFits:
+            # copy out of the shared dict, since it is deleted below
+            LocalSM, Sol = outdict[iPeak]["LocalSM"].copy(), outdict[iPeak]["Sol"].copy()
+            self.ModelMachine.AppendComponentToDictStacked((x, y), 1., Sol)
+            ListLocalSM.append(LocalSM)
+        outdict.delete()
+        return ListLocalSM
+
     def Deconvolve(self, ch=0, UpdateRMS=True):
         """
         Runs minor cycle over image channel 'ch'.
@@ -604,9 +672,6 @@ class ClassImageDeconvMachine():
         if self._niter >= self.MaxMinorIter:
             return "MaxIter", False, False
 
-        _, npol, npix, _ = self._MeanDirty.shape
-        xc = (npix)/2
-
         # m0,m1=self._CubeDirty.min(),self._CubeDirty.max()
         # pylab.clf()
         # pylab.subplot(1,2,1)
@@ -640,7 +705,9 @@ class ClassImageDeconvMachine():
             print>>log,"  not using a mask"
             CurrentNegMask=None
         
-        x,y,MaxDirty = NpParallel.A_whereMax(self._PeakSearchImage,NCPU=self.NCPU,DoAbs=DoAbs,Mask=CurrentNegMask)
+        # index the peak search image by tile, so that each iteration only rescans the tiles touched by SubStep()
+        self._PeakIndex = NpParallel.WhereMaxIndex(self._PeakSearchImage,DoAbs=DoAbs,Mask=CurrentNegMask)
+        x,y,MaxDirty = self._PeakIndex.whereMax()
 
         # ThisFlux is evaluated against stopping criteria. In weighted mode, use the true flux. Else use sigma value.
         ThisFlux = self._MeanDirty[0,0,x,y] if self._peakMode is "weighted" else MaxDirty
@@ -757,13 +824,22 @@ class ClassImageDeconvMachine():
             fracDone = 1.-(ThisMaxFlux-StopFlux)/(MaxDirty-StopFlux)
             return max(int(round(100*fracDone)), 100)
 
+        BatchMode = self._BatchSize > 1 and self.GD["HMP"]["FractionRandomPeak"] is None
+        if BatchMode:
+            # components fitted in the same batch must not fall into each other's fitting windows
+            BatchSeparation = max([MSMachine.DicoBasisMatrix["CubePSF"].shape[-1]
+                                   for MSMachine in self.DicoMSMachine.itervalues()])
+            print>>log, "    fitting up to %d components per iteration, above %.2f of the peak and %d pixels apart" % (
+                self._BatchSize, self._BatchPeakFactor, BatchSeparation)
+
         try:
-            for i in xrange(self._niter+1, self.MaxMinorIter+1):
+            i = self._niter
+            while i < self.MaxMinorIter:
+                i += 1
                 self._niter = i
 
                 # x,y,ThisFlux=NpParallel.A_whereMax(self.Dirty,NCPU=self.NCPU,DoAbs=1)
-                x, y, peak = NpParallel.A_whereMax(
-                    self._PeakSearchImage, NCPU=self.NCPU, DoAbs=DoAbs, Mask=CurrentNegMask)
+                x, y, peak = self._PeakIndex.whereMax()
 
                 if self.GD["HMP"]["FractionRandomPeak"] is not None:
                     op=lambda x: x
@@ -847,25 +923,22 @@ class ClassImageDeconvMachine():
                     #         i, ThisFlux)
                     ClassMultiScaleMachine.CleanSolutionsDump.flush()
 
-                nch, npol, _, _ = self._CubeDirty.shape
-                Fpol = np.float32(
-                    (self._CubeDirty[
-                        :, :, x, y].reshape(
-                        (nch, npol, 1, 1))).copy())
-                # print "Fpol",Fpol
-                dx = x-xc
-                dy = y-xc
+                # in batch mode, also fit the other well-separated peaks above a fraction of this one. The fits
+                # all see the residuals as they are now, and the components are then subtracted together
+                ListPeaks = [(x, y)]
+                if BatchMode:
+                    ListCandidates = self._PeakIndex.wherePeaks(peak*self._BatchPeakFactor, BatchSeparation,
+                                                                min(self._BatchSize, self.MaxMinorIter-i+1))
+                    for xp, yp, PeakValue in ListCandidates[1:]:
+                        Flux = self._MeanDirty[0, 0, xp, yp] if self._peakMode is "weighted" else PeakValue
+                        if abs(Flux) > StopFlux:
+                            ListPeaks.append((xp, yp))
 
                 T.timeit("stuff")
 
                 # iScale=self.MSMachine.FindBestScale((x,y),Fpol)
 
-                self.PSFServer.setLocation(x, y)
-
-                PSF = self.PSFServer.GivePSF()
-                MSMachine = self.DicoMSMachine[self.PSFServer.iFacet]
-
-                LocalSM = MSMachine.GiveLocalSM((x, y), Fpol)
+                ListLocalSM = self._fitLocalSMBatch(ListPeaks)
 
                 T.timeit("FindScale")
                 # print iScale
@@ -890,9 +963,13 @@ class ClassImageDeconvMachine():
                 # CurrentGain=self.GainMachine.GiveGain()
                 CurrentGain=np.float32(self.GD["Deconv"]["Gain"])
 
-                numexpr.evaluate('LocalSM*CurrentGain', out=LocalSM)
-                self.SubStep((x,y),LocalSM)
+                for (xp, yp), LocalSM in zip(ListPeaks, ListLocalSM):
+                    numexpr.evaluate('LocalSM*CurrentGain', out=LocalSM)
+                    self.SubStep((xp, yp), LocalSM)
                 T.timeit("SubStep")
+                # divergence and stopping criteria are checked against the peak of the residuals left by the batch
+                i += len(ListPeaks)-1
+                self._niter = i
 
                 # pylab.subplot(1,2,2)
                 # pylab.imshow(self.Dirty[0][x0:x1,y0:y1],interpolation="nearest",vmin=mm0,vmax=mm1)#,vmin=m0,vmax=m1)
@@ -19,6 +19,7 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
 import itertools
+import collections
 
 import numpy as np
 from DDFacet.Other import MyLogger
@@ -34,15 +35,53 @@ from DDFacet.Other import MyPickle
 from DDFacet.Other import reformat
 from DDFacet.Imager import ClassFrequencyMachine
 from DDFacet.ToolsDir.GiveEdges import GiveEdges
-from DDFacet.ToolsDir.GiveEdges import GiveEdgesDissymetric
 from DDFacet.Imager import ClassModelMachine as ClassModelMachinebase
 from DDFacet.ToolsDir import ModFFTW
 import scipy.ndimage
+import scipy.signal
 from SkyModel.Sky import ModRegFile
 from pyrap.images import image
 from SkyModel.Sky import ClassSM
 import os
 
+# Gaussian components are added directly (one kernel row at a time) when the number of pixels to be touched,
+# ncomp*Sup**2, is below this many times the image size, and by FFT-convolving a map of their fluxes otherwise
+GAUSS_DIRECT_FACTOR = 20
+
+def _addGaussianComponents(ModelImage, x, y, Flux, Gauss):
+    """
+    Adds Gaussian components to model image.
+
+    Args:
+        ModelImage: image of shape (nchan,npol,nx,ny)
+        x, y: component positions, vectors of length ncomp
+        Flux: component fluxes, array of shape (nchan,npol,ncomp)
+        Gauss: square kernel of odd size, centred on the component. Truncated at the image edges.
+    """
+    nchan, npol, nx, ny = ModelImage.shape
+    Sup, _ = Gauss.shape
+    if x.size*Sup**2 < GAUSS_DIRECT_FACTOR*nx*ny:
+        dy = np.arange(Sup) - Sup/2
+        for ix in range(Sup):
+            xx = x + ix - Sup/2
+            yy = y[:, np.newaxis] + dy[np.newaxis, :]
+            valid = (xx >= 0)[:, np.newaxis] & (xx < nx)[:, np.newaxis] & (yy >= 0) & (yy < ny)
+            icomp, iy = np.where(valid)
+            if not icomp.size:
+                continue
+            # footprints of neighbouring components overlap, so these must be unbuffered adds
+            for ch in range(nchan):
+                for pol in range(npol):
+                    np.add.at(ModelImage[ch, pol], (xx[icomp], yy[icomp, iy]),
+                              Flux[ch, pol, icomp]*Gauss[ix, iy])
+    else:
+        # component positions are unique (they're dict keys), so a plain fancy-indexed assignment will do
+        DeltaMap = np.zeros((nx, ny), np.float32)
+        for ch in range(nchan):
+            for pol in range(npol):
+                DeltaMap[x, y] = Flux[ch, pol]
+                ModelImage[ch, pol] += scipy.signal.fftconvolve(DeltaMap, Gauss, mode="same")
+
 class ClassModelMachine(ClassModelMachinebase.ClassModelMachine):
     def __init__(self,*args,**kwargs):
         ClassModelMachinebase.ClassModelMachine.__init__(self, *args, **kwargs)
@@ -300,8 +339,6 @@ class ClassModelMachine(ClassModelMachinebase.ClassModelMachine):
         FreqIn=np.array([FreqIn.ravel()]).flatten()
 
         _,npol,nx,ny=self.ModelShape
-        N0x=nx
-        N0y=ny
 
         nchan=FreqIn.size
         if out is not None:
@@ -315,36 +352,39 @@ class ClassModelMachine(ClassModelMachinebase.ClassModelMachine):
             return ModelImage
 
         DicoComp=self.DicoSMStacked["Comp"]
+        if not DicoComp:
+            return ModelImage
 
-        DicoSM={}
-        for key in DicoComp.keys():
-            for pol in range(npol):
-                Sol=DicoComp[key]["SolsArray"][:,pol]#/self.DicoSMStacked[key]["SumWeights"]
-                x,y=key
-
-                #print>>log, "%s : %s"%(str(key),str(Sol))
-
-                for iFunc in range(Sol.size):
-                    ThisComp=self.ListScales[iFunc]
-                    ThisAlpha=ThisComp["Alpha"]
-                    for ch in range(nchan):
-                        Flux=Sol[iFunc]*(FreqIn[ch]/RefFreq)**(ThisAlpha)
-                        Flux=f_apply(Flux)
-                        if ThisComp["ModelType"]=="Delta":
-                            ModelImage[ch,pol,x,y]+=Flux
-
-                        elif ThisComp["ModelType"]=="Gaussian":
-                            Gauss=ThisComp["Model"]
-                            Sup,_=Gauss.shape
-                            x0,x1=x-Sup/2,x+Sup/2+1
-                            y0,y1=y-Sup/2,y+Sup/2+1
-
-
-                            Aedge,Bedge=GiveEdgesDissymetric((x,y),(N0x,N0y),(Sup/2,Sup/2),(Sup,Sup))
-                            x0d,x1d,y0d,y1d=Aedge
-                            x0p,x1p,y0p,y1p=Bedge
-
-                            ModelImage[ch,pol,x0d:x1d,y0d:y1d]+=Gauss[x0p:x1p,y0p:y1p]*Flux
+        # components are rendered one basis function group at a time (functions sharing a scale share a
+        # Gaussian, but differ in spectral index), for all components, polarizations and channels at once
+        keys = DicoComp.keys()
+        x = np.array([key[0] for key in keys])
+        y = np.array([key[1] for key in keys])
+        # Sols is nfunc,npol,ncomp
+        Sols = np.array([DicoComp[key]["SolsArray"][:, :npol] for key in keys]).transpose((1, 2, 0))
+        nfunc = Sols.shape[0]
+
+        FuncGroups = collections.OrderedDict()
+        for iFunc in range(nfunc):
+            ThisComp = self.ListScales[iFunc]
+            if ThisComp["ModelType"] == "Delta":
+                FuncGroups.setdefault(None, []).append(iFunc)
+            elif ThisComp["ModelType"] == "Gaussian":
+                FuncGroups.setdefault(id(ThisComp["Model"]), []).append(iFunc)
+
+        for group, ListFunc in FuncGroups.iteritems():
+            # Flux is nchan,npol,ncomp
+            Flux = np.zeros((nchan, npol, x.size), np.float32)
+            for iFunc in ListFunc:
+                Sol = Sols[iFunc]
+                if not Sol.any():
+                    continue
+                SpectralFactor = (FreqIn/RefFreq)**self.ListScales[iFunc]["Alpha"]
+                Flux += f_apply(SpectralFactor[:, np.newaxis, np.newaxis]*Sol[np.newaxis, :, :])
+            if group is None:
+                ModelImage[:, :, x, y] += Flux
+            else:
+                _addGaussianComponents(ModelImage, x, y, Flux, self.ListScales[ListFunc[0]]["Model"])
 
         # vmin,vmax=np.min(self._MeanDirtyOrig[0,0]),np.max(self._MeanDirtyOrig[0,0])
         # vmin,vmax=-1,1
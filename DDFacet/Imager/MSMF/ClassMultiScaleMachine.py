@@ -796,8 +796,17 @@ class ClassMultiScaleMachine():
             y.append(b)
         return np.array(y)
 
-    #@profile
     def GiveLocalSM(self,(x,y),Fpol):
+        """Fits the component at x,y (see fitLocalSM()), appends it to the model, and returns its convolved image"""
+        LocalSM,Sol=self.fitLocalSM((x,y),Fpol)
+        self.ModelMachine.AppendComponentToDictStacked((x,y),1.,Sol)
+        return LocalSM
+
+    #@profile
+    def fitLocalSM(self,(x,y),Fpol):
+        """Fits the basis functions to the dirty image around x,y. Returns the convolved image of the fitted
+        component and the solution vector, but does not touch the model: that is up to the caller, so that
+        fits can be run in worker processes"""
         T= ClassTimeIt.ClassTimeIt("   GiveLocalSM")
         T.disable()
 
@@ -1331,9 +1340,6 @@ class ClassMultiScaleMachine():
         # print self.AlphaVec,Sol
         # print "alpha",np.sum(self.AlphaVec.ravel()*Sol.ravel())/np.sum(Sol)
 
-        FpolMean=1.
-
-        self.ModelMachine.AppendComponentToDictStacked((xc,yc),FpolMean,Sol)
 
         BM=DicoBasisMatrix["BM"]
         #print "MaxSM=",np.max(LocalSM)
@@ -1431,7 +1437,7 @@ class ClassMultiScaleMachine():
 
 #             # stop
 
-        return LocalSM
+        return LocalSM,Sol
 
             
 
@@ -1,4 +1,5 @@
 import collections
+import itertools
 import random
 
 import numpy as np
@@ -6,10 +7,8 @@ from DDFacet.Other import ClassTimeIt
 from DDFacet.Other import MyLogger
 
 log=MyLogger.getLogger("ClassArrayMethodSSD")
-import multiprocessing
 
 import ClassConvMachine
-import time
 from scipy.stats import chi2
 
 from deap import tools
@@ -19,8 +18,12 @@ log= MyLogger.getLogger("ClassArrayMethodSSD")
 
 from ClassParamMachine import ClassParamMachine
 from DDFacet.ToolsDir.GeneDist import ClassDistMachine
+from DDFacet.Other.AsyncProcessPool import APP
 import ClassMutate
 
+# tags the fitness state published for each parallel island, so that workers know when their cached copy is stale
+_fitness_state_tokens = itertools.count()
+
 class ClassArrayMethodSSD():
     def __init__(self,Dirty,PSF,ListPixParms,ListPixData,FreqsInfo,GD=None,
                  PixVariance=1.e-2,IslandBestIndiv=None,WeightFreqBands=None,iFacet=0,
@@ -110,6 +113,7 @@ class ClassArrayMethodSSD():
         self._chain_dict.delete()
         if "Population" in self._island_dict:
             self._island_dict.delete_item("Population")
+        self.KillWorkers()
 
     def SetDirtyArrays(self,Dirty):
         print>>log,"SetConvMatrix"
@@ -317,57 +321,45 @@ class ClassArrayMethodSSD():
 
 
     def InitWorkers(self):
-        Parallel=self.ParallelFitness
-        if not(Parallel):
-            NCPU=1
-        else:
-            NCPU=self.NCPU
-        self.NCPU=NCPU
-
-        work_queue = multiprocessing.Queue()
-        result_queue = multiprocessing.Queue()
-        workerlist=[]
-        #print "start"
-        for ii in range(NCPU):
-            W=WorkerFitness(work_queue,
-                            result_queue,
-                            island_dict=self._island_dict,
-                            iIsland=self.iIsland,
-                            ListPixParms=self.ListPixParms,
-                            ListPixData=self.ListPixData,
-                            PSF=self.PSF,
-                            GD=self.GD,
-                            PauseOnStart=False,
-                            PM=self.PM,
-                            PixVariance=self.PixVariance,
-                            EstimatedStdFromResid=self.EstimatedStdFromResid,
-                            MaxFunc=self.MaxFunc,
-                            WeightMaxFunc=self.WeightMaxFunc,
-                            DirtyArray=self.DirtyArray,
-                            ConvMode=self.ConvMode,
-                            StopWhenQueueEmpty=not(Parallel),
-                            BestChi2=self.BestChi2,
-                            DicoData=self.DicoData)
-
-            workerlist.append(W)
-
-        self.work_queue=work_queue
-        self.result_queue=result_queue
-        self.workerlist=workerlist
+        # fitness machine of this process, used directly when fitnesses are not computed in parallel
+        self.FitnessMachine=WorkerFitness(ListPixParms=self.ListPixParms,
+                                          ListPixData=self.ListPixData,
+                                          PSF=self.PSF,
+                                          GD=self.GD,
+                                          PM=self.PM,
+                                          PixVariance=self.PixVariance,
+                                          EstimatedStdFromResid=self.EstimatedStdFromResid,
+                                          MaxFunc=self.MaxFunc,
+                                          WeightMaxFunc=self.WeightMaxFunc,
+                                          DirtyArray=self.DirtyArray,
+                                          ConvMode=self.ConvMode,
+                                          BestChi2=self.BestChi2,
+                                          DicoData=self.DicoData)
         if self.ParallelFitness:
-            for ii in range(NCPU):
-                #print "launch parallel", ii
-                workerlist[ii].start()
-
+            # the APP workers build their own fitness machine from the state published here
+            self._fitness_token=_fitness_state_tokens.next()
+            self._island_dict["FitnessArgs"]=dict(ListPixParms=np.array(self.ListPixParms),
+                                                  ListPixData=np.array(self.ListPixData),
+                                                  PSF=self.PSF,
+                                                  GD=self.GD,
+                                                  PM=self.PM,
+                                                  PixVariance=self.PixVariance,
+                                                  EstimatedStdFromResid=self.EstimatedStdFromResid,
+                                                  MaxFunc=self.MaxFunc,
+                                                  WeightMaxFunc=self.WeightMaxFunc,
+                                                  DirtyArray=self.DirtyArray,
+                                                  ConvMode=self.ConvMode,
+                                                  DicoData=self.DicoData)
 
     def KillWorkers(self):
-        workerlist=self.workerlist
-        if self.ParallelFitness:
-            #print "turn off"
-            for ii in range(self.NCPU):
-                workerlist[ii].shutdown()
-                workerlist[ii].terminate()
-                workerlist[ii].join()
+        # the workers belong to APP: only drop the state we published for them
+        if self.ParallelFitness and "FitnessArgs" in self._island_dict:
+            self._island_dict.delete_item("FitnessArgs")
+
+    def _giveJobChunks(self,ListIndividuals):
+        """Splits a list of individuals over (at most) one job per APP worker"""
+        NJobs=max(min(APP.ncpu or 1,len(ListIndividuals)),1)
+        return [ListIndividuals[iJob::NJobs] for iJob in range(NJobs)]
 
     def giveDistanceIndiv(self,pop):
         N=len(pop)
@@ -399,67 +391,25 @@ class ClassArrayMethodSSD():
 
     def GiveFitnessPop(self,pop):
 
-        work_queue=self.work_queue
-        result_queue=self.result_queue
-        workerlist=self.workerlist
-        Parallel=self.ParallelFitness
         DicoFitnesses={}
         DicoChi2={}
-        NJobs = len(pop)
-        NCPU=self.NCPU
         #self.giveDistanceIndiv(pop)
         #print "OK"
-        self._fill_pop_array(pop)
-        for iIndividual,individual in enumerate(pop):
-            work_queue.put({"iIndividual":iIndividual,
-                            "BestChi2":self.BestChi2,
-                            "EntropyMinMax":self.EntropyMinMax,
-                            "OperationType":"Fitness"})
-
-        
-        if not Parallel:
-            for ii in range(NCPU):
-                workerlist[ii].run()  # just run until all work is completed
-
-        # for ii in range(NCPU):
-        #     print "launch parallel", ii
-        #     workerlist[ii].start()
-
-
-        iResult=0
-
-        while iResult < NJobs:
-            DicoResult=None
-            #print work_queue.qsize(),result_queue.qsize()
-            if result_queue.qsize()!=0:
-                try:
-                    DicoResult=result_queue.get_nowait()
-                except Exception,e:
-                    #print "Exception: %s"%(str(e))
-                    pass
-                
-
-            if DicoResult==None:
-                time.sleep(.1)
-                continue            
-
-            # try:
-            #     DicoResult = result_queue.get(True, 5)
-            # except:
-            #     time.sleep(0.1)
-            #     continue
-
-            if DicoResult["Success"]:
-                iIndividual=DicoResult["iIndividual"]
-                iResult += 1
-                DicoFitnesses[iIndividual]=DicoResult["fitness"]
-                DicoChi2[iIndividual]=DicoResult["Chi2"]
-            NDone = iResult
-
-        # for ii in range(NCPU):
-        #     workerlist[ii].shutdown()
-        #     workerlist[ii].terminate()
-        #     workerlist[ii].join()
+        if self.ParallelFitness:
+            self._fill_pop_array(pop)
+            for iJob,ListIndividuals in enumerate(self._giveJobChunks(range(len(pop)))):
+                APP.runJob("SSDFitness:%d"%iJob, _giveFitness_worker,
+                           args=(self._island_dict.readonly(), self._fitness_token, ListIndividuals,
+                                 self.BestChi2, self.EntropyMinMax))
+            for ListResults in APP.awaitJobResults("SSDFitness:*"):
+                for iIndividual,fitness,Chi2 in ListResults:
+                    DicoFitnesses[iIndividual]=fitness
+                    DicoChi2[iIndividual]=Chi2
+        else:
+            self.FitnessMachine.setFitnessParms(self.BestChi2,self.EntropyMinMax)
+            for iIndividual,(fitness,Chi2) in enumerate(self.FitnessMachine.GiveFitnessPop(pop)):
+                DicoFitnesses[iIndividual]=fitness
+                DicoChi2[iIndividual]=Chi2
 
         fitnesses=[]
         Chi2=[]
@@ -490,125 +440,44 @@ class ClassArrayMethodSSD():
 
     def mutatePop(self,pop,mutpb,MutConfig):
 
-        work_queue=self.work_queue
-        result_queue=self.result_queue
-        workerlist=self.workerlist
-        Parallel=self.ParallelFitness
-        DicoFitnesses={}
-        DicoChi2={}
-        NCPU=self.NCPU
-        NJobs = 0
-        pop_array = self._island_dict["Population"]
-        for iIndividual,individual in enumerate(pop):
-            if random.random() < mutpb:
-                NJobs+=1
-                pop_array[iIndividual,...] = individual
-                work_queue.put({"iIndividual":iIndividual,
-                                "mutConfig":MutConfig,
-                                "OperationType":"Mutate"})
-
-
-        
-        if not Parallel:
-            for ii in range(NCPU):
-                workerlist[ii].run()  # just run until all work is completed
-
-        # for ii in range(NCPU):
-        #     print "launch parallel", ii
-        #     workerlist[ii].start()
-
-
-        iResult=0
-
-        while iResult < NJobs:
-            DicoResult=None
-            #print work_queue.qsize(),result_queue.qsize()
-            if result_queue.qsize()!=0:
-                try:
-                    DicoResult=result_queue.get_nowait()
-                except Exception,e:
-                    #print "Exception: %s"%(str(e))
-                    pass
-                
+        ListMutants=[iIndividual for iIndividual in range(len(pop)) if random.random() < mutpb]
+        if not ListMutants:
+            return pop
 
-            if DicoResult==None:
-                time.sleep(.1)
-                continue            
-
-            # try:
-            #     DicoResult = result_queue.get(True, 5)
-            # except:
-            #     time.sleep(0.1)
-            #     continue
-
-            if DicoResult["Success"]:
-                iIndividual=DicoResult["iIndividual"]
-                iResult += 1
-                mutant = pop_array[iIndividual]
-                pop[iIndividual][:] = mutant[:]
-            NDone = iResult
+        if self.ParallelFitness:
+            pop_array = self._fill_pop_array(pop)
+            for iJob,ListIndividuals in enumerate(self._giveJobChunks(ListMutants)):
+                APP.runJob("SSDMutate:%d"%iJob, _mutate_worker,
+                           args=(self._island_dict.readwrite(), self._fitness_token, ListIndividuals, MutConfig))
+            APP.awaitJobResults("SSDMutate:*")
+            # mutation is done in-place in the population cube
+            for iIndividual in ListMutants:
+                pop[iIndividual][:] = pop_array[iIndividual][:]
+        else:
+            for iIndividual in ListMutants:
+                self.FitnessMachine.mutate(pop[iIndividual],MutConfig)
 
         return pop
 
 
     def GiveMetroChains(self,pop,NSteps=1000):
 
-        work_queue=self.work_queue
-        result_queue=self.result_queue
-        workerlist=self.workerlist
-        Parallel=self.ParallelFitness
-        DicoFitnesses={}
-        DicoChi2={}
-        NJobs = len(pop)
-        NCPU=self.NCPU
-
         self._chain_dict.delete()
 
-        self._fill_pop_array(pop)
-        for iIndividual,individual in enumerate(pop):
-            work_queue.put({"iIndividual":iIndividual,
-                            "BestChi2":self.BestChi2,
-                            "OperationType":"Metropolis",
-                            "NSteps":NSteps})
-
-        
-        if not Parallel:
-            for ii in range(NCPU):
-                workerlist[ii].run()  # just run until all work is completed
-
-        # for ii in range(NCPU):
-        #     print "launch parallel", ii
-        #     workerlist[ii].start()
-
-
-        iResult=0
-        DicoChains = {}
-        while iResult < NJobs:
-            DicoResult=None
-            #print work_queue.qsize(),result_queue.qsize()
-            if result_queue.qsize()!=0:
-                try:
-                    DicoResult=result_queue.get_nowait()
-                except Exception,e:
-                    #print "Exception: %s"%(str(e))
-                    pass
-                
-
-            if DicoResult==None:
-                time.sleep(.1)
-                continue            
-
-            # try:
-            #     DicoResult = result_queue.get(True, 5)
-            # except:
-            #     time.sleep(0.1)
-            #     continue
-
-            if DicoResult["Success"]:
-                iIndividual=DicoResult["iIndividual"]
-                iResult += 1
-                # result already in _chain_dict
-        self._chain_dict.reload()
+        if self.ParallelFitness:
+            self._fill_pop_array(pop)
+            for iIndividual in range(len(pop)):
+                APP.runJob("SSDMetroChain:%d"%iIndividual, _runMetroChain_worker,
+                           args=(self._island_dict.readwrite(), self._fitness_token, iIndividual,
+                                 self.BestChi2, NSteps))
+            APP.awaitJobResults("SSDMetroChain:*")
+            # result already in _chain_dict
+            self._chain_dict.reload()
+        else:
+            self.FitnessMachine.setFitnessParms(self.BestChi2)
+            for iIndividual,individual in enumerate(pop):
+                chain_dict = self._chain_dict.addSubdict(iIndividual)
+                self.FitnessMachine.runMetroSingleChain(individual,NSteps=NSteps,chain_dict=chain_dict)
 
         return self._chain_dict
 
@@ -770,17 +639,12 @@ class ClassArrayMethodSSD():
 # #################################################################"    
 
 
-class WorkerFitness(multiprocessing.Process):
+class WorkerFitness():
     def __init__(self,
-                 work_queue,
-                 result_queue,
-                 island_dict=None,
-                 iIsland=None,
                  ListPixParms=None,
                  ListPixData=None,
                  GD=None,
                  PSF=None,
-                 PauseOnStart=False,
                  PM=None,
                  PixVariance=1e-2,
                  EstimatedStdFromResid=0,
@@ -788,25 +652,15 @@ class WorkerFitness(multiprocessing.Process):
                  WeightMaxFunc=None,
                  DirtyArray=None,
                  ConvMode=None,
-                 StopWhenQueueEmpty=False,
                  BestChi2=1.,
                  DicoData=None):
         self.T=ClassTimeIt.ClassTimeIt("WorkerFitness")
         self.T.disable()
-        multiprocessing.Process.__init__(self)
-        self.work_queue = work_queue
-        self.result_queue = result_queue
-        self.kill_received = False
-        self.exit = multiprocessing.Event()
-        self._pause_on_start = PauseOnStart
-        self._island_dict = island_dict
-        self._chain_dict = island_dict["Chains"]
         self.GD=GD
         self.PM=PM
         self.EstimatedStdFromResid=EstimatedStdFromResid
         self.ListPixParms=ListPixParms
         self.ListPixData=ListPixData
-        self.iIsland=iIsland
         self.PSF = PSF
         self.PixVariance=PixVariance
         self.ConvMachine=ClassConvMachine.ClassConvMachine(self.PSF,self.ListPixParms,self.ListPixData,ConvMode)
@@ -818,110 +672,38 @@ class WorkerFitness(multiprocessing.Process):
         self.WeightMaxFunc=WeightMaxFunc
         self.DirtyArray=DirtyArray
         self.T.timeit("init")
-        self.StopWhenQueueEmpty=StopWhenQueueEmpty
         self.BestChi2=BestChi2
+        self.EntropyMinMax=None
 
-
-
-    def shutdown(self):
-        self.exit.set()
-
-    def CondContinue(self):
-        if self.StopWhenQueueEmpty:
-            return not(self.work_queue.qsize()==0)
-        else:
-            return True
+    def setFitnessParms(self,BestChi2,EntropyMinMax=None):
+        self.BestChi2=BestChi2
+        self.EntropyMinMax=EntropyMinMax
 
     def ToConvArray(self,V,OutMode="Data"):
         self.ModelA=self.PM.GiveModelArray(V)
         A=self.ConvMachine.Convolve(self.ModelA,OutMode=OutMode)
         return A
 
-    def run(self):
-        # # pause self in debugging mode
-        # #if self._pause_on_start:
-        # #    os.kill(os.getpid(),signal.SIGSTOP)
-        # while not self.kill_received and not self.work_queue.empty():
-        #     DicoJob = self.work_queue.get()
-        #     individual=DicoJob["individual"]
-        #     iIndividual=DicoJob["iIndividual"]
-        #     fitness=self.GiveFitness(individual)
-        #     #print iIndividual
-        #     self.result_queue.put({"Success": True, 
-        #                            "iIndividual": iIndividual,
-        #                            "fitness":fitness})
-         
-        while not self.kill_received and self.CondContinue():
-            #gc.enable()
-            try:
-                DicoJob = self.work_queue.get()
-            except:
-                break
-            
-
-            if DicoJob["OperationType"]=="Fitness":
-                #print "FitNess"
-                self.GiveFitnessWorker(DicoJob)
-            elif DicoJob["OperationType"]=="Metropolis":
-                self.runMetroSingleChainWorker(DicoJob)
-            elif DicoJob["OperationType"]=="Mutate":
-                #print "Mutate"
-                self.runSingleMutation(DicoJob)
-
-    def runSingleMutation(self,DicoJob):
-        pid=str(multiprocessing.current_process())
-        self.T.reinit()
-        iIndividual=DicoJob["iIndividual"]
-
-        self._island_dict.reload()
-        individual = self._island_dict["Population"][iIndividual]
-
-        Mut_pFlux, Mut_p0, Mut_pMove, Mut_pScale, Mut_pOffset=DicoJob["mutConfig"]
-
-
+    def mutate(self,individual,MutConfig):
+        Mut_pFlux, Mut_p0, Mut_pMove, Mut_pScale, Mut_pOffset=MutConfig
+        # mutation is in-place, so no need to copy
         self.MutMachine.mutGaussian(individual,
-                                                   Mut_pFlux, Mut_p0, Mut_pMove, Mut_pScale, Mut_pOffset)
-        ## mutation above is in-place, so no need to copy
-        #individual[:]=individualOut[:]
-
-        self.result_queue.put({"Success": True, 
-                               "iIndividual": iIndividual})
-        self.T.timeit("done job: %s"%pid)
-
-
-
-
-
-
-
-
-    def GiveFitnessWorker(self,DicoJob):
-        pid=str(multiprocessing.current_process())
-        self.T.reinit()
-        iIndividual=DicoJob["iIndividual"]
-        #print "Worker %s processing indiv %i"%(pid,iIndividual)
-        self.BestChi2=DicoJob["BestChi2"]
-        if "EntropyMinMax" in DicoJob.keys():
-            self.EntropyMinMax=DicoJob["EntropyMinMax"]
-
-        #individual=DicoJob["individual"]
-        self._island_dict.reload()
-        individual = self._island_dict["Population"][iIndividual]
-
-        fitness,Chi2=self.GiveFitness(individual)
-        #print iIndividual
-        self.result_queue.put({"Success": True, 
-                               "iIndividual": iIndividual,
-                               "fitness":fitness,
-                               "Chi2":Chi2})
-        self.T.timeit("done job: %s"%pid)
-
-
+                                    Mut_pFlux, Mut_p0, Mut_pMove, Mut_pScale, Mut_pOffset)
 
+    def GiveFitnessPop(self,pop):
+        """Returns the (fitness,chi2) of a list of individuals, convolving all their models in one go"""
+        ListModelA=[self.PM.GiveModelArray(individual) for individual in pop]
+        ConvPop=self.ConvMachine.ConvolvePop(np.array(ListModelA),OutMode="Data")
+        ListResults=[]
+        for iIndividual,individual in enumerate(pop):
+            self.ModelA=ListModelA[iIndividual]
+            ListResults.append(self.GiveFitness(individual,A=ConvPop[iIndividual]))
+        return ListResults
 
-    def GiveFitness(self,individual,DoPlot=False):
+    def GiveFitness(self,individual,DoPlot=False,A=None):
         
-        A=self.ToConvArray(individual)
+        if A is None:
+            A=self.ToConvArray(individual)
         fitness=0.
         Resid=self.DirtyArray-A
         
@@ -1032,21 +814,6 @@ class WorkerFitness(multiprocessing.Process):
         #return (ContinuousFitNess,),chi2
 
 
-    def runMetroSingleChainWorker(self,DicoJob):
-        pid=str(multiprocessing.current_process())
-        self.T.reinit()
-        iIndividual=DicoJob["iIndividual"]
-        #print "Worker %s processing indiv %i"%(pid,iIndividual)
-        self.BestChi2=DicoJob["BestChi2"]
-        self._island_dict.reload()
-        individual = self._island_dict["Population"][iIndividual]
-        self._chain_dict.reload()
-        chain_dict = self._chain_dict.addSubdict(iIndividual)
-        self.runMetroSingleChain(individual,NSteps=DicoJob["NSteps"],chain_dict=chain_dict)
-        self.result_queue.put({"Success": True,
-                               "iIndividual": iIndividual})
-        self.T.timeit("done job: %s"%pid)
-
     def runMetroSingleChain(self,individual0,NSteps=1000,chain_dict={}):
 
         df=self.PM.NPixListData
@@ -1337,3 +1104,49 @@ class WorkerFitness(multiprocessing.Process):
 
         #fig.savefig("png/fig%2.2i_%4.4i.png"%(iChannel,iGen))
         
+
+
+# #################################################################
+# APP job handlers for ClassArrayMethodSSD(ParallelFitness=True)
+
+# fitness machine of the island currently evolved in parallel, as built by this worker
+_FitnessMachineCache = {}
+
+def _giveFitnessMachine(island_dict, Token):
+    if Token not in _FitnessMachineCache:
+        _FitnessMachineCache.clear()
+        Args = island_dict["FitnessArgs"]
+        _FitnessMachineCache[Token] = WorkerFitness(ListPixParms=Args["ListPixParms"].tolist(),
+                                                    ListPixData=Args["ListPixData"].tolist(),
+                                                    PSF=Args["PSF"],
+                                                    GD=Args["GD"],
+                                                    PM=Args["PM"],
+                                                    PixVariance=Args["PixVariance"],
+                                                    EstimatedStdFromResid=Args["EstimatedStdFromResid"],
+                                                    MaxFunc=Args["MaxFunc"],
+                                                    WeightMaxFunc=Args["WeightMaxFunc"],
+                                                    DirtyArray=Args["DirtyArray"],
+                                                    ConvMode=Args["ConvMode"],
+                                                    DicoData=Args["DicoData"])
+    return _FitnessMachineCache[Token]
+
+def _giveFitness_worker(island_dict, Token, ListIndividuals, BestChi2, EntropyMinMax):
+    FitnessMachine = _giveFitnessMachine(island_dict, Token)
+    FitnessMachine.setFitnessParms(BestChi2, EntropyMinMax)
+    pop_array = island_dict["Population"]
+    ListFitness = FitnessMachine.GiveFitnessPop([pop_array[iIndividual] for iIndividual in ListIndividuals])
+    return [(iIndividual, fitness, Chi2) for iIndividual, (fitness, Chi2) in zip(ListIndividuals, ListFitness)]
+
+def _mutate_worker(island_dict, Token, ListIndividuals, MutConfig):
+    FitnessMachine = _giveFitnessMachine(island_dict, Token)
+    pop_array = island_dict["Population"]
+    for iIndividual in ListIndividuals:
+        FitnessMachine.mutate(pop_array[iIndividual], MutConfig)
+
+def _runMetroChain_worker(island_dict, Token, iIndividual, BestChi2, NSteps):
+    FitnessMachine = _giveFitnessMachine(island_dict, Token)
+    FitnessMachine.setFitnessParms(BestChi2)
+    chain_dict = island_dict["Chains"].addSubdict(iIndividual)
+    FitnessMachine.runMetroSingleChain(island_dict["Population"][iIndividual], NSteps=NSteps, chain_dict=chain_dict)
+
+APP.registerJobHandlers(_giveFitness_worker, _mutate_worker, _runMetroChain_worker)
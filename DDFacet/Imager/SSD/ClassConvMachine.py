@@ -6,7 +6,7 @@ import scipy.signal
 from DDFacet.Array import ModLinAlg
 from DDFacet.ToolsDir.GiveEdges import GiveEdgesDissymetric
 from DDFacet.ToolsDir import ModFFTW
-from DDFacet.ToolsDir.ModToolBox import EstimateNpix
+from DDFacet.ToolsDir.ModToolBox import FFTOddSizes
 
 def test():
     import DDFacet.ToolsDir.Gaussian
@@ -239,6 +239,9 @@ class ClassConvMachine():
         self.NFreqBands,self.npol,self.NPixPSF,_=PSF.shape
         self.invCM=None
         self.ConvMode=ConvMode
+        # batched FFT convolutions (see ConvolveFFTPop())
+        self.DicoFFTConvState={}
+        self.FFTConvBatchBytes=2**27
         # if ConvMode==None:
         #     if self.NPixListParms<3000:
         #         self.ConvMode="Matrix"
@@ -284,8 +287,9 @@ class ClassConvMachine():
         Asq=self.PM.ModelToSquareArray(A,TypeInOut=("Parms",OutMode))
         T.timeit("0")
         NFreqBand,npol,N,_=Asq.shape
-        zN=2*N+1
-        zN,_=EstimateNpix(float(zN))
+        # smallest fast size holding the PSF out to the largest offset between two pixels of the square (the
+        # closest fast size, as given by EstimateNpix(), can be too small)
+        zN=int(FFTOddSizes[FFTOddSizes>=2*N+1][0])
         zAsq=np.zeros((NFreqBand,npol,zN,zN),dtype=Asq.dtype)
         zAsq[:,:,zN/2-N/2:zN/2+N/2+1,zN/2-N/2:zN/2+N/2+1]=Asq[:,:,:,:]
         T.timeit("1")
@@ -352,6 +356,92 @@ class ClassConvMachine():
         return A.reshape((NFreqBand,npol,NPixOut))
 
 
+    def ConvolvePop(self,ArrayModelPop,OutMode="Data"):
+        """Convolves a population of model arrays [NPop,NFreqBands,NPixListParms] at once,
+        returning [NPop,NFreqBands,1,NPixOut]"""
+        if self.ConvMode=="Matrix":
+            return self.ConvolveMatrixPop(ArrayModelPop,OutMode=OutMode)
+        elif self.ConvMode=="FFT":
+            return self.ConvolveFFTPop(ArrayModelPop,OutMode=OutMode)
+        return np.array([self.Convolve(A,OutMode=OutMode) for A in ArrayModelPop])
+
+    def ConvolveMatrixPop(self,ArrayModelPop,OutMode="Data"):
+        if OutMode=="Data":
+            CM=self.CM
+            OutSize=self.NPixListData
+        elif OutMode=="Parms":
+            CM=self.CMParms
+            OutSize=self.NPixListParms
+        NPop=ArrayModelPop.shape[0]
+        ArrayModelPop=ArrayModelPop.reshape((NPop,self.NFreqBands,self.NPixListParms))
+        ConvA=np.zeros((NPop,self.NFreqBands,1,OutSize),np.float32)
+        for iBand in range(self.NFreqBands):
+            ConvA[:,iBand,0]=np.dot(ArrayModelPop[:,iBand],CM[iBand,0].T)
+        return ConvA
+
+    def giveFFTConvState(self,OutMode):
+        """Sets up (once per OutMode) the batched FFT convolution: the zero-padded grid size, the positions of the
+        model and output pixels in that grid, and the transform of the PSF, normalised for the inverse FFT"""
+        if OutMode in self.DicoFFTConvState:
+            return self.DicoFFTConvState[OutMode]
+        N=self.PM.SquareGrids[OutMode]["NPixSquare"]
+        # the convolution is circular over the padded grid: a size of at least 2N-1 is enough for the products
+        # of the N x N square of pixels with the PSF not to wrap around into that square. Take the smallest
+        # such fast size (GiveClosestFastSize() may round down)
+        zN=int(FFTOddSizes[FFTOddSizes>=2*N-1][0])
+        x0=zN/2-N/2
+
+        # model pixels, as placed by PM.ModelToSquareArray(TypeInOut=("Parms",OutMode))
+        x0y0_in=self.PM.SquareGrids["Parms"]["x0y0"]
+        x0y0_out=self.PM.SquareGrids[OutMode]["x0y0"]
+        x,y=self.PM.SquareGrids["Parms"]["ArrayPix"].T
+        xpos=x-x.min()+x0y0_in[0]-x0y0_out[0]+x0
+        ypos=y-y.min()+x0y0_in[1]-x0y0_out[1]+x0
+        IndIn=xpos*zN+ypos
+        # output pixels, as read by PM.SquareArrayToModel(TypeInOut=(OutMode,OutMode))
+        x,y=self.PM.SquareGrids[OutMode]["ArrayPix"].T
+        IndOut=(x-x.min()+x0)*zN+(y-y.min()+x0)
+
+        # PSF up to the largest offset between two pixels of the square, centred on pixel (0,0) of the grid
+        N1=self.PSF.shape[-1]
+        xc1=N1/2
+        h=min(N-1,xc1,N1-1-xc1)
+        assert zN>=2*h+1
+        zPSF=np.zeros((self.NFreqBands,1,zN,zN),np.float32)
+        zPSF[:,:,zN/2-h:zN/2+h+1,zN/2-h:zN/2+h+1]=self.PSF[:,0:1,xc1-h:xc1+h+1,xc1-h:xc1+h+1]
+        zPSF=np.fft.ifftshift(zPSF,axes=(-2,-1))
+        PSF_FT=np.fft.rfft2(zPSF).astype(np.complex64)/(zN*zN)
+
+        State=self.DicoFFTConvState[OutMode]={"zN":zN,"IndIn":IndIn,"IndOut":IndOut,"PSF_FT":PSF_FT}
+        return State
+
+    def ConvolveFFTPop(self,ArrayModelPop,OutMode="Data"):
+        """Like ConvolveFFT() for a population of model arrays: the models are convolved in batches as one real FFT,
+        through a cached FFTW plan whose work arrays are reused from call to call"""
+        State=self.giveFFTConvState(OutMode)
+        zN,IndIn,IndOut,PSF_FT=State["zN"],State["IndIn"],State["IndOut"],State["PSF_FT"]
+        NPop=ArrayModelPop.shape[0]
+        NBatch=int(max(1,min(NPop,self.FFTConvBatchBytes/(self.NFreqBands*zN*zN*4))))
+        ArrayModelPop=ArrayModelPop.reshape((NPop,self.NFreqBands,self.NPixListParms))
+        NPixOut=IndOut.size
+        ConvA=np.zeros((NPop,self.NFreqBands,1,NPixOut),np.float32)
+
+        # both plans must exist before the work arrays are filled in, since planning overwrites them
+        shape=(NBatch,self.NFreqBands,1,zN,zN)
+        rfft,irfft=ModFFTW._giveFFTWPlans(shape,np.complex64,("rfft","irfft"))
+        zA=rfft.input_array.reshape((NBatch,self.NFreqBands,zN*zN))
+        for iPop0 in range(0,NPop,NBatch):
+            iPop1=min(iPop0+NBatch,NPop)
+            # the transforms destroy their input, so the padded grids are zeroed every time
+            zA.fill(0)
+            zA[0:iPop1-iPop0,:,IndIn]=ArrayModelPop[iPop0:iPop1]
+            rfft.execute()
+            # the two plans share their work arrays, so this is the input of the inverse transform
+            np.multiply(rfft.output_array,PSF_FT,out=rfft.output_array)
+            irfft.execute()
+            ConvA[iPop0:iPop1,:,0,:]=zA[0:iPop1-iPop0,:,IndOut]
+        return ConvA
+
     def ConvolveVector(self,A,Norm=True,OutMode="Data"):
         sh=A.shape
         if OutMode=="Data":
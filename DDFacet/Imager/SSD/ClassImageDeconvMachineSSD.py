@@ -19,8 +19,6 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 import os
 import numpy as np
-import multiprocessing
-import time
 from DDFacet.Other import MyLogger
 from DDFacet.Other import ModColor
 log=MyLogger.getLogger("ClassImageDeconvMachine")
@@ -34,6 +32,7 @@ from DDFacet.Imager.SSD.MCMC.ClassMetropolis import ClassMetropolis
 from DDFacet.Array import NpParallel
 import ClassIslandDistanceMachine
 from DDFacet.Array import shared_dict
+from DDFacet.Other.AsyncProcessPool import APP
 
 MyLogger.setSilent("ClassArrayMethodSSD")
 MyLogger.setSilent("ClassIsland")
@@ -104,6 +103,8 @@ class ClassImageDeconvMachine():
         else:
             raise ValueError("InitType should be HMP or MORESANE")
 
+        APP.registerJobHandlers(self)
+
 
     def setMaskMachine(self,MaskMachine):
         self.MaskMachine=MaskMachine
@@ -434,41 +435,18 @@ class ClassImageDeconvMachine():
 
 
 
-    def DeconvListIsland(self,ListIslands,ParallelMode="OverIsland",ListInitIslands=None):
+    def DeconvListIsland(self,ListIslands,ParallelMode="OverIslands",ListInitIslands=None):
         # ================== Parallel part
 
         NIslands=len(ListIslands)
         if NIslands==0: return
-        if ParallelMode=="OverIslands":
-            NCPU=self.NCPU
-            NCPU=np.min([NCPU,NIslands])
-            Parallel=True
-            ParallelPerIsland=False
-            StopWhenQueueEmpty=True
-        elif ParallelMode=="PerIsland":
-            NCPU=1#self.NCPU
-            Parallel=True
-            ParallelPerIsland=True
-            StopWhenQueueEmpty=True
-
-        # ######### Debug
-        # ParallelPerIsland=False
-        # Parallel=False
-        # NCPU=1
-        # StopWhenQueueEmpty=True
-        # ##################
-        
-
-        work_queue = multiprocessing.Queue()
-
 
         # shared dict to hold inputs and outputs to workers (each island number is a key)
         deconv_dict  = shared_dict.create("DeconvListIslands")
 
-
-        NJobs=NIslands
         T=ClassTimeIt.ClassTimeIt("    ")
         T.disable()
+        ListFacetID=[]
         for iIsland, ThisPixList in enumerate(ListIslands):
             island_dict = deconv_dict.addSubdict(iIsland)
 
@@ -478,122 +456,114 @@ class ClassImageDeconvMachine():
             XY=np.array(ThisPixList,dtype=np.float32)
             xm,ym=np.mean(np.float32(XY),axis=0).astype(int)
             T.timeit("xm,ym")
-            nchan,npol,_,_=self._Dirty.shape
-            JonesNorm=(self.DicoDirty["JonesNorm"][:,:,xm,ym]).reshape((nchan,npol,1,1))
-            W=self.DicoDirty["WeightChansImages"]
-            JonesNorm=np.sum(JonesNorm*W.reshape((nchan,1,1,1)),axis=0).reshape((1,npol,1,1))
-            T.timeit("JonesNorm")
 
             IslandBestIndiv=self.ModelMachine.GiveIndividual(ThisPixList)
             T.timeit("GiveIndividual")
-            FacetID=self.PSFServer.giveFacetID2(xm,ym)
+            ListFacetID.append(self.PSFServer.giveFacetID2(xm,ym))
             T.timeit("FacetID")
 
             island_dict["BestIndiv"] = IslandBestIndiv
+            if ListInitIslands is not None and ListInitIslands[iIsland] is not None:
+                island_dict["Init"] = ListInitIslands[iIsland]
 
-            ListOrder=[iIsland,FacetID,JonesNorm.flat[0],self.RMS**2,island_dict.path]
+        # largest islands first, so that the workers don't end up waiting on a big one started last
+        ListOrder=sorted(range(NIslands),key=lambda iIsland: -len(ListIslands[iIsland]))
+        PixVariance=self.RMS**2
+        FreqsInfo=self.PSFServer.DicoMappingDesc
 
+        Title="Evolve pop."
+        if self.DeconvMode=="MetroClean":
+            Title="Running chain"
 
-            work_queue.put(ListOrder)
-            T.timeit("Put")
-
-
-        # ListArrayIslands=[np.array(ListIslands[iIsland]) for iIsland in range(NIslands)]
-        # NpShared.PackListArray(SharedListIsland,ListArrayIslands)
-        # T.timeit("Pack0")
-        # SharedBestIndiv="%s.ListBestIndiv"%(self.IdSharedMem)
-        # NpShared.PackListArray(SharedBestIndiv,ListBestIndiv)
-        # T.timeit("Pack1")
-        
-
-        workerlist=[]
+        if ParallelMode=="OverIslands":
+            for iIsland in ListOrder:
+                APP.runJob("DeconvIsland:%d"%iIsland, self._deconvIsland_worker,
+                           args=(deconv_dict[iIsland].readwrite(), iIsland, ListFacetID[iIsland], PixVariance,
+                                 self.DicoDirty.readonly(), self.DicoVariablePSF.readonly(), FreqsInfo))
+            ListHasError=APP.awaitJobResults("DeconvIsland:*", progress=Title)
+            DicoHasError=dict(ListHasError)
+        elif ParallelMode=="PerIsland":
+            # islands are done one at a time in this process, with the fitnesses of their population run as APP jobs
+            DicoHasError={}
+            pBAR= ProgressBar(Title=" "+Title)
+            pBAR.render(0, NIslands)
+            for iDone,iIsland in enumerate(ListOrder):
+                FacetID=ListFacetID[iIsland]
+                DicoHasError[iIsland]=self._deconvIsland(deconv_dict[iIsland], iIsland, FacetID, PixVariance,
+                                                          self._Dirty, self.DicoVariablePSF["CubeVariablePSF"][FacetID],
+                                                          FreqsInfo, ParallelFitness=True)
+                pBAR.render(iDone+1, NIslands)
+
+        deconv_dict.reload()
+        for iIsland in range(NIslands):
+            island_dict = deconv_dict[iIsland]
+            self.ModelMachine.AppendIsland(ListIslands[iIsland], island_dict["Model"].copy())
+
+            if DicoHasError[iIsland]:
+                self.ErrorModelMachine.AppendIsland(ListIslands[iIsland], island_dict["sModel"].copy())
 
-        # List_Result_queue=[]
-        # for ii in range(NCPU):
-        #     List_Result_queue.append(multiprocessing.JoinableQueue())
+        deconv_dict.delete()
 
+    def _deconvIsland_worker(self, island_dict, iIsland, FacetID, PixVariance, DicoDirty, DicoVariablePSF, FreqsInfo):
+        HasError=self._deconvIsland(island_dict, iIsland, FacetID, PixVariance,
+                                    DicoDirty["ImageCube"], DicoVariablePSF["CubeVariablePSF"][FacetID],
+                                    FreqsInfo, ParallelFitness=False)
+        return iIsland, HasError
 
-        result_queue=multiprocessing.Queue()
-        Title=" Evolve pop."
-        if self.DeconvMode=="MetroClean":
-            Title=" Running chain"
-            
-        pBAR= ProgressBar(Title=Title)
-        #pBAR.disable()
-        pBAR.render(0, NJobs)
-        for ii in range(NCPU):
-            W=WorkerDeconvIsland(work_queue, 
-                                 result_queue,
-                                 self.GD,
-                                 self._Dirty,
-                                 self.DicoVariablePSF["CubeVariablePSF"],
-                                 IdSharedMem=self.IdSharedMem,
-                                 FreqsInfo=self.PSFServer.DicoMappingDesc,ParallelPerIsland=ParallelPerIsland,
-                                 StopWhenQueueEmpty=StopWhenQueueEmpty,
-                                 DeconvMode=self.DeconvMode,
-                                 NChains=self.NChains,
-                                 ListInitIslands=ListInitIslands)
-            workerlist.append(W)
-
-            if Parallel: 
-                workerlist[ii].start()
-            else:
-                workerlist[ii].run()
-
-        iResult=0
-        #print "!!!!!!!!!!!!!!!!!!!!!!!!",iResult,NJobs
-        while iResult < NJobs:
-            DicoResult=None
-            # for result_queue in List_Result_queue:
-            #     if result_queue.qsize()!=0:
-            #         try:
-            #             DicoResult=result_queue.get_nowait()
-                        
-            #             break
-            #         except:
-                        
-            #             pass
-            #         #DicoResult=result_queue.get()
-            #print "!!!!!!!!!!!!!!!!!!!!!!!!! Qsize",result_queue.qsize()
-            if result_queue.qsize()!=0:
-                try:
-                    DicoResult=result_queue.get_nowait()
-                except:
-                    pass
-                    #DicoResult=result_queue.get()
-
-
-            if DicoResult is None:
-                time.sleep(0.05)
-                continue
-
-            iResult+=1
-            NDone=iResult
-            intPercent=int(100*  NDone / float(NJobs))
-            pBAR.render(NDone,NJobs)
-
-            if DicoResult["Success"]:
-                iIsland=DicoResult["iIsland"]
-                island_dict = deconv_dict[iIsland]
-                island_dict.reload()
-
-                self.ModelMachine.AppendIsland(ListIslands[iIsland], island_dict["Model"].copy())
-
-                if DicoResult["HasError"]:
-                    self.ErrorModelMachine.AppendIsland(ThisPixList, ListIslands[iIsland], island_dict["sModel"].copy())
+    def _deconvIsland(self, island_dict, iIsland, FacetID, PixVariance, Dirty, PSF, FreqsInfo, ParallelFitness=False):
+        """Runs the GA (or Metropolis chains) on one island, and puts the resulting model into island_dict.
+        Returns True if an error model ("sModel") was produced as well."""
+        ThisPixList = island_dict["Island"].tolist()
+        IslandBestIndiv = island_dict["BestIndiv"]
 
-        deconv_dict.delete()
+        NGen=self.GD["GAClean"]["NMaxGen"]
+        NIndiv=self.GD["GAClean"]["NSourceKin"]
 
-        for ii in range(NCPU):
-            try:
-                workerlist[ii].shutdown()
-                workerlist[ii].terminate()
-                workerlist[ii].join()
-            except:
-                pass
-        
+        ListPixParms=ThisPixList
+        ListPixData=ThisPixList
+        dx=self.GD["SSDClean"]["NEnlargeData"]
+        if dx>0:
+            IncreaseIslandMachine=ClassIncreaseIsland.ClassIncreaseIsland()
+            ListPixData=IncreaseIslandMachine.IncreaseIsland(ListPixData,dx=dx)
 
+        if self.DeconvMode=="GAClean":
+            InitIsland=island_dict["Init"] if "Init" in island_dict else None
+            CEv=ClassEvolveGA(Dirty,
+                              PSF,
+                              FreqsInfo,
+                              ListPixParms=ListPixParms,
+                              ListPixData=ListPixData,
+                              iFacet=FacetID,PixVariance=PixVariance,
+                              IslandBestIndiv=IslandBestIndiv,#*np.sqrt(JonesNorm),
+                              GD=self.GD,
+                              iIsland=iIsland,
+                              island_dict=island_dict,
+                              ParallelFitness=ParallelFitness,
+                              ListInitIslands={iIsland:InitIsland})
+            Model=CEv.main(NGen=NGen,NIndiv=NIndiv,DoPlot=False)
+            island_dict["Model"] = np.array(Model)
+            del(CEv)
+            return False
 
+        elif self.DeconvMode=="MetroClean":
+            CEv=ClassMetropolis(Dirty,
+                                PSF,
+                                FreqsInfo,
+                                ListPixParms=ListPixParms,
+                                ListPixData=ListPixData,
+                                iFacet=FacetID,PixVariance=PixVariance,
+                                IslandBestIndiv=IslandBestIndiv,#*np.sqrt(JonesNorm),
+                                GD=self.GD,
+                                iIsland=iIsland,
+                                island_dict=island_dict,
+                                ParallelFitness=ParallelFitness,
+                                NChains=self.NChains)
+            Model,sModel=CEv.main(NSteps=self.GD["MetroClean"]["MetroNIter"])
+
+            island_dict["Model"] = np.array(Model)
+            island_dict["sModel"] = np.array(sModel)
+            del(CEv)
+            return True
 
 
     ###################################################################################
@@ -674,180 +644,3 @@ class ClassImageDeconvMachine():
         Read in model dict
         """
         self.ModelMachine.FromDico(DicoName)
-
-#===============================================
-#===============================================
-#===============================================
-#===============================================
-
-class WorkerDeconvIsland(multiprocessing.Process):
-    def __init__(self,
-                 work_queue,
-                 result_queue,
-                 GD,
-                 Dirty,
-                 CubeVariablePSF,
-                 IdSharedMem=None,
-                 FreqsInfo=None,
-                 MultiFreqMode=False,
-                 ParallelPerIsland=False,
-                 StopWhenQueueEmpty=False,
-                 DeconvMode="GAClean",
-                 NChains=1,
-                 ListInitIslands=None):
-        multiprocessing.Process.__init__(self)
-        self.MultiFreqMode=MultiFreqMode
-        self.work_queue = work_queue
-        self.result_queue = result_queue
-        self.kill_received = False
-        self.ListInitIslands=ListInitIslands
-        self.exit = multiprocessing.Event()
-        self.GD=GD
-        self.IdSharedMem=IdSharedMem
-        self.FreqsInfo=FreqsInfo
-
-        self._Dirty = Dirty
-        self.CubeVariablePSF = CubeVariablePSF
-
-        #self.WeightFreqBands=WeightFreqBands
-        self.ParallelPerIsland=ParallelPerIsland
-        self.StopWhenQueueEmpty=StopWhenQueueEmpty
-        self.DeconvMode=DeconvMode
-        self.NChains=NChains
-
-    def shutdown(self):
-        self.exit.set()
-
-    def CondContinue(self):
-        if self.StopWhenQueueEmpty:
-            return not(self.work_queue.qsize()==0)
-        else:
-            return True
-
- 
-    def run(self):
-
-
-        while not self.kill_received and self.CondContinue():
-
-            #gc.enable()
-            try:
-                iIsland,FacetID,JonesNorm,PixVariance,shdict_path = self.work_queue.get(True,2)
-            except Exception,e:
-                #print "Exception worker: %s"%str(e)
-                break
-
-            # iIsland=DicoOrder["iIsland"]
-            # FacetID=DicoOrder["FacetID"]
-            
-            # JonesNorm=DicoOrder["JonesNorm"]
-
-            island_dict = shared_dict.attach(shdict_path)
-
-            ThisPixList = island_dict["Island"].tolist()
-            IslandBestIndiv = island_dict["BestIndiv"]
-            
-            PSF=self.CubeVariablePSF[FacetID]
-            NGen=self.GD["GAClean"]["NMaxGen"]
-            NIndiv=self.GD["GAClean"]["NSourceKin"]
-
-            ListPixParms=ThisPixList
-            ListPixData=ThisPixList
-            dx=self.GD["SSDClean"]["NEnlargeData"]
-            if dx>0:
-                IncreaseIslandMachine=ClassIncreaseIsland.ClassIncreaseIsland()
-                ListPixData=IncreaseIslandMachine.IncreaseIsland(ListPixData,dx=dx)
-
-
-            # ################################
-            # DicoSave={"Dirty":self._Dirty,
-            #           "PSF":PSF,
-            #           "FreqsInfo":self.FreqsInfo,
-            #           #"DicoMappingDesc":self.PSFServer.DicoMappingDesc,
-            #           "ListPixData":ListPixData,
-            #           "ListPixParms":ListPixParms,
-            #           "IslandBestIndiv":IslandBestIndiv,
-            #           "GD":self.GD,
-            #           "FacetID":FacetID,
-            #           "iIsland":iIsland,"IdSharedMem":self.IdSharedMem}
-            # print "saving"
-            # MyPickle.Save(DicoSave, "SaveTest")
-            # print "saving ok"
-            # ################################
-
-            
-            if self.DeconvMode=="GAClean":
-                CEv=ClassEvolveGA(self._Dirty,
-                                  PSF,
-                                  self.FreqsInfo,
-                                  ListPixParms=ListPixParms,
-                                  ListPixData=ListPixData,
-                                  iFacet=FacetID,PixVariance=PixVariance,
-                                  IslandBestIndiv=IslandBestIndiv,#*np.sqrt(JonesNorm),
-                                  GD=self.GD,
-                                  iIsland=iIsland,
-                                  island_dict=island_dict,
-                                  ParallelFitness=self.ParallelPerIsland,
-                                  ListInitIslands=self.ListInitIslands)
-                Model=CEv.main(NGen=NGen,NIndiv=NIndiv,DoPlot=False)
-                island_dict["Model"] = np.array(Model)
-                del(CEv)
-                self.result_queue.put({"Success":True,"iIsland":iIsland,"HasError":False})
-
-            elif self.DeconvMode=="MetroClean":
-                CEv=ClassMetropolis(self._Dirty,
-                                    PSF,
-                                    self.FreqsInfo,
-                                    ListPixParms=ListPixParms,
-                                    ListPixData=ListPixData,
-                                    iFacet=FacetID,PixVariance=PixVariance,
-                                    IslandBestIndiv=IslandBestIndiv,#*np.sqrt(JonesNorm),
-                                    GD=self.GD,
-                                    iIsland=iIsland,
-                                    island_dict=island_dict,
-                                    ParallelFitness=self.ParallelPerIsland,
-                                    NChains=self.NChains)
-                Model,sModel=CEv.main(NSteps=self.GD["MetroClean"]["MetroNIter"])
-            
-                island_dict["Model"] = np.array(Model)
-                island_dict["sModel"] = np.array(sModel)
-
-                del(CEv)
-                self.result_queue.put({"Success":True,"iIsland":iIsland,"HasError":True})
-
-
-            # # if island lies inside image
-            # try:
-            #     nch=self.FreqsInfo["MeanJonesBand"][FacetID].size
-            #     #WeightMeanJonesBand=self.FreqsInfo["MeanJonesBand"][FacetID].reshape((nch,1,1,1))
-            #     #WeightMueller=WeightMeanJonesBand.ravel()
-            #     #WeightMuellerSignal=np.sqrt(WeightMueller*self.FreqsInfo["WeightChansImages"].ravel())
-
-            #     CEv=ClassEvolveGA(self._Dirty,
-            #                       PSF,
-            #                       self.FreqsInfo,
-            #                       ListPixParms=ListPixParms,
-            #                       ListPixData=ListPixData,
-            #                       iFacet=FacetID,PixVariance=PixVariance,
-            #                       IslandBestIndiv=IslandBestIndiv,#*np.sqrt(JonesNorm),
-            #                       GD=self.GD)
-            #     #,
-            #      #                 WeightFreqBands=WeightMuellerSignal)
-            #     Model=CEv.main(NGen=NGen,NIndiv=NIndiv,DoPlot=False)
-            
-            #     Model=np.array(Model).copy()#/np.sqrt(JonesNorm)
-            #     #Model*=CEv.ArrayMethodsMachine.Gain
-                
-            #     del(CEv)
-                
-            #     NpShared.ToShared("%s.FitIsland_%5.5i"%(self.IdSharedMem,iIsland),Model)
-                
-            #     #print "Current process: %s [%s left]"%(str(multiprocessing.current_process()),str(self.work_queue.qsize()))
-                
-            #     self.result_queue.put({"Success":True,"iIsland":iIsland})
-            # except Exception,e:
-            #     print "Exception on island %i: %s"%(iIsland,str(e))
-
-            #     self.result_queue.put({"Success":False})
-
-        #print "WORKER DONE"
@@ -1,4 +1,4 @@
-import time
+import itertools
 import numpy as np
 from DDFacet.Other import MyLogger
 from DDFacet.Other import ModColor
@@ -6,54 +6,12 @@ log=MyLogger.getLogger("ClassIslandDistanceMachine")
 from DDFacet.Other.progressbar import ProgressBar
 from SkyModel.PSourceExtract import ClassIslands
 from SkyModel.PSourceExtract import ClassIncreaseIsland
-from DDFacet.Array import NpShared
 from DDFacet.ToolsDir.GiveEdges import GiveEdgesDissymetric
 from scipy.spatial import ConvexHull
+from scipy.spatial import cKDTree
 from matplotlib.path import Path
 import psutil
 
-class Island(object):
-    '''
-    helper class for MergeIsland
-    '''
-    def __init__(self,island):
-        if isinstance(island,set):
-            self.ilist=[[j[0],j[1]] for j in island]
-            self.iset=island
-        else:
-            self.iset=None
-            self.ilist=island
-        self.npa=np.array(self.ilist)
-        self.minx=np.min(self.npa[:,0])
-        self.maxx=np.max(self.npa[:,0])
-        self.miny=np.min(self.npa[:,1])
-        self.maxy=np.max(self.npa[:,1])
-        self.merged=False
-        self.new=False
-    def overlap(self,other):
-        # check if the bounding box overlaps
-        if (other.maxx<self.minx or other.maxy<self.miny or
-            other.minx>self.maxx or other.miny>self.maxy):
-            return False
-        return True
-    def make_set(self):
-        if self.iset is None:
-            self.iset=set(((j[0],j[1]) for j in self.ilist))
-    def intersect(self,other):
-        self.make_set()
-        other.make_set()
-        inter=self.iset.intersection(other.iset)
-        return len(inter)>0
-    def merge(self,other):
-        self.make_set()
-        other.make_set()
-        merged=self.iset.union(other.iset)
-        other.merged=True
-        return Island(merged)
-    def plot(self,**kwargs):
-        plt.scatter(self.npa[:,0],self.npa[:,1],**kwargs)
-
-
 class ClassIslandDistanceMachine():
     def __init__(self,GD,MaskArray,PSFServer,DicoDirty,IdSharedMem=""):
         self.GD=GD
@@ -156,25 +114,60 @@ class ClassIslandDistanceMachine():
         # dy=yMean.reshape((NIslands,1))-yMean.reshape((1,NIslands))
 
         #self.calcDistanceMatrixMean(ListIslands)
-        self.calcDistanceMatrixMinParallel(ListIslands)
-        dx,dy=self.dx,self.dy
-        self.DistCross=np.sqrt(dx**2+dy**2)
-
-        dx+=xcPSF
-        dy+=xcPSF
-        PSFCross=np.zeros((NIslands,NIslands),np.float32)
-        indPSF=np.arange(NIslands**2)
-        Cx=((dx>=0)&(dx<nPSF))
-        Cy=((dy>=0)&(dy<nPSF))
-        C=(Cx&Cy)
-        indPSF_sel=indPSF[C.ravel()]
-        indPixPSF=dx.ravel()[C.ravel()]*nPSF+dy.ravel()[C.ravel()]
-        PSFCross.flat[indPSF_sel]=np.abs(PSF.flat[indPixPSF.ravel()])
+        # only islands closer than the maximum group distance can be grouped, so only these pairs are kept:
+        # NeighbourIslands[i] lists the islands near island i, and DistCross[i]/PSFCross[i] are aligned with it
+        _,D1=self.GD["SSDClean"]["MinMaxGroupDistance"]
+        Neighbours=self.giveNeighbourIslands(self.giveEdgesIslands(ListIslands),D1)
+
+        self.NeighbourIslands=[]
+        self.DistCross=[]
+        PSFCross=[]
+        for iIsland in range(NIslands):
+            ListNeighbours=sorted(Neighbours[iIsland].keys())
+            dxdyd=np.array([Neighbours[iIsland][jIsland] for jIsland in ListNeighbours],np.float32).reshape((-1,3))
+            dx=np.int32(dxdyd[:,0])+xcPSF
+            dy=np.int32(dxdyd[:,1])+xcPSF
+            C=((dx>=0)&(dx<nPSF)&(dy>=0)&(dy<nPSF))
+            ThisPSFCross=np.zeros((dx.size,),np.float32)
+            ThisPSFCross[C]=np.abs(PSF[dx[C],dy[C]])
+            self.NeighbourIslands.append(np.array(ListNeighbours,np.int32))
+            self.DistCross.append(dxdyd[:,2])
+            PSFCross.append(ThisPSFCross)
 
+        self.PSFCross=PSFCross
 
+    def giveNeighbourIslands(self,ListPix,MaxDistance):
+        """Finds the pairs of pixel lists (islands, or their edges) that are within MaxDistance of each other,
+        using KD-trees. Returns a list with, for each pixel list i, a dict mapping every such j (including i
+        itself) to (dx,dy,d): the offset from the closest pixel of j to the closest pixel of i, and its length."""
+        NIslands=len(ListPix)
+        ListXY=[np.array(Pix,np.int32).reshape((-1,2)) for Pix in ListPix]
+        Owner=np.concatenate([np.zeros((0,),np.int32)]+[np.zeros((XY.shape[0],),np.int32)+iIsland for iIsland,XY in enumerate(ListXY)])
+        Neighbours=[{} for iIsland in range(NIslands)]
+        if Owner.size==0:
+            return Neighbours
+        Tree=cKDTree(np.concatenate(ListXY))
+        ListTrees=[None]*NIslands
 
-        
-        self.PSFCross=PSFCross
+        for iIsland in range(NIslands):
+            XY0=ListXY[iIsland]
+            if XY0.shape[0]==0: continue
+            # candidates are the islands owning a pixel within MaxDistance of this one
+            ListClose=Tree.query_ball_point(XY0,MaxDistance)
+            Candidates=np.unique(Owner[np.fromiter(itertools.chain.from_iterable(ListClose),np.int64)])
+            for jIsland in Candidates:
+                if jIsland<iIsland: continue
+                if jIsland==iIsland:
+                    Neighbours[iIsland][iIsland]=(0,0,0.)
+                    continue
+                if ListTrees[jIsland] is None:
+                    ListTrees[jIsland]=cKDTree(ListXY[jIsland])
+                d,ind=ListTrees[jIsland].query(XY0)
+                iPix=np.argmin(d)
+                dx,dy=XY0[iPix]-ListXY[jIsland][ind[iPix]]
+                Neighbours[iIsland][jIsland]=(dx,dy,d[iPix])
+                Neighbours[jIsland][iIsland]=(-dx,-dy,d[iPix])
+        return Neighbours
 
     def GiveNearbyIsland(self,iIsland,SetThisIsland):
         Th=0.05
@@ -191,7 +184,7 @@ class ClassIslandDistanceMachine():
         CTh=(self.PSFCross[iIsland]>Th)
         C0=(self.DistCross[iIsland]<D0)
         C1=(self.DistCross[iIsland]<D1)
-        setNearbyIsland=set(np.where( (CTh | C0) & (C1) )[0].tolist())
+        setNearbyIsland=set(self.NeighbourIslands[iIsland][(CTh | C0) & (C1)].tolist())
         setNearbyIsland=setNearbyIsland.difference(SetThisIsland)
         
         #print "  #%3.3i <- %i islands"%(iIsland,len(setNearbyIsland))
@@ -224,7 +217,7 @@ class ClassIslandDistanceMachine():
             MaxIslandFlux[iIsland]=np.max(PixVals0)
             DicoIsland[iIsland]=ListIslands[iIsland]
 
-        self.CrossFluxContrib=self.PSFCross*MaxIslandFlux.reshape((1,NIslands))
+        self.CrossFluxContrib=[self.PSFCross[iIsland]*MaxIslandFlux[self.NeighbourIslands[iIsland]] for iIsland in range(NIslands)]
         self.DicoIsland=DicoIsland
 
         NDone=0
@@ -386,161 +379,24 @@ class ClassIslandDistanceMachine():
 
     def MergeIslands(self,ListIslands):
         print>>log,"  Merge intersecting islands"
-        Islands=[Island(i) for i in ListIslands]
-
-        i=0
-        while i<len(Islands)-1:
-            merged=False
-            for j in range(i+1,len(Islands)):
-                if Islands[j].merged:
-                    continue
-                if Islands[i].overlap(Islands[j]):
-                    if Islands[i].intersect(Islands[j]):
-                        merged=True
-                        Islands[i]=Islands[i].merge(Islands[j])
-                        Islands[i].new=True
-            if not(merged):
-                i+=1
-        result=[i.ilist for i in Islands if not i.merged]
-        print>>log,"  %i islands remaining after merge" % len(result)
-        return result
-
-    def calcDistanceMatrixMinParallel(self,ListIslands,Parallel=True):
+        # intersecting islands share a pixel, i.e. are at distance 0: merge each connected group of these
+        Neighbours=self.giveNeighbourIslands(ListIslands,0.5)
         NIslands=len(ListIslands)
-        self.D=np.zeros((NIslands,NIslands),np.float32)
-        self.dx=np.zeros((NIslands,NIslands),np.int32)
-        self.dy=np.zeros((NIslands,NIslands),np.int32)
-
-        work_queue = multiprocessing.JoinableQueue()
+        Merged=np.zeros((NIslands,),bool)
+        result=[]
         for iIsland in range(NIslands):
-            work_queue.put({"iIsland":(iIsland)})
-
-        result_queue=multiprocessing.JoinableQueue()
-        NJobs=work_queue.qsize()
-        workerlist=[]
-        NCPU=self.NCPU
-
-        ListEdgeIslands=self.giveEdgesIslands(ListIslands)
-
-        for ii in range(NCPU):
-            W = WorkerDistance(work_queue,
-                               result_queue,
-                               ListEdgeIslands,
-                               self.IdSharedMem)
-            workerlist.append(W)
-            if Parallel:
-                workerlist[ii].start()
-
-        pBAR = ProgressBar(Title="  Calc. Dist. ")
-        pBAR.render(0, NJobs)
-        iResult = 0
-        if not Parallel:
-            for ii in range(NCPU):
-                workerlist[ii].run()  # just run until all work is completed
-
-        while iResult < NJobs:
-            DicoResult = None
-            if result_queue.qsize() != 0:
-                try:
-                    DicoResult = result_queue.get()
-                except:
-                    pass
-
-            if DicoResult == None:
-                time.sleep(0.5)
-                continue
-
-            if DicoResult["Success"]:
-                iResult+=1
-                NDone=iResult
-                pBAR.render(NDone,NJobs)
-
-                iIsland=DicoResult["iIsland"]
-                Result=NpShared.GiveArray("%sDistances_%6.6i"%(self.IdSharedMem,iIsland))
-
-                self.dx[iIsland]=Result[0]
-                self.dy[iIsland]=Result[1]
-                self.D[iIsland]=Result[2]
-                NpShared.DelAll("%sDistances_%6.6i"%(self.IdSharedMem,iIsland))
-
-
-
-
-        if Parallel:
-            for ii in range(NCPU):
-                workerlist[ii].shutdown()
-                workerlist[ii].terminate()
-                workerlist[ii].join()
-
-
-
-
-
-##########################################
-####### Workers
-##########################################
-import os
-import signal
-import multiprocessing
-
-class WorkerDistance(multiprocessing.Process):
-    def __init__(self,
-                 work_queue,
-                 result_queue,
-                 ListIsland,
-                 IdSharedMem):
-        multiprocessing.Process.__init__(self)
-        self.work_queue = work_queue
-        self.result_queue = result_queue
-        self.kill_received = False
-        self.exit = multiprocessing.Event()
-        self.ListIslands=ListIsland
-        self.IdSharedMem=IdSharedMem
-
-    def shutdown(self):
-        self.exit.set()
-
-
-    def giveMinDist(self, DicoJob):
-        iIsland=DicoJob["iIsland"]
-        NIslands=len(self.ListIslands)
-        Result=np.zeros((3,NIslands),np.int32)
-
-        x0,y0=np.array(self.ListIslands[iIsland]).T
-        for jIsland in range(NIslands):
-            x1,y1=np.array(self.ListIslands[jIsland]).T
-            dx=x0.reshape((-1,1))-x1.reshape((1,-1))
-            dy=y0.reshape((-1,1))-y1.reshape((1,-1))
-            d=np.sqrt(dx**2+dy**2)
-            dmin=np.min(d)
-            indx,indy=np.where(d==dmin)
-            Res=dmin
-            Result[0,jIsland]=dx[indx[0],indy[0]]
-            Result[1,jIsland]=dy[indx[0],indy[0]]
-            Result[2,jIsland]=dmin
-
-        NpShared.ToShared("%sDistances_%6.6i"%(self.IdSharedMem,iIsland),Result)
-
-        self.result_queue.put({"iIsland": iIsland, "Success":True})
-
-    def run(self):
-        while not self.kill_received and not self.work_queue.empty():
-            
-            DicoJob = self.work_queue.get()
-            self.giveMinDist(DicoJob)
-            # try:
-            #     self.initIsland(DicoJob)
-            # except:
-            #     iIsland=DicoJob["iIsland"]
-            #     print ModColor.Str("On island %i"%iIsland)
-            #     print traceback.format_exc()
-            #     print
-            #     print self.ListIsland[iIsland]
-            #     print
-
-
-
-
-
-
-
+            if Merged[iIsland]: continue
+            Merged[iIsland]=True
+            ListGroup=[iIsland]
+            for iGroup in ListGroup:
+                for jIsland in Neighbours[iGroup].keys():
+                    if not Merged[jIsland]:
+                        Merged[jIsland]=True
+                        ListGroup.append(jIsland)
+            if len(ListGroup)==1:
+                result.append(ListIslands[iIsland])
+            else:
+                SetPix=set([(x,y) for jIsland in ListGroup for x,y in ListIslands[jIsland]])
+                result.append([[x,y] for x,y in SetPix])
+        print>>log,"  %i islands remaining after merge" % len(result)
+        return result
@@ -37,6 +37,7 @@ from DDFacet.Other import MyLogger
 from DDFacet.Other import ClassTimeIt
 from DDFacet.Other import ModColor
 from DDFacet.Other import Exceptions
+from DDFacet.Other import Tracing
 from DDFacet.Other.progressbar import ProgressBar
 from DDFacet.Array import shared_dict
 import DDFacet.cbuild.Gridder._pyArrays as _pyArrays
@@ -53,6 +54,21 @@ parent_pid = os.getpid()
 class WorkerProcessError(Exception):
     pass
 
+# Layout of the compute job ring. Small compute jobs (whose arguments are all scalars, short strings or SharedDict
+# representations) are described by a fixed-size record in a shared-memory ring, instead of a job dict pickled
+# through the compute queue. Each record is a row of int64 header fields, plus a row of bytes holding the job ID,
+# method name and string arguments, separated by nulls. The total length of these is stored in the header, so that
+# empty strings (e.g. the method name of a function handler) are decoded exactly.
+JOB_RING_SIZE = 4096        # number of job records
+JOB_RING_MAXARGS = 8        # max number of positional args in a ring job
+JOB_RING_STRLEN = 1024      # max total length of strings in a ring job
+# header fields
+_JR_HANDLER, _JR_EVENT, _JR_COUNTER, _JR_COLLECT, _JR_TIME, _JR_NARGS, _JR_STRLEN, _JR_ARGKIND = range(8)
+_JR_ARGVAL = _JR_ARGKIND + JOB_RING_MAXARGS
+_JR_NFIELDS = _JR_ARGVAL + JOB_RING_MAXARGS
+# argument kinds
+_JR_NONE, _JR_INT, _JR_FLOAT, _JR_BOOL, _JR_STR, _JR_SHAREDDICT = range(6)
+
 class Job(object):
     def __init__ (self, job_id, jobitem, singleton=False, event=None, when_complete=None):
         self.job_id, self.jobitem, self.singleton, self.event, self.when_complete = \
@@ -63,7 +79,8 @@ class Job(object):
     def setResult (self, result):
         self.result = result
         self.complete = True
-        self.when_complete()
+        if result.get("success"):
+            self.when_complete()
 
 class JobCounterPool(object):
     """Implements a condition variable that is a counter. Typically used to keep track of the number of pending jobs
@@ -152,6 +169,8 @@ class AsyncProcessPool (object):
         self._events = {}
         self._results_map = {}
         self._job_counters = JobCounterPool()
+        self._job_ring = None
+        self._dispatch_stats = None
 
     def __del__(self):
         self.shutdown()
@@ -298,6 +317,12 @@ class AsyncProcessPool (object):
         self._compute_queue   = multiprocessing.Queue()
         self._io_queues       = [ multiprocessing.Queue() for x in xrange(num_io_processes) ]
         self._result_queue    = multiprocessing.Queue()
+        # compute workers wait on this semaphore, which counts pending compute jobs (in the ring and in the queue)
+        self._compute_tickets = multiprocessing.Semaphore(0)
+        # this counts free slots in the job ring
+        self._job_ring_free   = multiprocessing.Semaphore(JOB_RING_SIZE)
+        self._job_ring_lock   = multiprocessing.Lock()
+        self._dispatch_stats_lock = multiprocessing.Lock()
         self._termination_event = multiprocessing.Event()
         # this event is set when all workers have been started, an cleared when a restart is requested
         self._workers_started_event = multiprocessing.Event()
@@ -317,6 +342,21 @@ class AsyncProcessPool (object):
 
         self._started = False
 
+    def _initJobRing(self, state):
+        """Allocates the job ring in the given SharedDict, along with the tables of handlers, events and counters,
+        which are referred to by index in job ring records. This is done before the workers are forked, so the
+        tables are the same in every process."""
+        self._handler_ids = self._job_handlers.keys()
+        self._handler_index = dict([(hid, i) for i, hid in enumerate(self._handler_ids)])
+        self._event_ids = self._events.keys()
+        self._event_index = dict([(eid, i) for i, eid in enumerate(self._event_ids)])
+        self._counter_ids = self._job_counters._counters.keys()
+        self._counter_index = dict([(cid, i) for i, cid in enumerate(self._counter_ids)])
+        self._job_ring = state.addSharedArray("JobRing", (JOB_RING_SIZE, _JR_NFIELDS), np.int64)
+        self._job_ring_strings = state.addSharedArray("JobRingStrings", (JOB_RING_SIZE, JOB_RING_STRLEN), np.uint8)
+        # head and tail of ring
+        self._job_ring_pointers = state.addSharedArray("JobRingPointers", (2,), np.int64)
+
     def registerJobHandlers (self, *handlers):
         """Adds recognized job handlers. Job handlers may be functions or objects."""
         if os.getpid() != parent_pid:
@@ -348,6 +388,9 @@ class AsyncProcessPool (object):
         """Starts worker threads. All job handlers and events must be registered *BEFORE*"""
         self._shared_state = shared_dict.create("APP")
         self._job_counters.finalize(self._shared_state)
+        self._initJobRing(self._shared_state)
+        # per handler: number of jobs, total and max dispatch latency, number of jobs dispatched via the ring
+        self._dispatch_stats = self._shared_state.addSharedArray("DispatchStats", (len(self._handler_ids), 4), np.float64)
         if self.ncpu > 1:
             self._taras_bulba.start()
         self._started = True
@@ -382,7 +425,7 @@ class AsyncProcessPool (object):
             if self.verbose:
                 print>> log, "asking worker processes to restart"
             for core in self._cores:
-                self._compute_queue.put("POISON-E")
+                self._putComputeQueue("POISON-E")
             for queue in self._io_queues:
                 queue.put("POISON-E")
             if self.verbose:
@@ -514,7 +557,7 @@ class AsyncProcessPool (object):
     def runJob (self, job_id, handler=None, io=None, args=(), kwargs={},
                 event=None, counter=None,
                 singleton=False, collect_result=True,
-                serial=False):
+                serial=False, when_complete=None):
         """
         Puts a job on a processing queue.
 
@@ -534,7 +577,13 @@ class AsyncProcessPool (object):
                     If False, job result will be collected by awaitJobResults() and removed from the map: the job can be
                     run again.
             serial: if True, job is run serially in the main process. Useful for debugging.
+            when_complete: if set, this callable is invoked (with no arguments) in the parent process when the job's
+                    result has been received successfully. Results are received while the parent sits in
+                    awaitJobResults() (on any job), so this can be used to launch dependent jobs as soon as possible.
+                    Requires collect_result=True.
         """
+        if when_complete and not collect_result:
+            raise RuntimeError("Job '%s': when_complete requires collect_result=True. This is a bug."%job_id)
         if collect_result and os.getpid() != parent_pid:
             raise RuntimeError("runJob() with collect_result can only be called in the parent process. This is a bug.")
         if collect_result and job_id in self._results_map:
@@ -577,17 +626,19 @@ class AsyncProcessPool (object):
                        event=event and id(event),
                        counter=counter and id(counter),
                        collect_result=collect_result,
-                       args=args, kwargs=kwargs)
+                       args=args, kwargs=kwargs,
+                       enqueue_time=time.time())
         # insert entry into dict of pending jobs
         if collect_result:
-            job = self._results_map[job_id] = Job(job_id, jobitem, singleton=singleton)
+            job = self._results_map[job_id] = Job(job_id, jobitem, singleton=singleton, when_complete=when_complete)
         ## normal paralell mode, stick job on queue
         if self.ncpu > 1 and not serial:
             if self.verbose > 2:
                 print>>log, "enqueueing job %s: %s"%(job_id, handler_desc)
-            # place it on appropriate queue
+            # place it on appropriate queue. Small compute jobs go onto the job ring, if there's room
             if io is None:
-                self._compute_queue.put(jobitem)
+                if not self._putJobRing(jobitem):
+                    self._putComputeQueue(jobitem)
             else:
                 io = max(len(self._io_queues)-1, io)
                 self._io_queues[io].put(jobitem)
@@ -595,6 +646,145 @@ class AsyncProcessPool (object):
         else:
             self._dispatch_job(jobitem, reraise=True)
 
+    def _putComputeQueue (self, jobitem):
+        """Places a pickled job item (or a poison pill) onto the compute queue"""
+        self._compute_queue.put(jobitem)
+        self._compute_tickets.release()
+
+    def _putJobRing (self, jobitem):
+        """Places a job onto the job ring. Returns False if the job can't be described by a ring record
+        (e.g. has kwargs, or array arguments), or if the ring is full, in which case the job must go onto the queue."""
+        if self._job_ring is None or jobitem["kwargs"] or len(jobitem["args"]) > JOB_RING_MAXARGS:
+            return False
+        handler_id, method, _ = jobitem["handler"]
+        header = np.zeros(_JR_NFIELDS, np.int64)
+        header[_JR_HANDLER] = self._handler_index[handler_id]
+        header[_JR_EVENT] = self._event_index[jobitem["event"]] if jobitem["event"] is not None else -1
+        header[_JR_COUNTER] = self._counter_index[jobitem["counter"]] if jobitem["counter"] else -1
+        header[_JR_COLLECT] = jobitem["collect_result"]
+        header[_JR_TIME:_JR_TIME+1].view(np.float64)[0] = jobitem["enqueue_time"]
+        header[_JR_NARGS] = len(jobitem["args"])
+        strings = [jobitem["job_id"], method or ""]
+        for iarg, arg in enumerate(jobitem["args"]):
+            if arg is None:
+                kind = _JR_NONE
+            elif isinstance(arg, (bool, np.bool_)):
+                kind, header[_JR_ARGVAL+iarg] = _JR_BOOL, arg
+            elif isinstance(arg, (int, long, np.integer)):
+                if not -2**63 <= arg < 2**63:
+                    return False
+                kind, header[_JR_ARGVAL+iarg] = _JR_INT, arg
+            elif isinstance(arg, (float, np.floating)):
+                kind = _JR_FLOAT
+                header[_JR_ARGVAL+iarg:_JR_ARGVAL+iarg+1].view(np.float64)[0] = arg
+            elif type(arg) is str and "\0" not in arg:
+                kind = _JR_STR
+                strings.append(arg)
+            elif type(arg) is shared_dict.SharedDictRepresentation:
+                kind, header[_JR_ARGVAL+iarg] = _JR_SHAREDDICT, int(bool(arg.readwrite)) | (int(bool(arg.load)) << 1)
+                strings.append(arg.path)
+            else:
+                return False
+            header[_JR_ARGKIND+iarg] = kind
+        strings = "\0".join(strings)
+        if len(strings) > JOB_RING_STRLEN or "\0" in jobitem["job_id"]:
+            return False
+        header[_JR_STRLEN] = len(strings)
+        if not self._job_ring_free.acquire(False):
+            return False
+        with self._job_ring_lock:
+            slot = self._job_ring_pointers[1] % JOB_RING_SIZE
+            self._job_ring[slot, :] = header
+            self._job_ring_strings[slot, :len(strings)] = np.frombuffer(strings, np.uint8)
+            self._job_ring_strings[slot, len(strings):] = 0
+            self._job_ring_pointers[1] += 1
+        self._compute_tickets.release()
+        return True
+
+    def _getComputeJob (self, timeout):
+        """Called in compute workers to get the next job item, either from the job ring or from the compute queue.
+        Returns None on timeout."""
+        if not self._compute_tickets.acquire(True, timeout):
+            return None
+        header = None
+        with self._job_ring_lock:
+            head, tail = self._job_ring_pointers
+            if head < tail:
+                slot = head % JOB_RING_SIZE
+                header = self._job_ring[slot, :].copy()
+                strings = self._job_ring_strings[slot, :header[_JR_STRLEN]].tostring()
+                self._job_ring_pointers[0] += 1
+        # nothing on the ring, so our ticket is for a job on the queue
+        if header is None:
+            return self._compute_queue.get()
+        self._job_ring_free.release()
+        # decode the record back into a job item
+        strings = strings.split("\0")
+        job_id, method = strings[0], strings[1] or None
+        istr = 2
+        args = []
+        for iarg in xrange(header[_JR_NARGS]):
+            kind, value = header[_JR_ARGKIND+iarg], header[_JR_ARGVAL+iarg]
+            if kind == _JR_NONE:
+                args.append(None)
+            elif kind == _JR_BOOL:
+                args.append(bool(value))
+            elif kind == _JR_INT:
+                args.append(int(value))
+            elif kind == _JR_FLOAT:
+                args.append(float(header[_JR_ARGVAL+iarg:_JR_ARGVAL+iarg+1].view(np.float64)[0]))
+            elif kind == _JR_STR:
+                args.append(strings[istr])
+                istr += 1
+            elif kind == _JR_SHAREDDICT:
+                args.append(shared_dict.SharedDictRepresentation(strings[istr], readwrite=bool(value&1), load=bool(value&2)))
+                istr += 1
+        handler_id = self._handler_ids[header[_JR_HANDLER]]
+        handler = self._job_handlers[handler_id]
+        handler_desc = "%s.%s()" % (type(handler).__name__, method) if method else "%s()" % getattr(handler, "__name__", handler_id)
+        return dict(job_id=job_id, handler=(handler_id, method, handler_desc),
+                    event=self._event_ids[header[_JR_EVENT]] if header[_JR_EVENT] >= 0 else None,
+                    counter=self._counter_ids[header[_JR_COUNTER]] if header[_JR_COUNTER] >= 0 else None,
+                    collect_result=bool(header[_JR_COLLECT]),
+                    args=args, kwargs={},
+                    enqueue_time=header[_JR_TIME:_JR_TIME+1].view(np.float64)[0],
+                    via_ring=True)
+
+    def _updateDispatchStats (self, jobitem, latency):
+        """Called in worker processes to accumulate dispatch latency per handler"""
+        if self._dispatch_stats is None:
+            return
+        ih = self._handler_index.get(jobitem["handler"][0])
+        if ih is None:
+            return
+        with self._dispatch_stats_lock:
+            stats = self._dispatch_stats[ih]
+            stats[0] += 1
+            stats[1] += latency
+            stats[2] = max(stats[2], latency)
+            stats[3] += bool(jobitem.get("via_ring"))
+
+    def getDispatchStats (self):
+        """Returns a dict of handler_name: (njobs, mean_latency, max_latency, njobs_via_ring). Latency is the time
+        between runJob() and a worker picking the job up, in seconds."""
+        if self._dispatch_stats is None:
+            return {}
+        stats = {}
+        with self._dispatch_stats_lock:
+            for ih, handler_id in enumerate(self._handler_ids):
+                njobs, total, maxlat, nring = self._dispatch_stats[ih]
+                if njobs:
+                    handler = self._job_handlers[handler_id]
+                    name = getattr(handler, "__name__", None) or type(handler).__name__
+                    stats[name] = int(njobs), total/njobs, maxlat, int(nring)
+        return stats
+
+    def printDispatchStats (self):
+        """Prints a summary of job dispatch latencies"""
+        for name, (njobs, mean, maxlat, nring) in sorted(self.getDispatchStats().items()):
+            print>>log, "%s: %d jobs (%d via job ring), dispatch latency mean %.2fms, max %.2fms" % (
+                name, njobs, nring, mean*1e3, maxlat*1e3)
+
     def awaitJobCounter (self, counter, progress=None, total=None, timeout=10):
         if self.verbose > 2:
             print>> log, "  %s is complete" % counter.name
@@ -661,6 +851,7 @@ class AsyncProcessPool (object):
             raise RuntimeError("This method can only be called in the parent process. This is a bug.")
         if type(jobspecs) is str:
             jobspecs = [ jobspecs ]
+        t0_await = time.time()
         # make a dict of all jobs still outstanding
         awaiting_jobs = {}  # this maps job_id to a set of jobspecs (if multiple) that it matches
         job_results = OrderedDict()   # this maps jobspec to a list of results
@@ -722,6 +913,8 @@ class AsyncProcessPool (object):
         # render complete
         if progress:
             pBAR.render(complete_jobs,(total_jobs or 1))
+        # time spent blocking here is time the main process is not doing anything else
+        Tracing.addEvent("await %s" % ",".join(jobspecs), "await", t0_await, time.time(), njobs=total_jobs)
 
         if self._termination_event.is_set():
             if self.verbose > 1:
@@ -731,11 +924,14 @@ class AsyncProcessPool (object):
         # process list of results for each jobspec to check for errors
         for jobspec, (njobs, results) in job_results.iteritems():
             times = np.array([ res['time'] for res in results ])
+            latencies = np.array([ res.get('latency', 0) for res in results ])
             num_errors = len([res for res in results if not res['success']])
             if timing or progress:
-                print>> log, "%s: %d jobs complete, average single-core time %.2fs per job" % (timing or progress, len(results), times.mean())
+                print>> log, "%s: %d jobs complete, average single-core time %.2fs per job, dispatch latency %.2fms" % (
+                    timing or progress, len(results), times.mean(), latencies.mean()*1e3)
             elif self.verbose > 0:
-                print>> log, "%s: %d jobs complete, average single-core time %.2fs per job" % (jobspec, len(results), times.mean())
+                print>> log, "%s: %d jobs complete, average single-core time %.2fs per job, dispatch latency %.2fms" % (
+                    jobspec, len(results), times.mean(), latencies.mean()*1e3)
             if num_errors:
                 print>>log, ModColor.Str("%s: %d jobs returned an error. Aborting."%(jobspec, num_errors), col="red")
                 raise RuntimeError("some distributed jobs have failed")
@@ -761,6 +957,8 @@ class AsyncProcessPool (object):
             return
         if self.verbose > 1:
             print>>log,"shutdown: asking TB to stop workers"
+        if self.verbose > 0:
+            self.printDispatchStats()
         self._started = False
         self._taras_exit_event.set()
         self.restartWorkers()
@@ -803,6 +1001,7 @@ class AsyncProcessPool (object):
         _pyArrays.pySetOMPDynamicNumThreads(1)
         AsyncProcessPool.proc_id = proc_id
         MyLogger.subprocess_id = proc_id
+        Tracing.setProcessName(proc_id)
         if affinity:
             psutil.Process().cpu_affinity(affinity)
         object._run_worker(worker_queue)
@@ -816,6 +1015,8 @@ class AsyncProcessPool (object):
         If reraise is True, any eceptions are re-raised. This is useful for debugging."""
         timer = ClassTimeIt.ClassTimeIt()
         event = counter = None
+        latency = timer.t0 - jobitem.get("enqueue_time", timer.t0)
+        self._updateDispatchStats(jobitem, latency)
         try:
             job_id, event_id, counter_id, args, kwargs = [jobitem.get(attr) for attr in
                                                         "job_id", "event", "counter", "args", "kwargs"]
@@ -852,7 +1053,8 @@ class AsyncProcessPool (object):
             # Send result back
             if jobitem['collect_result']:
                 self._result_queue.put(
-                    dict(job_id=job_id, proc_id=self.proc_id, success=True, result=result, time=timer.seconds()))
+                    dict(job_id=job_id, proc_id=self.proc_id, success=True, result=result, time=timer.seconds(),
+                         latency=latency))
         except KeyboardInterrupt:
             raise
         except Exception, exc:
@@ -865,13 +1067,31 @@ class AsyncProcessPool (object):
                 AsyncProcessPool.proc_id, job_id, traceback.format_exc()))
             if jobitem['collect_result']:
                 self._result_queue.put(
-                    dict(job_id=job_id, proc_id=self.proc_id, success=False, error=exc, time=timer.seconds()))
+                    dict(job_id=job_id, proc_id=self.proc_id, success=False, error=exc, time=timer.seconds(),
+                         latency=latency))
         finally:
             # Raise event
             if event is not None:
                 event.set()
             if counter is not None:
                 counter.decrement()
+            if Tracing.isEnabled():
+                self._traceJob(jobitem, timer.t0, latency)
+
+    @staticmethod
+    def _traceJob(jobitem, t0, latency):
+        """Records a trace event for a job. Handlers can attach facet, chunk and bytes touched via
+        Tracing.annotate(), otherwise bytes touched is estimated from the array arguments."""
+        args = dict(handler=jobitem["handler"][2], latency=latency)
+        nbytes = sum([arg.nbytes for arg in list(jobitem["args"]) + jobitem["kwargs"].values()
+                      if isinstance(arg, np.ndarray)])
+        if nbytes:
+            args["bytes"] = nbytes
+        match = re.search(r"F(\d+)$", jobitem["job_id"])
+        if match:
+            args["facet"] = int(match.group(1))
+        args.update(Tracing.popAnnotations())
+        Tracing.addEvent(jobitem["job_id"], "job", t0, time.time(), **args)
 
     def _run_worker (self, queue):
         """
@@ -886,8 +1106,14 @@ class AsyncProcessPool (object):
             while pill:
                 try:
                     # Get queue item, or timeout and check if pill perscribed.
+                    # Compute workers get their jobs via the job ring (which falls back to the compute queue)
                     #print>>log,"%s: calling queue.get()"%AsyncProcessPool.proc_id
-                    jobitem = queue.get(True, 10)
+                    if queue is self._compute_queue:
+                        jobitem = self._getComputeJob(10)
+                        if jobitem is None:
+                            continue
+                    else:
+                        jobitem = queue.get(True, 10)
                     #print>>log,"%s: queue.get() returns %s"%(AsyncProcessPool.proc_id, jobitem)
                 except Queue.Empty:
                     continue
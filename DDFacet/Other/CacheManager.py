@@ -21,10 +21,52 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import os, os.path, subprocess
 import cPickle
 import collections
+import json
+import hashlib
+import fcntl
+import time
+import numpy as np
 
 from DDFacet.Other import MyLogger, ModColor
 log = MyLogger.getLogger("CacheManager")
 
+# name of cache index file (one per cache directory)
+INDEX_NAME = "CacheIndex.json"
+
+# start time of this process. Cache elements accessed since then are never evicted.
+_session_start = time.time()
+
+
+def _canonicalKeys(keys):
+    """Converts a hash key object into a canonical JSON-serializable form. Arrays are represented by a hash of
+    their contents (plus shape and type), so they may be used as keys directly."""
+    if isinstance(keys, dict):
+        return dict([(str(key), _canonicalKeys(value)) for key, value in keys.iteritems()])
+    elif isinstance(keys, (list, tuple)):
+        return [_canonicalKeys(value) for value in keys]
+    elif isinstance(keys, np.ndarray):
+        return dict(ndarray=hashlib.sha1(np.ascontiguousarray(keys).view(np.uint8)).hexdigest(),
+                    shape=list(keys.shape), dtype=str(keys.dtype))
+    elif isinstance(keys, np.generic):
+        return keys.item()
+    elif keys is None or isinstance(keys, (bool, int, long, float, basestring)):
+        return keys
+    return repr(keys)
+
+
+def _keyDigest(canonical_keys):
+    """Returns content hash of canonical keys"""
+    return hashlib.sha1(json.dumps(canonical_keys, sort_keys=True)).hexdigest()
+
+
+def _elementSize(path):
+    """Returns size of cache element on disk (for directories, total size of contents)"""
+    if os.path.isdir(path):
+        return sum([os.path.getsize(os.path.join(dirpath, name))
+                    for dirpath, _, filenames in os.walk(path) for name in filenames
+                    if not os.path.islink(os.path.join(dirpath, name))])
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
 
 class CacheManager (object):
     """
@@ -51,17 +93,25 @@ class CacheManager (object):
 
     So: checkCache() returns a path to the item (/cache/directory/foo, in this case), and a flag telling
     you if the saved item is valid. The item is considered valid if /cache/directory/foo exists, **and**
-    /cache/directory/foo.hash exists, **and** contains the same value as the supplied "hashvalue". Thus,
-    if hashvalue has changed w.r.t. the stored hash, then the cache is invalid.
+    the cache index (/cache/directory/CacheIndex.json) has an entry for it, **and** the entry's content hash
+    matches a hash of the supplied "hashvalue". Thus, if hashvalue has changed w.r.t. the stored hash,
+    then the cache is invalid.
 
-    Hashvalue may be any Python object supporting the comparison operator (for example, a dict).
-    Typically, this would be a dict of parameters any changes in which should cause the data item
-    to be recomputed.
+    Hashvalue is usually a dict (possibly nested) of the parameters any changes in which should cause the
+    data item to be recomputed. Keep it to the parameters the item actually depends on, since any other
+    parameter in there will needlessly invalidate the cache. Values may be basic Python types, lists, dicts,
+    or numpy arrays (which are hashed by content, e.g. a channel mapping may be used as a key directly).
 
     The saveCache("foo") call is vitally important! The cache manager cannot know by itself when
     you've successfully written to the cache. By calling saveCache(), you're telling it that your data
-    has been safely written to /cache/directory/foo. The cache manager then takes the hashvalue you
-    supplied in the previous checkCache() call, and saves it to /cache/directory/foo.hash.
+    has been safely written to /cache/directory/foo. The cache manager then records the hashvalue you
+    supplied in the previous checkCache() call in the cache index, along with the size of the item.
+
+    The index also records the last access time of each item. If a cap is placed on the total size of
+    caches (--Cache-MaxSize), enforceSizeLimit() evicts the least recently used items. The index is
+    updated under a file lock, so several processes can share a cache directory. Items cached by older
+    versions (with a foo.hash file in place of an index entry) are still recognized, and are moved into
+    the index on first use.
 
 
     # Using cache manager in DDFacet
@@ -160,6 +210,47 @@ class CacheManager (object):
         """
         return "file://" + self.getElementPath(name, **kw)
 
+    def _readIndex(self):
+        """Returns dict of index entries for this cache directory"""
+        return CacheManager._readIndexAt(self.dirname)
+
+    @staticmethod
+    def _readIndexAt(dirname):
+        # the index is replaced atomically, so it can be read without a lock
+        try:
+            return json.load(file(os.path.join(dirname, INDEX_NAME)))
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _updateIndex(self, name, entry=None, **kw):
+        """Updates index entry for element 'name' (under a lock). If entry is given, it replaces the existing
+        entry. Otherwise, the existing entry is updated with the given keywords (and if there is none,
+        nothing is done). An entry of False removes the element from the index."""
+        CacheManager._updateIndexAt(self.dirname, name, entry, **kw)
+
+    @staticmethod
+    def _updateIndexAt(dirname, name, entry=None, **kw):
+        indexpath = os.path.join(dirname, INDEX_NAME)
+        with open(indexpath + ".lock", "a") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                index = json.load(file(indexpath))
+            except (IOError, OSError, ValueError):
+                index = {}
+            if entry is False:
+                if name not in index:
+                    return
+                del index[name]
+            elif entry is not None:
+                index[name] = entry
+            elif name in index:
+                index[name].update(kw)
+            else:
+                return
+            tmppath = "%s.%d" % (indexpath, os.getpid())
+            json.dump(index, file(tmppath, "w"), sort_keys=True)
+            os.rename(tmppath, indexpath)
+
     def checkCache(self, name, hashkeys, directory=False, reset=False, ignore_key=False):
         """
         Checks if cached element named "name" is valid.
@@ -179,10 +270,12 @@ class CacheManager (object):
             and valid is True if a valid cache exists
         """
         cachepath = self.getElementPath(name)
+        # hash files are no longer written, but may be left over from older versions
         hashpath = cachepath + ".hash"
-        # convert hash keys into a single list
-        hash = hashkeys
-        self.hashes[name] = hashpath, hash
+        # convert hash keys into canonical form, and get their content hash
+        hash = _canonicalKeys(hashkeys)
+        digest = _keyDigest(hash)
+        entry = None
         # delete cache if explicitly asked to
         if reset:
             print>>log, "cache element %s will be explicitly reset" % cachepath
@@ -194,20 +287,29 @@ class CacheManager (object):
                 reset = True
             # check for stored hash
             if not reset:
-                try:
-                    storedhash = cPickle.load(file(hashpath))
-                except:
-                    print>>log, "cache hash %s invalid, will re-make" % hashpath
-                    reset = True
+                entry = self._readIndex().get(name)
+                if entry is None:
+                    try:
+                        storedhash = _canonicalKeys(cPickle.load(file(hashpath)))
+                        entry = dict(hash=_keyDigest(storedhash), keys=storedhash, size=_elementSize(cachepath),
+                                     created=os.path.getmtime(hashpath))
+                    except:
+                        print>>log, "cache element %s not in cache index, will re-make" % cachepath
+                        reset = True
+                    else:
+                        print>>log, "moving cache hash %s into cache index" % hashpath
+                        self._updateIndex(name, entry)
+                        os.unlink(hashpath)
             # check for hash match
-            if not reset and not ignore_key and hash != storedhash:
+            if not reset and not ignore_key and digest != entry["hash"]:
+                storedhash = entry["keys"]
                 ListDiffer=[]
                 for MainField, D1 in storedhash.iteritems():
                     if MainField not in hash:
                         ListDiffer.append("(%s: missing in hash)" % (str(MainField)))
                         continue
                     D0 = hash[MainField]
-                    if type(D0) != type(D1):
+                    if type(D0) != type(D1) and not (isinstance(D0, basestring) and isinstance(D1, basestring)):
                         ListDiffer.append("(%s: %s vs %s)" % (str(MainField), type(D0), type(D1)))
                     elif hasattr(D0,'iteritems'):
                         for key, value0 in D0.iteritems():
@@ -226,13 +328,14 @@ class CacheManager (object):
                     ListDiffer.append(
                         "(%s: missing in stored hash)" % (str(MainField)))
 
-                print>>log, "cache hash %s does not match, will re-make" % hashpath
+                print>>log, "cache element %s has different keys, will re-make" % cachepath
                 print>>log, "  differences in parameters (Param: this vs cached): %s"%" & ".join(ListDiffer)
                 
                 reset = True
             # if resetting cache, then mark new hash value for saving (will be saved in flushCache),
             # and remove any existing cache/hash
         if reset:
+            self._updateIndex(name, False)
             if os.path.exists(hashpath):
                 os.unlink(hashpath)
             if os.path.exists(cachepath):
@@ -242,14 +345,16 @@ class CacheManager (object):
                     os.mkdir(cachepath)
                 else:
                     os.unlink(cachepath)
+        else:
+            self._updateIndex(name, atime=time.time())
 
         # store hash
-        self.hashes[name] = hashpath, hash, reset
+        self.hashes[name] = digest, hash, reset
         return cachepath, not reset
 
     def saveCache(self, name=None):
         """
-        Saves cache hash to disk. Meant to be called after a cache object has been successfully written to.
+        Saves cache hash to the index. Meant to be called after a cache object has been successfully written to.
 
         Args:
             name: name of cache object. If None, all accumulated objects are flushed.
@@ -259,8 +364,55 @@ class CacheManager (object):
         """
         names = [name] if name else self.hashes.keys()
         for name in names:
-            hashpath, hash, reset = self.hashes[name]
+            digest, hash, reset = self.hashes[name]
             if reset:
-                cPickle.dump(hash, file(hashpath, "w"))
-                print>>log, "writing cache hash %s" % hashpath
+                now = time.time()
+                size = _elementSize(self.getElementPath(name))
+                self._updateIndex(name, dict(hash=digest, keys=hash, size=size, created=now, atime=now))
+                print>>log, "writing cache index entry for %s (%.1f MB)" % (self.getElementPath(name), size/float(2**20))
                 del self.hashes[name]
+
+    @staticmethod
+    def enforceSizeLimit(dirs, maxsize):
+        """
+        Evicts least recently used cache elements until the total size of caches is within the limit.
+
+        Args:
+            dirs: list of directories containing caches (i.e. *.ddfcache directories). All caches found in there,
+                including those of other MSs, count towards the limit.
+            maxsize: size limit in bytes
+
+        Elements accessed by this process are never evicted. Elements not recorded in a cache index
+        (i.e. made by older versions) are not counted.
+        """
+        elements = []
+        for dirname in set(dirs):
+            if not os.path.isdir(dirname):
+                continue
+            for cachename in os.listdir(dirname):
+                cachedir = os.path.join(dirname, cachename)
+                if not cachename.endswith(".ddfcache") or not os.path.isdir(cachedir):
+                    continue
+                for dirpath, _, filenames in os.walk(cachedir):
+                    if INDEX_NAME in filenames:
+                        index = CacheManager._readIndexAt(dirpath)
+                        elements += [(entry.get("atime", 0), entry.get("size", 0), dirpath, name)
+                                     for name, entry in index.iteritems()]
+        total = sum([size for _, size, _, _ in elements])
+        if total <= maxsize:
+            return
+        print>>log, "caches in %s take up %.2f GB, over the %.2f GB limit" % (", ".join(sorted(set(dirs))),
+                                                                           total/float(2**30), maxsize/float(2**30))
+        nevict = freed = 0
+        for atime, size, dirpath, name in sorted(elements):
+            if total <= maxsize or atime >= _session_start:
+                break
+            CacheManager._updateIndexAt(dirpath, name, False)
+            os.system("rm -fr %s" % os.path.join(dirpath, name))
+            total -= size
+            freed += size
+            nevict += 1
+        print>>log, "evicted %d least recently used cache elements (%.2f GB)" % (nevict, freed/float(2**30))
+        if total > maxsize:
+            print>>log, ModColor.Str("WARNING: caches in use by this run are still over the limit (%.2f GB)" % (
+                total/float(2**30)))
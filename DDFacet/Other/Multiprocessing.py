@@ -65,6 +65,7 @@ def cleanupShm ():
     NpShared.DelAll(getShmPrefix())
     # above statement don't work for directories and subdirectories
     os.system("rm -rf /dev/shm/%s"%getShmPrefix())
+    NpShared.CleanupSpilled()
 
 def cleanupStaleShm ():
     """
@@ -0,0 +1,141 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+"""
+Records the start and end of APP jobs (see AsyncProcessPool._dispatch_job()) and of processing stages in the
+main process, and writes them out as a Chrome trace file, which can be loaded into chrome://tracing or
+https://ui.perfetto.dev. Every process (main and workers) appends its events to its own part file as they
+happen; finalize() merges the parts into the trace file.
+
+Typical use:
+
+    with Tracing.stage("grid", chunk=DATA["label"]):
+        FacetMachine.collectGriddingResults()
+
+or, where wrapping a block is inconvenient:
+
+    t0 = time.time()
+    ...
+    Tracing.recordStage("stitch", t0)
+
+Job handlers can attach extra arguments (facet, chunk, bytes touched...) to the event of the job being run
+by calling Tracing.annotate().
+"""
+
+import os
+import glob
+import json
+import time
+import contextlib
+
+from DDFacet.Other import MyLogger
+log = MyLogger.getLogger("Tracing")
+
+# name of the trace file, or None if tracing is disabled
+_filename = None
+# the name of this process, as it will appear in the trace
+_process_name = "main"
+# part file of this process, and the pid that opened it (a forked process must open its own)
+_part_file = None
+_part_pid = None
+# extra arguments attached to the event of the current job, see annotate()
+_annotations = {}
+
+def enable(filename):
+    """Enables tracing to the given file. Must be called before worker processes are started."""
+    global _filename
+    _filename = filename
+    # remove any leftover parts from a previous run
+    for part in glob.glob(_filename + ".*.part"):
+        os.unlink(part)
+    print>>log, "tracing jobs and processing stages to %s" % _filename
+
+def isEnabled():
+    return _filename is not None
+
+def setProcessName(name):
+    """Sets the name of this process, as it appears in the trace. Called by worker processes on startup."""
+    global _process_name
+    _process_name = name
+
+def _writeEvent(event):
+    global _part_file, _part_pid
+    pid = os.getpid()
+    if _part_pid != pid:
+        # line-buffered, so that events are on disk even if the process is killed
+        _part_file = open("%s.%d.part" % (_filename, pid), "a", 1)
+        _part_pid = pid
+        _part_file.write(json.dumps(dict(name="process_name", ph="M", pid=pid, tid=0,
+                                         args=dict(name="%s (%d)" % (_process_name, pid)))) + "\n")
+    _part_file.write(json.dumps(event) + "\n")
+
+def addEvent(name, category, t0, t1, **args):
+    """Records an event of the given name and category, from time t0 to t1 (as returned by time.time())"""
+    if _filename is None:
+        return
+    _writeEvent(dict(name=name, cat=category, ph="X", pid=os.getpid(), tid=0,
+                     ts=int(t0*1e6), dur=int((t1-t0)*1e6), args=args))
+
+def recordStage(name, t0, **args):
+    """Records a processing stage that started at t0 and ends now"""
+    addEvent(name, "stage", t0, time.time(), **args)
+
+@contextlib.contextmanager
+def stage(name, **args):
+    """Context manager recording a processing stage"""
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        recordStage(name, t0, **args)
+
+def annotate(**args):
+    """Attaches arguments to the event of the job currently being run in this process"""
+    if _filename is not None:
+        _annotations.update(args)
+
+def popAnnotations():
+    """Returns and clears the arguments attached by annotate(). Called by the job dispatcher."""
+    args = _annotations.copy()
+    _annotations.clear()
+    return args
+
+def finalize():
+    """Merges the part files of all processes into the trace file. Called by the main process once the
+    workers have exited."""
+    global _filename, _part_file, _part_pid
+    if _filename is None:
+        return
+    if _part_file is not None:
+        _part_file.close()
+        _part_file = _part_pid = None
+    events = []
+    for part in sorted(glob.glob(_filename + ".*.part")):
+        for line in open(part):
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # a process may have been killed halfway through writing the line
+                pass
+        os.unlink(part)
+    with open(_filename, "w") as outfile:
+        json.dump(dict(traceEvents=events, displayTimeUnit="ms"), outfile)
+    print>>log, "wrote %d trace events to %s" % (len(events), _filename)
+    _filename = None
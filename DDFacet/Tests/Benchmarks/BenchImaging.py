@@ -0,0 +1,433 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2017  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+"""
+Times the imaging hot paths on synthetic data, without a Measurement Set.
+
+    python -m DDFacet.Tests.Benchmarks.BenchImaging [options]
+
+UVW tracks of a random nant-antenna array are generated in memory for ntimes timeslots (MS order, time-major
+and baseline-minor, no autocorrelations), together with nchan channels of random visibilities. We then time:
+
+    bda        the BDA mappings of the gridder and degridder (GiveBlocksRowsListBL, over all baselines)
+    weighting  Briggs imaging weights (ClassVisServer._makeWeightGrid and _computeChunkWeights)
+    grid       BDA gridding onto nfacets facets (_pyGridderSmearPols.pyGridderWPol)
+    degrid     BDA degridding from nfacets facet grids (_pyGridderSmearPols.pyDeGridderWPol)
+    minor      an HMP minor cycle of niter iterations on a synthetic dirty image and PSF
+
+Everything runs in the main process, on a single core, so that the numbers are comparable between machines
+and releases. Convolution functions, model grids and HMP basis functions are set up outside the timed
+sections. The results (seconds, visibilities/s or pixels/s, and the peak RSS of the process so far) are
+written as JSON to stdout, or to the file given by --Output. Note that peak RSS is cumulative, so to get the
+footprint of a single stage, select it alone with --Benchmarks.
+"""
+
+import os
+import sys
+import time
+import json
+import math
+import resource
+import optparse
+import numpy as np
+from DDFacet.Parset import ReadCFG
+from DDFacet.Other import Multiprocessing
+from DDFacet.Array import shared_dict
+
+BENCHMARKS = ["bda", "weighting", "grid", "degrid", "minor"]
+
+def peakRSS():
+    """Returns the peak RSS of this process so far, in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def makeData(nant=62, ntimes=200, nchan=16, dt=10., freq0=120e6, bandwidth=40e6, dec=np.pi/4,
+             radius=20e3, seed=0):
+    """Makes an in-memory DATA dict for a random nant-antenna array observing at declination dec, with
+    ntimes timeslots of dt seconds, and nchan channels spanning bandwidth from freq0."""
+    rng = np.random.RandomState(seed)
+    # antenna positions: a dense core plus a sparse outer array, in equatorial XYZ (metres)
+    r = radius * rng.rand(nant)**2
+    phi = 2 * np.pi * rng.rand(nant)
+    XYZ = np.array([r * np.cos(phi), r * np.sin(phi), 0.1 * r * rng.randn(nant)]).T
+    A0, A1 = np.triu_indices(nant, 1)
+    nbl = A0.size
+    B = XYZ[A1] - XYZ[A0]
+    # +/- ntimes*dt/2 around transit
+    ha = (np.arange(ntimes) - ntimes / 2.) * dt * 2 * np.pi / 86400.
+    sh, ch = np.sin(ha)[:, np.newaxis], np.cos(ha)[:, np.newaxis]
+    sd, cd = np.sin(dec), np.cos(dec)
+    Bx, By, Bz = B[np.newaxis, :, 0], B[np.newaxis, :, 1], B[np.newaxis, :, 2]
+    uvw = np.empty((ntimes, nbl, 3), np.float64)
+    uvw[..., 0] = sh * Bx + ch * By
+    uvw[..., 1] = -sd * ch * Bx + sd * sh * By + cd * Bz
+    uvw[..., 2] = cd * ch * Bx - cd * sh * By + sd * Bz
+    nrows = ntimes * nbl
+    DATA = dict(uvw=uvw.reshape((nrows, 3)),
+                A0=np.tile(A0, ntimes).astype(np.int32),
+                A1=np.tile(A1, ntimes).astype(np.int32),
+                times=np.repeat(np.arange(ntimes, dtype=np.float64) * dt, nbl),
+                freqs=freq0 + (np.arange(nchan) + 0.5) * (bandwidth / nchan),
+                dfreqs=bandwidth / nchan,
+                nant=nant, nbl=nbl, ntimes=ntimes)
+    DATA["data"] = (rng.randn(nrows, nchan, 4) + 1j * rng.randn(nrows, nchan, 4)).astype(np.complex64)
+    DATA["flags"] = np.zeros((nrows, nchan, 4), np.bool8)
+    DATA["Weights"] = np.ones((nrows, nchan), np.float32)
+    return DATA
+
+def makeFacets(npix, nfacets, CellSizeRad):
+    """Lays out nfacets facets on a square grid over an npix image. Returns the facet size, and a list of
+    (lmShift, pixCentral) per facet."""
+    nside = int(math.ceil(math.sqrt(nfacets)))
+    NpixFacet = npix // nside
+    facets = []
+    for iFacet in xrange(nfacets):
+        ix, iy = iFacet % nside, iFacet // nside
+        dx, dy = (ix - (nside - 1) / 2.) * NpixFacet, (iy - (nside - 1) / 2.) * NpixFacet
+        facets.append(((dx * CellSizeRad, dy * CellSizeRad), (int(npix / 2 + dx), int(npix / 2 + dy))))
+    return NpixFacet, facets
+
+def benchBDA(GD, DATA, ChanMapping, NpixFacet, CellSizeRad):
+    """Computes the BDA gridding and degridding mappings (as ClassSmearMapping does, but in the main
+    process), and times them"""
+    from DDFacet.Data.ClassSmearMapping import GiveBlocksRowsListBL
+    # BDA FoV of a facet, as in ClassVisServer._BDAFoV("Facet")
+    l = CellSizeRad * NpixFacet * (np.sqrt(2.) / 2.)
+    stats = {}
+    mappings = {}
+    t00 = time.time()
+    for name, decorr in ("Grid", GD["Comp"]["GridDecorr"]), ("Degrid", GD["Comp"]["DegridDecorr"]):
+        t0 = time.time()
+        # ClassVisServer passes Decorr=1-decorr, and computeSmearMappingInBackground() takes dPhi=sqrt(6*(1-Decorr))
+        dPhi = np.sqrt(6. * decorr)
+        # group rows by baseline, as computeSmearMappingInBackground() does
+        A0, A1 = DATA["A0"], DATA["A1"]
+        blnum = A0.astype(np.int64) * DATA["nant"] + A1
+        rows = np.argsort(blnum, kind="mergesort").astype(np.int32)
+        blnum = blnum[rows]
+        start = np.concatenate(([0], np.where(blnum[1:] != blnum[:-1])[0] + 1))
+        end = np.concatenate((start[1:], [rows.size]))
+        ListBlocksRows = []
+        ListBlocksSizes = []
+        for ibl in xrange(start.size):
+            a0, a1 = A0[rows[start[ibl]]], A1[rows[start[ibl]]]
+            BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, ChanMapping,
+                                                                      row_index=rows[start[ibl]:end[ibl]])
+            if BlocksRowsListBL is not None:
+                ListBlocksRows.append(np.asarray(BlocksRowsListBL, np.int32))
+                ListBlocksSizes.append(np.asarray(BlocksSizesBL, np.int32))
+        # assemble into the flat layout of ClassSmearMapping.collectSmearMapping()
+        sizes = np.concatenate(ListBlocksSizes)
+        blocks = np.concatenate(ListBlocksRows)
+        NTotBlocks = sizes.size
+        mapping = np.empty((2 + NTotBlocks + blocks.size,), np.int32)
+        mapping[0] = NTotBlocks
+        mapping[1] = NTotBlocks >> 32
+        mapping[2:2 + NTotBlocks] = sizes
+        mapping[2 + NTotBlocks:] = blocks
+        mappings[name] = mapping
+        NVis = DATA["uvw"].shape[0] * DATA["freqs"].size
+        stats["%s_seconds" % name.lower()] = time.time() - t0
+        stats["%s_blocks" % name.lower()] = int(NTotBlocks)
+        stats["%s_compression" % name.lower()] = NVis / float(NTotBlocks)
+    stats["seconds"] = time.time() - t00
+    stats["vis_per_sec"] = 2 * DATA["uvw"].shape[0] * DATA["freqs"].size / stats["seconds"]
+    stats["peak_rss_mb"] = peakRSS()
+    return stats, mappings
+
+class BenchMS(object):
+    """Stands in for a ClassMS in benchWeighting(): holds the channel frequencies, and splits the rows
+    into nchunks chunks"""
+    def __init__(self, freqs, nrows, nchunks):
+        self.MSName = "BenchImaging"
+        self.ChanFreq = freqs.reshape((1, freqs.size))
+        edges = np.linspace(0, nrows, nchunks + 1).astype(int)
+        self._chunks = zip(edges[:-1], edges[1:])
+
+    def getChunkRow0Row1(self):
+        return self._chunks
+
+def benchWeighting(GD, DATA, ChanMapping, npix, nbands, CellSizeRad, nchunks=10):
+    """Computes Briggs imaging weights as ClassVisServer does in ConserveMemory mode (chunk histograms,
+    _makeWeightGrid(), then _computeChunkWeights() per chunk), in the main process, and times them"""
+    from DDFacet.Data.ClassVisServer import ClassVisServer
+
+    class BenchVisServer(ClassVisServer):
+        """A VisServer with just the attributes that the weighting code uses, which reads its chunks
+        from DATA rather than from an MS"""
+        def __init__(self):
+            self.GD = GD
+            self.Weighting = "briggs"
+            self.Robust = GD["Weight"]["Robust"]
+            self.Super = GD["Weight"]["SuperUniform"]
+            self.MFSWeighting = GD["Weight"]["MFS"]
+            self.NFreqBands = nbands
+            self.FullImShape = (nbands, 1, npix, npix)
+            self.CellSizeRad = CellSizeRad
+            self.ListMS = [BenchMS(DATA["freqs"], DATA["uvw"].shape[0], nchunks)]
+            self.DicoMSChanMapping = {0: ChanMapping}
+            self.VisWeights = None
+
+        def _readWeights(self, ims, ichunk, wmax_only=False):
+            row0, row1 = self.ListMS[ims].getChunkRow0Row1()[ichunk]
+            uvw = DATA["uvw"][row0:row1]
+            uvmax_wavelengths = abs(uvw[:, :2]).max() * DATA["freqs"].max() / 299792458.
+            weight = DATA["Weights"][row0:row1] * ~DATA["flags"][row0:row1].any(axis=2)
+            return abs(uvw[:, 2]).max(), uvmax_wavelengths, uvw[:, :2], weight
+
+    VS = BenchVisServer()
+    VS._weight_dict = shared_dict.create("BenchImaging.VisWeights")
+    try:
+        cell, nbands = VS._weightGridCell()
+        msweights = VS._weight_dict.addSubdict(0)
+        t00 = t0 = time.time()
+        for ichunk in xrange(nchunks):
+            msw = msweights.addSubdict(ichunk)
+            VS._loadWeights_handler(msw, 0, ichunk, cell=cell, nbands=nbands, keep_weights=False)
+            if "error" in msw:
+                raise msw["error"]
+        stats = dict(histogram_seconds=time.time() - t0)
+        t0 = time.time()
+        VS._makeWeightGrid()
+        stats["grid_seconds"] = time.time() - t0
+        stats["grid_cells"] = int(VS._weight_dict["gridkeys"].size)
+        VS.VisWeights = VS._weight_dict
+        nvis = 0
+        t0 = time.time()
+        for ichunk in xrange(nchunks):
+            nvis += VS._computeChunkWeights(0, ichunk).size
+        stats["apply_seconds"] = time.time() - t0
+        stats["seconds"] = time.time() - t00
+        stats["vis_per_sec"] = nvis / stats["seconds"]
+        stats["peak_rss_mb"] = peakRSS()
+        return stats
+    finally:
+        VS._weight_dict.delete()
+
+def makeGridMachines(GD, DATA, mappings, NpixFacet, facets, nbands, cf_dict, **kw):
+    """Makes a grid machine per facet, computing its convolution functions into cf_dict. Returns the
+    list of machines, and the time taken."""
+    from DDFacet.Imager.ClassDDEGridMachine import ClassDDEGridMachine
+    wmax = np.abs(DATA["uvw"][:, 2]).max()
+    t0 = time.time()
+    machines = [ClassDDEGridMachine(GD, DATA["freqs"], NpixFacet, lmShift, iFacet, NFreqBands=nbands,
+                                    cf_dict=cf_dict.addSubdict(iFacet), compute_cf=True, wmax=wmax,
+                                    bda_grid=mappings["Grid"], bda_degrid=mappings["Degrid"], **kw)
+                for iFacet, (lmShift, _) in enumerate(facets)]
+    return machines, time.time() - t0
+
+def benchGrid(GD, DATA, mappings, ChanMapping, NpixFacet, facets, nbands):
+    cf_dict = shared_dict.create("BenchImaging.CF")
+    try:
+        machines, cf_time = makeGridMachines(GD, DATA, mappings, NpixFacet, facets, nbands, cf_dict)
+        stats = dict(cf_seconds=cf_time, grid_npix=machines[0].GridShape[-1])
+        A0A1 = DATA["A0"], DATA["A1"]
+        t0 = time.time()
+        for GridMachine in machines:
+            Grid = np.zeros(GridMachine.GridShape, np.complex64)
+            GridMachine.put(DATA["times"], DATA["uvw"], DATA["data"], DATA["flags"], A0A1, DATA["Weights"],
+                            DoNormWeights=False, freqs=DATA["freqs"], DoPSF=0, ChanMapping=ChanMapping,
+                            ResidueGrid=Grid)
+            del Grid
+        stats["seconds"] = time.time() - t0
+        stats["vis_per_sec"] = len(machines) * DATA["data"].shape[0] * DATA["data"].shape[1] / stats["seconds"]
+        stats["peak_rss_mb"] = peakRSS()
+        return stats
+    finally:
+        cf_dict.delete()
+
+def benchDegrid(GD, DATA, mappings, ChanMapping, NpixFacet, facets, nbands, nsources=100):
+    import DDFacet.cbuild.Gridder._pyGridderSmearPols as _pyGridderSmear
+    from DDFacet.ToolsDir import ModFFTW
+    from DDFacet.Array import NpShared
+    # the degridder needs a set of named semaphores, as made by ClassFacetMachine
+    semaphores = [Multiprocessing.getShmName("Semaphore", sem=i) for i in xrange(3373)]
+    _pyGridderSmear.pySetSemaphores(semaphores)
+    cf_dict = shared_dict.create("BenchImaging.CF")
+    try:
+        machines, cf_time = makeGridMachines(GD, DATA, mappings, NpixFacet, facets, nbands, cf_dict,
+                                             ListSemaphores=semaphores)
+        stats = dict(cf_seconds=cf_time, grid_npix=machines[0].GridShape[-1])
+        # FFT a model of point sources into a model grid per facet, so that only the degridder is timed
+        rng = np.random.RandomState(1)
+        t0 = time.time()
+        grids = []
+        for GridMachine in machines:
+            _, _, n, _ = GridMachine.GridShape
+            model = np.zeros(GridMachine.GridShape, np.complex64)
+            x0, x1 = GridMachine.PaddingInnerCoord
+            model[:, 0, rng.randint(x0, x1, nsources), rng.randint(x0, x1, nsources)] = rng.rand(nsources)
+            grids.append(np.complex64(ModFFTW.FFTW_2Donly_np(GridMachine.GridShape, np.complex64).fft(model)))
+        stats["fft_seconds"] = time.time() - t0
+        A0A1 = DATA["A0"], DATA["A1"]
+        vis = DATA["data"].copy()
+        t0 = time.time()
+        for GridMachine, Grid in zip(machines, grids):
+            GridMachine.get(DATA["times"], DATA["uvw"], vis, DATA["flags"], A0A1, Grid, ImToGrid=False,
+                            freqs=DATA["freqs"], TranformModelInput="", ChanMapping=ChanMapping)
+        stats["seconds"] = time.time() - t0
+        stats["vis_per_sec"] = len(machines) * vis.shape[0] * vis.shape[1] / stats["seconds"]
+        stats["peak_rss_mb"] = peakRSS()
+        return stats
+    finally:
+        cf_dict.delete()
+        _pyGridderSmear.pyDeleteSemaphore(semaphores)
+        for sem in semaphores:
+            NpShared.DelArray(sem)
+
+def makePSF(npsf, fwhm=3., sidelobe=0.1):
+    """Makes a peak-normalised synthetic PSF: a Gaussian main lobe, with decaying ring sidelobes"""
+    x = np.arange(npsf) - npsf // 2
+    r = np.sqrt(x[:, np.newaxis]**2 + x[np.newaxis, :]**2)
+    psf = np.exp(-r**2 / (2 * (fwhm / 2.3548)**2))
+    psf += sidelobe * np.cos(np.pi * r / fwhm) * np.exp(-r / (npsf / 8.)) * (r > fwhm)
+    psf /= psf[npsf // 2, npsf // 2]
+    return np.float32(psf)
+
+def benchMinorCycle(GD, DATA, npix, NpixFacet, facets, nbands, CellSizeRad, niter=1000, nsources=1000):
+    from scipy.signal import fftconvolve
+    from DDFacet.Imager.ModModelMachine import ClassModModelMachine
+    from DDFacet.Imager.MSMF import ClassImageDeconvMachineMSMF
+    rng = np.random.RandomState(2)
+    nfacets = len(facets)
+    freqs = DATA["freqs"]
+    nchan = freqs.size
+    band_mapping = (np.arange(nchan) * nbands) // nchan
+    band_freqs = [freqs[band_mapping == band] for band in xrange(nbands)]
+    GridFreqs = np.array([f.mean() for f in band_freqs])
+    RefFreq = freqs.mean()
+    # PSF, as cut out by ClassFacetMachine: odd-sized, same for all facets and bands
+    NPSF = NpixFacet + 1 - NpixFacet % 2
+    psf = makePSF(NPSF)
+    PSFCube = np.zeros((nfacets, nbands, 1, NPSF, NPSF), np.float32)
+    PSFCube[...] = psf
+    DicoVariablePSF = {
+        "CubeVariablePSF": PSFCube, "CubeMeanVariablePSF": PSFCube[:, :1],
+        "PeakNormed_CubeVariablePSF": PSFCube, "PeakNormed_CubeMeanVariablePSF": PSFCube[:, :1],
+        "freqs": dict([(band, list(f)) for band, f in enumerate(band_freqs)]),
+        "WeightChansImages": np.ones((nbands, 1), np.float64) / nbands,
+        "SumJonesChan": {0: np.ones((nfacets, 2, nchan), np.float64)},
+        "ChanMappingGrid": {0: band_mapping},
+        "ChanMappingGridChan": {0: np.concatenate([np.arange(f.size) for f in band_freqs])},
+        "MeanJonesBand": [np.ones(nbands, np.float64) for _ in xrange(nfacets)],
+        "Facets": dict([(iFacet, dict(lmSol=lmShift, pixCentral=pixCentral))
+                        for iFacet, (lmShift, pixCentral) in enumerate(facets)]),
+        "CentralFacet": nfacets // 2, "CellSizeRad": CellSizeRad, "OutImShape": (nbands, 1, npix, npix)}
+    # dirty image: power-law sources with a spectral index of -0.7, plus noise
+    x, y = rng.randint(0, npix, nsources), rng.randint(0, npix, nsources)
+    flux = 0.01 * rng.pareto(1.5, nsources)
+    Cube = np.zeros((nbands, 1, npix, npix), np.float32)
+    for band in xrange(nbands):
+        model = np.zeros((npix, npix), np.float32)
+        np.add.at(model, (x, y), flux * (GridFreqs[band] / RefFreq)**-0.7)
+        Cube[band, 0] = fftconvolve(model, psf, mode="same") + 1e-3 * rng.randn(npix, npix)
+    DicoDirty = {"ImageCube": Cube, "MeanImage": Cube.mean(axis=0).reshape((1, 1, npix, npix)),
+                 "WeightChansImages": DicoVariablePSF["WeightChansImages"], "JonesNorm": None}
+
+    GD["Deconv"]["Mode"] = "HMP"
+    ModelMachine = ClassModModelMachine(GD).GiveMM(Mode="HMP")
+    ModelMachine.setRefFreq(RefFreq)
+    # no stopping thresholds, so that exactly niter iterations are done (unless the cycle diverges)
+    DeconvMachine = ClassImageDeconvMachineMSMF.ClassImageDeconvMachine(
+        Gain=GD["Deconv"]["Gain"], MaxMinorIter=niter, NCPU=1, CycleFactor=0, FluxThreshold=0, RMSFactor=0,
+        PeakFactor=0, PrevPeakFactor=0, GD=GD, ModelMachine=ModelMachine, NFreqBands=nbands, RefFreq=RefFreq,
+        ParallelMode=False)
+    # approximation mode: one set of basis functions (from the central facet's PSF), kept in this dict
+    facetcache = shared_dict.create("BenchImaging.HMP")
+    t0 = time.time()
+    DeconvMachine.Init(PSFVar=DicoVariablePSF, PSFAve=(0.1, 5), GridFreqs=GridFreqs, DegridFreqs=GridFreqs,
+                       approx=True, cache=False, facetcache=facetcache)
+    DeconvMachine.Update(DicoDirty)
+    stats = dict(init_seconds=time.time() - t0, npsf=NPSF)
+    t0 = time.time()
+    DeconvMachine.Deconvolve()
+    stats["seconds"] = time.time() - t0
+    stats["iterations"] = DeconvMachine._niter
+    stats["iter_per_sec"] = DeconvMachine._niter / stats["seconds"]
+    # every iteration searches the full dirty image for its peak
+    stats["pixels_per_sec"] = DeconvMachine._niter * float(npix * npix) / stats["seconds"]
+    stats["peak_rss_mb"] = peakRSS()
+    DeconvMachine.Reset()
+    return stats
+
+def main(nant=62, ntimes=200, nchan=16, npix=4096, nfacets=9, nbands=1, cell=None, niter=1000,
+         benchmarks=BENCHMARKS, output=None):
+    GD = ReadCFG.Parset("%s/DefaultParset.cfg" % os.path.dirname(ReadCFG.__file__)).value_dict
+    GD["Parallel"]["NCPU"] = 1
+    GD["RIME"]["ForwardMode"] = "BDA-degrid"
+    GD["RIME"]["DecorrMode"] = ""
+    t0 = time.time()
+    DATA = makeData(nant=nant, ntimes=ntimes, nchan=nchan)
+    # unless given, pick a cell size that samples the longest baseline at the highest frequency
+    if cell is None:
+        uvmax = np.abs(DATA["uvw"][:, :2]).max() * DATA["freqs"].max() / 299792458.
+        cell = (1. / (3 * uvmax)) * 180 / np.pi * 3600
+    GD["Image"]["Cell"] = cell
+    CellSizeRad = (cell / 3600.) * np.pi / 180
+    NpixFacet, facets = makeFacets(npix, nfacets, CellSizeRad)
+    ChanMapping = np.int32((np.arange(nchan) * nbands) // nchan)
+    results = dict(config=dict(nant=nant, ntimes=ntimes, nbl=DATA["nbl"], nrows=DATA["uvw"].shape[0],
+                               nchan=nchan, npix=npix, nfacets=nfacets, npix_facet=NpixFacet, nbands=nbands,
+                               cell_arcsec=cell, niter=niter, data_seconds=time.time() - t0,
+                               data_peak_rss_mb=peakRSS()))
+    try:
+        if set(benchmarks) & set(["bda", "grid", "degrid"]):
+            stats, mappings = benchBDA(GD, DATA, ChanMapping, NpixFacet, CellSizeRad)
+            if "bda" in benchmarks:
+                results["bda"] = stats
+        if "weighting" in benchmarks:
+            results["weighting"] = benchWeighting(GD, DATA, ChanMapping, npix, nbands, CellSizeRad)
+        if "grid" in benchmarks:
+            results["grid"] = benchGrid(GD, DATA, mappings, ChanMapping, NpixFacet, facets, nbands)
+        if "degrid" in benchmarks:
+            results["degrid"] = benchDegrid(GD, DATA, mappings, ChanMapping, NpixFacet, facets, nbands)
+        if "minor" in benchmarks:
+            results["minor"] = benchMinorCycle(GD, DATA, npix, NpixFacet, facets, nbands, CellSizeRad, niter=niter)
+    finally:
+        Multiprocessing.cleanupShm()
+    if output:
+        with open(output, "w") as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+    return results
+
+if __name__ == "__main__":
+    opt = optparse.OptionParser(usage='Usage: %prog <options>', description=__doc__.split("\n\n")[0].strip())
+    opt.add_option('--NAnt', type="int", default=62, help='Number of antennas, default is %default')
+    opt.add_option('--NTimes', type="int", default=200,
+                   help='Number of timeslots, default is %default. There are NAnt*(NAnt-1)/2 rows per timeslot')
+    opt.add_option('--NChan', type="int", default=16, help='Number of channels, default is %default')
+    opt.add_option('--NPix', type="int", default=4096, help='Image size, default is %default')
+    opt.add_option('--NFacets', type="int", default=9, help='Number of facets, default is %default')
+    opt.add_option('--NBands', type="int", default=1, help='Number of imaging bands, default is %default')
+    opt.add_option('--Cell', type="float", default=None,
+                   help='Cell size in arcsec. Default is to sample the longest baseline')
+    opt.add_option('--NIter', type="int", default=1000, help='Number of minor cycle iterations, default is %default')
+    opt.add_option('--Benchmarks', type="str", default=",".join(BENCHMARKS),
+                   help='Comma-separated list of benchmarks to run, default is %default')
+    opt.add_option('--Output', type="str", default=None, help='Write JSON results to this file, default is stdout')
+    options, _ = opt.parse_args()
+    benchmarks = options.Benchmarks.split(",")
+    unknown = set(benchmarks) - set(BENCHMARKS)
+    if unknown:
+        opt.error("unknown benchmark(s) %s" % ",".join(sorted(unknown)))
+    main(nant=options.NAnt, ntimes=options.NTimes, nchan=options.NChan, npix=options.NPix, nfacets=options.NFacets,
+         nbands=options.NBands, cell=options.Cell, niter=options.NIter, benchmarks=benchmarks, output=options.Output)
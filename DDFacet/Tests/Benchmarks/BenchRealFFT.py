@@ -0,0 +1,79 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2017  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+"""
+Times the complex and real-to-complex FFT paths of the facet FFT machines against facet size.
+
+    python -m DDFacet.Tests.Benchmarks.BenchRealFFT [minnpix] [maxnpix] [machine]
+
+For each (odd, fast) facet size from minnpix up to maxnpix, doubling each time, we time the forward FFT of a
+real model image (fft vs fft_real, as used for degridding) and the inverse FFT of a complex grid (ifft vs
+ifft_real, as used to make dirty images and PSFs), and check that the two paths agree. machine is FFTW
+(default) or LAPACK, as in --RIME-FFTMachine. Note that a 16k facet needs ~4GB of RAM.
+"""
+
+import sys
+import time
+import numpy as np
+from DDFacet.ToolsDir import ModFFTW
+from DDFacet.ToolsDir.ModToolBox import GiveClosestFastSize
+
+def timeFFT(npix, machine="FFTW"):
+    if machine == "FFTW":
+        FFTM = ModFFTW.FFTW_2Donly((1, 1, npix, npix), np.complex64, ncores=1)
+    else:
+        FFTM = ModFFTW.FFTW_2Donly_np((1, 1, npix, npix), np.complex64)
+    image = np.random.randn(1, 1, npix, npix).astype(np.float32)
+    stats = dict(npix=npix)
+    # forward FFT of a real image. The complex path FFTs in-place, so give it a fresh copy
+    results = {}
+    for path, make_input in ("fft", lambda: image.astype(np.complex64)), ("fft_real", lambda: image):
+        # run once beforehand, so that planning is not timed
+        getattr(FFTM, path)(make_input())
+        A = make_input()
+        t0 = time.time()
+        results[path] = getattr(FFTM, path)(A)
+        stats[path] = time.time() - t0
+    grid = results["fft"]
+    stats["fft_error"] = abs(grid - results.pop("fft_real")).max() / abs(grid).max()
+    # inverse FFT of a complex grid, in-place
+    for path in "ifft", "ifft_real":
+        getattr(FFTM, path)(grid.copy())
+        A = grid.copy()
+        t0 = time.time()
+        getattr(FFTM, path)(A)
+        stats[path] = time.time() - t0
+        results[path] = A.real
+    stats["ifft_error"] = abs(results["ifft"] - results["ifft_real"]).max() / abs(results["ifft"]).max()
+    return stats
+
+def main(minnpix=2048, maxnpix=16384, machine="FFTW"):
+    npix = minnpix
+    while npix <= maxnpix:
+        stats = timeFFT(GiveClosestFastSize(npix, Odd=True), machine=machine)
+        print "%6d pixels: fft %.3fs fft_real %.3fs (x%.2f)  ifft %.3fs ifft_real %.3fs (x%.2f)  errors %.1e %.1e" % (
+            stats["npix"], stats["fft"], stats["fft_real"], stats["fft"] / stats["fft_real"],
+            stats["ifft"], stats["ifft_real"], stats["ifft"] / stats["ifft_real"],
+            stats["fft_error"], stats["ifft_error"])
+        npix *= 2
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(*(map(int, args[:2]) + args[2:3]))
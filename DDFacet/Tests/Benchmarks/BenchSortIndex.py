@@ -0,0 +1,83 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2017  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+"""
+Times the baseline-time sort of ClassMS.ReadData against chunk row count.
+
+    python -m DDFacet.Tests.Benchmarks.BenchSortIndex [nant] [maxrows]
+
+Rows are laid out in MS order (time-major, baseline-minor) for an array of nant antennas. For each row
+count we time the legacy tuple sort, the lexsort index used by ReadData, and the gather of a
+visibility/flag chunk through the sort index.
+"""
+
+import sys
+import time
+import numpy as np
+from DDFacet.Data.ClassMS import GiveBaselineTimeSortIndex, GatherRows
+
+def makeRows(nrows, nant):
+    A0, A1 = np.triu_indices(nant, 1)
+    nbl = A0.size
+    ntimes = max(nrows // nbl, 1)
+    A0 = np.tile(A0, ntimes)[:nrows].astype(np.int32)
+    A1 = np.tile(A1, ntimes)[:nrows].astype(np.int32)
+    times = np.repeat(np.arange(ntimes, dtype=np.float64) * 10., nbl)[:nrows]
+    return A0, A1, times
+
+def timeSort(nrows, nant=62, nchan=4, ncorr=4, legacy=True):
+    A0, A1, times = makeRows(nrows, nant)
+    nrows = A0.size
+    stats = dict(nrows=nrows)
+    if legacy:
+        t0 = time.time()
+        sortby = sorted(zip(A0, A1, times, range(nrows)))
+        index0 = np.array([s[3] for s in sortby])
+        stats["tuple_sort"] = time.time() - t0
+    t0 = time.time()
+    index = GiveBaselineTimeSortIndex(A0, A1, times)
+    stats["lexsort"] = time.time() - t0
+    if legacy:
+        assert (index == index0).all(), "lexsort index differs from tuple sort"
+
+    vis = np.ones((nrows, nchan, ncorr), np.complex64)
+    flags = np.zeros((nrows, nchan, ncorr), np.bool)
+    visout = np.empty_like(vis)
+    flagout = np.empty_like(flags)
+    t0 = time.time()
+    visout[...] = vis[index]
+    flagout[...] = flags[index]
+    stats["fancy_gather"] = time.time() - t0
+    t0 = time.time()
+    GatherRows(visout, vis, index)
+    GatherRows(flagout, flags, index)
+    stats["take_gather"] = time.time() - t0
+    return stats
+
+def main(nant=62, maxrows=10000000):
+    nrows = 10000
+    while nrows <= maxrows:
+        stats = timeSort(nrows, nant=nant, legacy=(nrows <= 1000000))
+        print "%10d rows: %s" % (stats["nrows"], "  ".join(["%s %.3fs" % (key, stats[key])
+                                   for key in ("tuple_sort", "lexsort", "fancy_gather", "take_gather") if key in stats]))
+        nrows *= 10
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
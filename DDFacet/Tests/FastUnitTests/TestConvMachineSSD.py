@@ -0,0 +1,60 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2017  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+from DDFacet.Imager.SSD.ClassConvMachine import ClassConvMachine
+from DDFacet.Imager.SSD.ClassParamMachine import ClassParamMachine
+
+
+def giveConvMachine(N, NPixPSF, NFreqBands=2, seed=0):
+    """FFT conv machine for an N x N island (every other pixel being a parameter), with a random PSF"""
+    rng = np.random.RandomState(seed)
+    x, y = np.mgrid[100:100+N, 200:200+N]
+    ListPixData = zip(x.ravel().tolist(), y.ravel().tolist())
+    ListPixParms = ListPixData[::2]
+    PSF = rng.randn(NFreqBands, 1, NPixPSF, NPixPSF).astype(np.float32)
+    PM = ClassParamMachine(ListPixParms, ListPixData, {"freqs": [None]*NFreqBands}, SolveParam=["S"])
+    CM = ClassConvMachine(PSF, ListPixParms, ListPixData, "FFT")
+    CM.setParamMachine(PM)
+    return CM, rng
+
+def testConvolvePopFFT():
+    # odd island sizes (including ones whose closest fast FFT size is below 2N-1), with PSFs both larger and smaller than the padded island
+    for N in range(1, 102, 2):
+        for NPixPSF in (2*N+101, N/2*2+1):
+            CM, rng = giveConvMachine(N, NPixPSF)
+            Pop = rng.randn(2, CM.NFreqBands, CM.NPixListParms).astype(np.float32)
+            for OutMode in ("Data", "Parms"):
+                ConvPop = CM.ConvolvePop(Pop, OutMode=OutMode)
+                for iIndiv in range(Pop.shape[0]):
+                    Ref = CM.ConvolveFFT(Pop[iIndiv], OutMode=OutMode)
+                    assert ConvPop[iIndiv].shape == Ref.shape
+                    Err = np.abs(ConvPop[iIndiv]-Ref).max()/np.abs(Ref).max()
+                    assert Err < 1e-4, "N=%d NPixPSF=%d %s: relative error %g" % (N, NPixPSF, OutMode, Err)
+
+def testConvolvePopBatches():
+    # the population is split into several FFT batches
+    CM, rng = giveConvMachine(47, 195)
+    CM.FFTConvBatchBytes = 2*CM.NFreqBands*128**2*4
+    Pop = rng.randn(7, CM.NFreqBands, CM.NPixListParms).astype(np.float32)
+    ConvPop = CM.ConvolvePop(Pop)
+    for iIndiv in range(Pop.shape[0]):
+        Ref = CM.ConvolveFFT(Pop[iIndiv])
+        assert np.abs(ConvPop[iIndiv]-Ref).max()/np.abs(Ref).max() < 1e-4
@@ -0,0 +1,71 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2017  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import multiprocessing
+import numpy as np
+from DDFacet.Other.AsyncProcessPool import AsyncProcessPool, JOB_RING_SIZE
+from DDFacet.Array import shared_dict
+
+
+class ArrayState(object):
+    """Stands in for the APP SharedDict, with plain arrays: enough to put and get jobs in one process"""
+    def addSharedArray(self, name, shape, dtype):
+        return np.zeros(shape, dtype)
+
+def handlerFunction(*args):
+    pass
+
+class HandlerObject(object):
+    def method(self, *args):
+        pass
+
+def giveRingPool():
+    pool = AsyncProcessPool()
+    handler = HandlerObject()
+    pool.registerJobHandlers(handlerFunction, handler)
+    pool._compute_tickets = multiprocessing.Semaphore(0)
+    pool._job_ring_free = multiprocessing.Semaphore(JOB_RING_SIZE)
+    pool._job_ring_lock = multiprocessing.Lock()
+    pool._initJobRing(ArrayState())
+    return pool, handler
+
+def roundTrip(pool, handler_id, method, args):
+    jobitem = dict(job_id="job:0", handler=(handler_id, method, "handler"), event=None, counter=None,
+                   collect_result=True, args=args, kwargs={}, enqueue_time=1.5)
+    assert pool._putJobRing(jobitem)
+    job = pool._getComputeJob(1)
+    assert job["job_id"] == "job:0"
+    assert job["handler"][:2] == (handler_id, method)
+    assert job["collect_result"] and job["enqueue_time"] == 1.5
+    return job["args"]
+
+def testJobRingFunctionHandlers():
+    pool, _ = giveRingPool()
+    for args in [(), (None,), (1, 2.5, True, None), ("",), ("a", ""), (3, "", "", None), ("", 1, "b")]:
+        out = roundTrip(pool, id(handlerFunction), None, args)
+        assert tuple(out) == args, (args, out)
+        assert [type(x) for x in out] == [type(x) for x in args]
+
+def testJobRingMethodHandlers():
+    pool, handler = giveRingPool()
+    args = (shared_dict.SharedDictRepresentation("dict", readwrite=True, load=False), "", 7)
+    out = roundTrip(pool, id(handler), "method", args)
+    assert out[0].path == "dict" and out[0].readwrite and not out[0].load
+    assert out[1:] == ["", 7]
@@ -0,0 +1,99 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2017  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+from DDFacet.Array.NpParallel import WhereMaxIndex
+
+
+def giveImage(nx=200, ny=150, seed=0):
+    """A noise image of odd tile counts, with a few bright sources"""
+    rng = np.random.RandomState(seed)
+    A = np.float32(rng.randn(1, nx, ny))
+    for x, y, flux in (20, 30, 50.), (25, 34, 40.), (150, 100, -45.), (190, 10, 30.), (100, 140, 20.):
+        A[0, x, y] = flux
+    return A
+
+def checkPeaks(Index, Peaks, Threshold, MinSeparation, MaxPeaks):
+    assert 1 <= len(Peaks) <= MaxPeaks
+    # the first peak is the one whereMax() returns, the others are above Threshold, in decreasing order
+    assert Peaks[0] == Index.whereMax()
+    Vals = [v for _, _, v in Peaks]
+    assert all(v >= Threshold for v in Vals[1:])
+    assert Vals == sorted(Vals, reverse=True)
+    for i, (x, y, v) in enumerate(Peaks):
+        assert v == Index._give(0, x, x+1, y, y+1)[0, 0]
+        for xp, yp, _ in Peaks[:i]:
+            assert abs(x-xp) >= MinSeparation or abs(y-yp) >= MinSeparation
+
+def testWherePeaksKnownSources():
+    A = giveImage()
+    Index = WhereMaxIndex(A, DoAbs=1, TileSize=16)
+    Peaks = Index.wherePeaks(10., 8, 10)
+    checkPeaks(Index, Peaks, 10., 8, 10)
+    # (25,34) is within 8 pixels of the brighter (20,30) along both axes, so it is left out
+    assert [(x, y) for x, y, _ in Peaks] == [(20, 30), (150, 100), (190, 10), (100, 140)]
+    assert [v for _, _, v in Peaks] == [50., 45., 30., 20.]
+    # with a smaller separation, it comes back
+    Peaks = Index.wherePeaks(10., 4, 10)
+    assert [(x, y) for x, y, _ in Peaks] == [(20, 30), (150, 100), (25, 34), (190, 10), (100, 140)]
+
+def testWherePeaksThreshold():
+    A = giveImage()
+    Index = WhereMaxIndex(A, DoAbs=1, TileSize=16)
+    for Threshold in 0., 3., 25., 35., 100.:
+        checkPeaks(Index, Index.wherePeaks(Threshold, 8, 1000), Threshold, 8, 1000)
+    assert [v for _, _, v in Index.wherePeaks(35., 8, 10)] == [50., 45.]
+    # the first peak is always returned, even if below Threshold
+    assert Index.wherePeaks(100., 8, 10) == [Index.whereMax()]
+
+def testWherePeaksMaxPeaks():
+    A = giveImage()
+    Index = WhereMaxIndex(A, DoAbs=1, TileSize=16)
+    assert Index.wherePeaks(0., 1, 1) == [Index.whereMax()]
+    for MaxPeaks in 2, 3, 7, 50:
+        Peaks = Index.wherePeaks(0., 3, MaxPeaks)
+        assert len(Peaks) == MaxPeaks
+        checkPeaks(Index, Peaks, 0., 3, MaxPeaks)
+    assert [(x, y) for x, y, _ in Index.wherePeaks(10., 8, 3)] == [(20, 30), (150, 100), (190, 10)]
+
+def testWherePeaksMinSeparation():
+    A = giveImage(seed=1)
+    Index = WhereMaxIndex(A, DoAbs=1, TileSize=8)
+    for MinSeparation in 1, 5, 17, 40, 300:
+        checkPeaks(Index, Index.wherePeaks(1., MinSeparation, 1000), 1., MinSeparation, 1000)
+    # no other peak can be far enough from the first
+    assert Index.wherePeaks(1., 300, 1000) == [Index.whereMax()]
+
+def testWherePeaksFirstIsWhereMax():
+    rng = np.random.RandomState(2)
+    for DoAbs in 0, 1:
+        A = np.float32(rng.randn(1, 130, 97))
+        Mask = rng.rand(1, 130, 97) > 0.7
+        Index = WhereMaxIndex(A, DoAbs=DoAbs, Mask=Mask, TileSize=16)
+        # change the image in place, as the minor cycle does, and check the first peak against the full image
+        for i in xrange(20):
+            Peaks = Index.wherePeaks(2., 5, 10)
+            checkPeaks(Index, Peaks, 2., 5, 10)
+            B = np.where(Mask, -np.inf, np.abs(A) if DoAbs else A)
+            x, y = np.unravel_index(np.argmax(B[0]), B[0].shape)
+            assert Peaks[0] == (x, y, B[0, x, y])
+            x0, y0 = rng.randint(-5, 130), rng.randint(-5, 97)
+            A[0, max(x0, 0):x0+11, max(y0, 0):y0+11] -= 3 * rng.rand()
+            Index.update(x0, x0+11, y0, y0+11)
@@ -18,7 +18,15 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
+import os
+import socket
+import fcntl
+import cPickle
+import contextlib
 import scipy
+import scipy.ndimage
+import collections
+import cpuinfo
 
 import numpy as np
 import pyfftw
@@ -136,6 +144,220 @@ NCPU_global = 0#psutil.cpu_count()
 def GiveFFTW_aligned(shape, dtype):
     return pyfftw.n_byte_align_empty( shape[-2::], 16, dtype=dtype)
 
+# Real-valued images have Hermitian-symmetric spectra, so only the non-negative frequencies along the last
+# axis need to be computed (rfft2), which takes about half the time of a complex FFT. The helpers below
+# convert between these half spectra and the full, centred (fftshifted) grids used by the (de)gridders. They
+# read and write the FFT work arrays and the grids through strided views, with the shifts folded in, so that
+# no temporary copies are made.
+
+def _scatterHermitian(F, R):
+    """Given the rfft2 R (n x n//2+1) of a real n x n image, writes its full centred (fftshifted) spectrum into
+    the n x n array F"""
+    n = F.shape[0]
+    s, m = n//2, n//2 + 1
+    # non-negative frequencies: Fs(F)[k1,k2] = R[k1,k2] goes to [k1+s,k2+s] (mod n)
+    p = min(m, n - s)
+    _rollInto(F[:, s:s+p], R[:, :p], s, 0)
+    if m > p:
+        _rollInto(F[:, :m-p], R[:, p:m], s, 0)
+    # negative frequencies: F[k1,k2] = conj(R[-k1,-k2]), which land in columns c0..s-1 of the centred grid
+    c0 = m + s - n
+    np.conjugate(R[s::-1, s-c0:0:-1], out=F[:s+1, c0:s])
+    np.conjugate(R[n-1:s:-1, s-c0:0:-1], out=F[s+1:, c0:s])
+
+def _gatherHermitian(H, G):
+    """Given a centred n x n spectrum G, writes into the n x n//2+1 array H the non-negative frequency half
+    (as expected by irfft2) of twice the Hermitian part of iFs(G), i.e. of the spectrum of twice the real part
+    of the inverse FFT of G"""
+    n = G.shape[0]
+    s, m = n//2, n//2 + 1
+    # conj(iFs(G)[-k1,-k2]) = conj(G[s-k1,s-k2])
+    np.conjugate(G[s::-1, s::-1], out=H[:s+1])
+    np.conjugate(G[n-1:s:-1, s::-1], out=H[s+1:])
+    # iFs(G)[k1,k2] = G[k1+s,k2+s] (mod n)
+    p = min(m, n - s)
+    for H1, G1 in (H[:, :p], G[:, s:s+p]), (H[:, p:m], G[:, :m-p]):
+        np.add(H1[:n-s], G1[s:], out=H1[:n-s])
+        np.add(H1[n-s:], G1[:s], out=H1[n-s:])
+
+# FFTW plans for the facet FFTs are made once per (shape, type, direction) in each process, and kept for the
+# lifetime of the process. Plans of both directions share work arrays. The cache is LRU, bounded by the
+# size in bytes of the work arrays. Since every process has its own cache, the bound is set per process from
+# --Cache-MaxSizeFFTWPlans (see setPlanCacheSize()). Plans whose work arrays exceed the bound are not cached.
+FFTW_PLANNER_EFFORT = 'FFTW_MEASURE'
+FFTW_PLAN_CACHE_SIZE = 2**30
+_fftw_plans = collections.OrderedDict()
+_fftw_plans_bytes = 0
+
+def _makeFFTWArrays(shape, dtype, family):
+    """Makes the work arrays for 2D transforms of the given shape and complex type: a complex array for
+    in-place "c2c" transforms, or a real array and a half-spectrum complex array for "r2c" transforms"""
+    ctype = np.dtype(dtype)
+    rtype = np.float64 if ctype == np.complex128 else np.float32
+    if family == "c2c":
+        return pyfftw.n_byte_align_empty(shape, pyfftw.simd_alignment, dtype=ctype),
+    return (pyfftw.n_byte_align_empty(shape, pyfftw.simd_alignment, dtype=rtype),
+            pyfftw.n_byte_align_empty(tuple(shape[:-1]) + (shape[-1]//2+1,), pyfftw.simd_alignment, dtype=ctype))
+
+def _makeFFTWPlan(arrays, kind, threads=1):
+    """Plans a transform over the last two axes of the work arrays. kind is "fft" or "ifft" (in-place
+    complex transforms), "rfft" or "irfft". Transforms are not normalised."""
+    flags = (FFTW_PLANNER_EFFORT, 'FFTW_DESTROY_INPUT')
+    axes = (-2, -1)
+    if kind in ("fft", "ifft"):
+        a, = arrays
+        return pyfftw.FFTW(a, a, axes=axes, direction='FFTW_FORWARD' if kind == "fft" else 'FFTW_BACKWARD',
+                           flags=flags, threads=threads)
+    r, c = arrays
+    if kind == "rfft":
+        return pyfftw.FFTW(r, c, axes=axes, direction='FFTW_FORWARD', flags=flags, threads=threads)
+    return pyfftw.FFTW(c, r, axes=axes, direction='FFTW_BACKWARD', flags=flags, threads=threads)
+
+def setPlanCacheSize(total_size, nprocs):
+    """Sets the bound of the per-process plan cache, so that nprocs processes hold at most total_size bytes
+    of plan work arrays between them"""
+    global FFTW_PLAN_CACHE_SIZE
+    FFTW_PLAN_CACHE_SIZE = int(total_size/max(nprocs, 1))
+
+def _giveFFTWPlans(shape, dtype, kinds, threads=1):
+    """Returns a list of plans (see _makeFFTWPlan()) of the given kinds, all of the same family, from the plan
+    cache, making them if needed. The plans share their work arrays. shape is that of the full (not half-spectrum)
+    grid, dtype the complex type."""
+    global _fftw_plans_bytes
+    family = "c2c" if kinds[0] in ("fft", "ifft") else "r2c"
+    key = tuple(shape), np.dtype(dtype).name, family, threads
+    plans = _fftw_plans.pop(key, None)
+    if plans is None:
+        arrays = _makeFFTWArrays(shape, dtype, family)
+        nbytes = sum([a.nbytes for a in arrays])
+        plans = dict(arrays=arrays, nbytes=nbytes)
+        if nbytes <= FFTW_PLAN_CACHE_SIZE:
+            while _fftw_plans and _fftw_plans_bytes + nbytes > FFTW_PLAN_CACHE_SIZE:
+                _, old = _fftw_plans.popitem(last=False)
+                _fftw_plans_bytes -= old["nbytes"]
+            _fftw_plans_bytes += nbytes
+            # (re)inserted as most recently used below
+            plans["cached"] = True
+    if plans.get("cached"):
+        _fftw_plans[key] = plans
+    for kind in kinds:
+        if kind not in plans:
+            plans[kind] = _makeFFTWPlan(plans["arrays"], kind, threads)
+    return [plans[kind] for kind in kinds]
+
+def _giveFFTWPlan(shape, dtype, kind, threads=1):
+    """Returns a single plan, as _giveFFTWPlans()"""
+    return _giveFFTWPlans(shape, dtype, (kind,), threads)[0]
+
+def _rollInto(dest, src, k0, k1):
+    """dest[...] = np.roll(np.roll(src, k0, axis=0), k1, axis=1) for 2D arrays, without temporaries"""
+    n0, n1 = src.shape
+    k0 %= n0
+    k1 %= n1
+    dest[k0:, k1:] = src[:n0-k0, :n1-k1]
+    dest[k0:, :k1] = src[:n0-k0, n1-k1:]
+    dest[:k0, k1:] = src[n0-k0:, :n1-k1]
+    dest[:k0, :k1] = src[n0-k0:, n1-k1:]
+
+# FFTW wisdom is stored in one file per CPU type, under a directory (--Cache-DirWisdomFFTW) that may be
+# shared between the nodes of a cluster, so that identical nodes pay the cost of planning only once.
+# Accesses to the file are serialised with POSIX locks on a lock file, which also work over NFS.
+# Wisdom types are recorded as (npix, dtype name, kind) tuples, kind being as in _makeFFTWPlan().
+
+# wisdom files imported into this process, with their modification times when imported
+_wisdom_imported = {}
+# wisdom files that were reset by this process
+_wisdom_reset = set()
+_cpu_name = None
+
+def giveWisdomFile(dirname):
+    """Returns the name of the wisdom file for this type of CPU under the given directory"""
+    global _cpu_name
+    if _cpu_name is None:
+        # this is slow, so only do it once per process
+        _cpu_name = cpuinfo.get_cpu_info()["brand"].replace(" ", "")
+    return os.path.join(os.path.expanduser(dirname), _cpu_name, "Wisdom.pickle")
+
+@contextlib.contextmanager
+def _lockWisdomFile(filename, exclusive=False):
+    lockfile = open(filename + ".lock", "a+")
+    try:
+        fcntl.lockf(lockfile, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        lockfile.close()
+
+def _readWisdomFile(filename):
+    if os.path.isfile(filename):
+        try:
+            return cPickle.load(open(filename, "rb"))
+        except Exception, exc:
+            print>>log, "can't read wisdom file %s (%s), ignoring" % (filename, exc)
+    return {"Wisdom": None, "WisdomTypes": []}
+
+def loadWisdom(filename):
+    """Imports the wisdom file into this process, if it exists and has changed since it was last imported.
+    Called by worker processes before planning facet FFTs."""
+    if not os.path.isfile(filename) or _wisdom_imported.get(filename) == os.path.getmtime(filename):
+        return
+    with _lockWisdomFile(filename):
+        mtime = os.path.getmtime(filename)
+        DictWisdom = _readWisdomFile(filename)
+    if DictWisdom["Wisdom"] is not None:
+        pyfftw.import_wisdom(DictWisdom["Wisdom"])
+    _wisdom_imported[filename] = mtime
+
+def learnWisdom(filename, types, reset=False):
+    """Makes sure the wisdom file holds wisdom for the given (npix, dtype, kind) types, planning any that
+    are missing, and imports it into this process. If reset is True, all types are planned again (once
+    per process)."""
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        print>>log, "Wisdom directory %s does not exist, create it" % dirname
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # another process may have just created it
+            if not os.path.isdir(dirname):
+                raise
+    reset = reset and filename not in _wisdom_reset
+    types = [(int(npix), np.dtype(dtype).name, kind) for npix, dtype, kind in types]
+    with _lockWisdomFile(filename):
+        DictWisdom = _readWisdomFile(filename)
+    if reset or [key for key in types if key not in DictWisdom["WisdomTypes"]]:
+        with _lockWisdomFile(filename, exclusive=True):
+            # re-read, since another process may have updated the file while we were waiting for the lock
+            DictWisdom = {"Wisdom": None, "WisdomTypes": []} if reset else _readWisdomFile(filename)
+            if DictWisdom["Wisdom"] is not None:
+                pyfftw.import_wisdom(DictWisdom["Wisdom"])
+            WisdomTypes = list(DictWisdom["WisdomTypes"])
+            nwisdom = len(WisdomTypes)
+            for key in types:
+                if key not in WisdomTypes:
+                    npix, dtype, kind = key
+                    print>>log, "  Computing fftw wisdom (%s) for shape [%i x %i] and dtype %s" % (kind, npix, npix, dtype)
+                    if kind == "interfaces":
+                        learnFFTWWisdom(npix, getattr(np, dtype))
+                    else:
+                        family = "c2c" if kind in ("fft", "ifft") else "r2c"
+                        _makeFFTWPlan(_makeFFTWArrays((npix, npix), dtype, family), kind)
+                    WisdomTypes.append(key)
+            if reset or len(WisdomTypes) > nwisdom:
+                DictWisdom = {"Wisdom": pyfftw.export_wisdom(), "WisdomTypes": WisdomTypes}
+                print>>log, "Saving wisdom file to %s" % filename
+                # write to a temporary file and rename it, so that readers never see a partial file
+                tmpname = "%s.%s.%d" % (filename, socket.gethostname(), os.getpid())
+                cPickle.dump(DictWisdom, open(tmpname, "wb"), 2)
+                os.rename(tmpname, filename)
+        if reset:
+            _wisdom_reset.add(filename)
+    else:
+        print>>log, "Loading wisdom file %s" % filename
+        if DictWisdom["Wisdom"] is not None:
+            pyfftw.import_wisdom(DictWisdom["Wisdom"])
+    if os.path.isfile(filename):
+        _wisdom_imported[filename] = os.path.getmtime(filename)
+
 # FFTW version of the FFT engine
 class FFTW_2Donly():
     def __init__(self, shape, dtype, norm=True, ncores=1, FromSharedId=None):
@@ -160,7 +382,6 @@ class FFTW_2Donly():
         self.norm = norm
 
     def fft(self, Ain):
-        axes=(-1,-2)
 
         T= ClassTimeIt.ClassTimeIt("ModFFTW")
         T.disable()
@@ -172,14 +393,16 @@ class FFTW_2Donly():
         else:
             A=Ain
 
-        nch,npol,_,_=A.shape
+        nch,npol,n0,n1=A.shape
+        plan = _giveFFTWPlan((n0,n1), self.ThisType, "fft", self.ncores)
         for ich in range(nch):
             for ipol in range(npol):
-                A_2D = iFs(A[ich,ipol].astype(self.ThisType),axes=axes)
+                # iFs into the work array, FFT, and Fs back out
+                _rollInto(plan.input_array, A[ich,ipol], -(n0//2), -(n1//2))
                 T.timeit("shift and copy")
-                A_2D[...] = pyfftw.interfaces.numpy_fft.fft2(A_2D, axes=(-1,-2),overwrite_input=True, planner_effort='FFTW_MEASURE', threads=self.ncores)
+                plan.execute()
                 T.timeit("fft")
-                A[ich,ipol]=Fs(A_2D,axes=axes)
+                _rollInto(A[ich,ipol], plan.output_array, n0//2, n1//2)
                 T.timeit("shift")
         if self.norm:
             A /= (A.shape[-1] * A.shape[-2])
@@ -187,20 +410,58 @@ class FFTW_2Donly():
         return A.reshape(sin)
 
     def ifft(self, A, norm=True):
-        axes=(-1,-2)
         sin=A.shape
         if len(A.shape)==2:
             s=(1,1,A.shape[0],A.shape[1])
             A=A.reshape(s)
         #log=MyLogger.getLogger("ModToolBox.FFTM2.ifft")
-        nch,npol,_, _ = A.shape
+        nch,npol,n0,n1 = A.shape
+        plan = _giveFFTWPlan((n0,n1), self.ThisType, "ifft", self.ncores)
         for ich in range(nch):
             for ipol in range(npol):
-                A_2D = iFs(A[ich,ipol].astype(self.ThisType),axes=axes)
-                A_2D[...] = pyfftw.interfaces.numpy_fft.ifft2(A_2D, axes=(-1,-2),overwrite_input=True, planner_effort='FFTW_MEASURE', threads=self.ncores)
-                A[ich,ipol]=Fs(A_2D,axes=axes)
-        if self.norm:
-            A *= (A.shape[-1] * A.shape[-2])
+                _rollInto(plan.input_array, A[ich,ipol], -(n0//2), -(n1//2))
+                plan.execute()
+                _rollInto(A[ich,ipol], plan.output_array, n0//2, n1//2)
+        # FFTW's inverse transform is not normalised
+        if not self.norm:
+            A /= (n0 * n1)
+        return A.reshape(sin)
+
+    def fft_real(self, Ain):
+        """Like fft(), for real-valued images (or the real parts of complex images). Returns a new complex array
+        of type self.ThisType."""
+        sin = Ain.shape
+        A = Ain.reshape((1,1) + sin) if len(sin) == 2 else Ain
+        nch, npol, n, _ = A.shape
+        plan = _giveFFTWPlan((n,n), self.ThisType, "rfft", self.ncores)
+        out = np.empty(A.shape, self.ThisType)
+        for ich in range(nch):
+            for ipol in range(npol):
+                # iFs into the work array, FFT, and expand the half spectrum into the centred output
+                _rollInto(plan.input_array, A[ich,ipol].real, -(n//2), -(n//2))
+                plan.execute()
+                R = plan.output_array
+                if self.norm:
+                    R *= 1./(n * n)
+                _scatterHermitian(out[ich,ipol], R)
+        return out.reshape(sin)
+
+    def ifft_real(self, A):
+        """Like ifft() (in-place), when only the real part of the result is needed"""
+        sin = A.shape
+        if len(sin) == 2:
+            A = A.reshape((1,1) + sin)
+        nch, npol, n, _ = A.shape
+        plan = _giveFFTWPlan((n,n), self.ThisType, "irfft", self.ncores)
+        # _gatherHermitian() gives twice the Hermitian part, and FFTW's inverse transform is not normalised
+        scale = 0.5 if self.norm else 0.5/(n * n)
+        for ich in range(nch):
+            for ipol in range(npol):
+                H = plan.input_array
+                _gatherHermitian(H, A[ich,ipol])
+                H *= scale
+                plan.execute()
+                _rollInto(A[ich,ipol], plan.output_array, n//2, n//2)
         return A.reshape(sin)
 
 # LAPACK (or ATLAS???) version of the FFT engine
@@ -252,6 +513,30 @@ class FFTW_2Donly_np():
 
         return A
 
+    def fft_real(self,A,ChanList=None):
+        """Like fft(), for real-valued images. Returns a new complex array (channels not in ChanList are
+        copied over from A)."""
+        ThisType = np.complex128 if A.dtype in (np.float64, np.complex128) else np.complex64
+        nch,npol,n,_=A.shape
+        out = A.astype(ThisType) if ChanList is not None else np.empty(A.shape, ThisType)
+        for ich in (range(nch) if ChanList is None else ChanList):
+            for ipol in range(npol):
+                R = np.fft.rfft2(iFs(A[ich,ipol].real))
+                R /= (n * n)
+                _scatterHermitian(out[ich,ipol], R)
+        return out
+
+    def ifft_real(self,A,ChanList=None):
+        """Like ifft() (in-place), when only the real part of the result is needed"""
+        nch,npol,n,_=A.shape
+        H = np.empty((n, n//2+1), np.complex128)
+        for ich in (range(nch) if ChanList is None else ChanList):
+            for ipol in range(npol):
+                _gatherHermitian(H, A[ich,ipol])
+                # _gatherHermitian() gives twice the Hermitian part
+                A[ich,ipol] = Fs(np.fft.irfft2(H, s=(n, n)) * (0.5 * n * n))
+        return A
+
 
 _give_gauss_grid_key = None,None
 _give_gauss_grid_cache = None,None
@@ -356,6 +641,125 @@ def learnFFTWWisdom(npix,dtype=np.float32):
         a = pyfftw.interfaces.numpy_fft.fft2(test, overwrite_input=True, threads=1)
         b = pyfftw.interfaces.numpy_fft.ifft2(a, overwrite_input=True, threads=1)
 
+# Fourier-transformed Gaussian kernels are cached per process, since the same restoring beam convolutions
+# (model images, cubes, noise maps, facet spatial weights) are done over and over on images of the same size.
+# The cache is LRU, bounded by size in bytes; kernels bigger than the bound are simply not cached.
+GAUSS_KERNEL_CACHE_SIZE = 2**30
+_gauss_kernel_cache = collections.OrderedDict()
+_gauss_kernel_cache_bytes = 0
+
+# at most this many bytes of padded images (plus their transforms) are put through one batched FFT
+GAUSS_FFT_BATCH_SIZE = 2**28
+
+# separable Gaussians narrower than this many pixels can be convolved directly rather than via FFTs
+GAUSS_DIRECT_MAX_SUPPORT = 31
+# the direct convolution kernel is truncated this many sigmas away from the centre
+GAUSS_DIRECT_NSIGMA = 5
+
+def _givePadEdge(npix):
+    """Returns the number of pixels of padding needed to avoid spectral leakage when convolving npix images"""
+    return max(int(np.ceil((ModToolBox.EstimateNpix(npix)[1] - npix) / 2.0) * 2), 0)
+
+def _givePaddedGauss(npix, pad_edge, CellSizeRad, GaussPars, Normalise=False):
+    p = pad_edge//2
+    PSF = np.pad(GiveGauss(npix, CellSizeRad, GaussPars, parallel=True), ((p,p),(p,p)), mode="constant")
+    if Normalise:
+        PSF /= np.sum(PSF)
+    return PSF
+
+def _giveGaussKernelFT(npix, pad_edge, CellSizeRad, GaussPars, Normalise=False, nthreads=1):
+    """Returns the (real, since the Gaussian is centred) rfft2 of an npix Gaussian padded by pad_edge pixels.
+    Transforms are looked up in, and added to, the kernel cache."""
+    global _gauss_kernel_cache_bytes
+    key = npix, pad_edge, float(CellSizeRad), tuple(map(float, GaussPars)), bool(Normalise)
+    fPSF = _gauss_kernel_cache.pop(key, None)
+    if fPSF is None:
+        PSF = _givePaddedGauss(npix, pad_edge, CellSizeRad, GaussPars, Normalise)
+        fPSF = np.abs(pyfftw.interfaces.numpy_fft.rfft2(iFs(PSF), overwrite_input=True, threads=nthreads))
+        if fPSF.nbytes > GAUSS_KERNEL_CACHE_SIZE:
+            return fPSF
+        _gauss_kernel_cache_bytes += fPSF.nbytes
+        while _gauss_kernel_cache_bytes > GAUSS_KERNEL_CACHE_SIZE:
+            _, old = _gauss_kernel_cache.popitem(last=False)
+            _gauss_kernel_cache_bytes -= old.nbytes
+    # (re)insert as most recently used
+    _gauss_kernel_cache[key] = fPSF
+    return fPSF
+
+def _giveSeparableGaussKernels(npix, CellSizeRad, GaussPars, Normalise=False):
+    """If the Gaussian is separable along the image axes (i.e. circular, or aligned with the axes) and
+    narrow enough, returns its 1D kernels along axes 0 and 1, sampled as GiveGauss() does. Else returns None."""
+    SigMaj, SigMin, ang = GaussPars
+    # see GiveGauss(): exp(-(a*x**2+2*b*x*y+c*y**2))
+    ang = 2*np.pi - ang
+    CT, ST, S2T = np.cos(ang), np.sin(ang), np.sin(2*ang)
+    sx2, sy2 = SigMaj**2, SigMin**2
+    if not sx2 or not sy2:
+        return None
+    a = (CT**2/(2.*sx2))+(ST**2/(2.*sy2))
+    b = -(S2T/(4.*sx2))+(S2T/(4.*sy2))
+    c = (ST**2/(2.*sx2))+(CT**2/(2.*sy2))
+    if abs(b) > 1e-6*max(a, c):
+        return None
+    # pixel spacing of the GiveGauss() grid
+    dx = npix*CellSizeRad/(npix-1.)
+    kernels = []
+    for coeff in a, c:
+        half = int(np.ceil(GAUSS_DIRECT_NSIGMA/np.sqrt(2*coeff)/dx))
+        if 2*half+1 > GAUSS_DIRECT_MAX_SUPPORT or 2*half+1 > npix:
+            return None
+        x = np.arange(-half, half+1)*dx
+        kernels.append(np.exp(-coeff*x**2))
+    if Normalise:
+        kernels = [k/k.sum() for k in kernels]
+    return kernels
+
+def _convolveGaussianStack(Ain, Aout, CellSizeRad, GaussPars, Normalise=False, nthreads=1, AllowDirect=False):
+    """Convolves a stack of images with the same Gaussian
+       @param Ain: input array of size [nimages, Ny, Nx]
+       @param Aout: output array of the same size (can be the same as Ain)
+       @param AllowDirect: convolve small separable Gaussians directly, rather than via FFTs
+    """
+    nimg, npix_y, npix_x = Ain.shape
+    assert npix_y == npix_x, "Only supports square grids at the moment"
+    if AllowDirect:
+        kernels = _giveSeparableGaussKernels(npix_x, CellSizeRad, GaussPars, Normalise)
+        if kernels is not None:
+            k0, k1 = kernels
+            for i in range(nimg):
+                A = scipy.ndimage.convolve1d(Ain[i], k0, axis=0, mode="constant")
+                Aout[i] = scipy.ndimage.convolve1d(A, k1, axis=1, mode="constant")
+            return
+    # The FFT needs to be big enough to avoid spectral leakage in the
+    # transforms, so we pad both sides of the stack of images with the same
+    # number of pixels. This preserves the baseband component correctly:
+    # Even - 4 pixels becomes 6 for instance:
+    #   |   |   |  x  |    | => |    |    |    |  x  |    |    |
+    # Odd - 3 pixels becomes 5 for instance:
+    #   |   |  x  |   | => |   |   |  x  |   |   |
+    # IFFTShift will shift the central location down to 0 (middle + 1 and
+    # middle for even and odd respectively). After FFT the baseband is at
+    # 0 as expected. FFTShift can then recentre the FFT. Going back the
+    # IFF is again applied so baseband is at 0, ifft taken and FFTShift
+    # brings the central location back to middle + 1 and middle for even and
+    # odd respectively. The signal can then safely be unpadded
+    pad_edge = _givePadEdge(npix_x)
+    p = pad_edge//2
+    fPSF = _giveGaussKernelFT(npix_x, pad_edge, CellSizeRad, GaussPars, Normalise, nthreads)
+    npad = npix_x + pad_edge
+    axes = (-2, -1)
+    # several images go through each FFT: the float32 padded image, plus its complex64 transform, takes
+    # ~12 bytes per pixel
+    batch = max(GAUSS_FFT_BATCH_SIZE // (npad*npad*12), 1)
+    for i0 in range(0, nimg, batch):
+        i1 = min(i0+batch, nimg)
+        A = iFs(np.pad(Ain[i0:i1], ((0,0),(p,p),(p,p)), mode="constant"), axes=axes)
+        fA = pyfftw.interfaces.numpy_fft.rfft2(A, axes=axes, overwrite_input=True, threads=nthreads)
+        fA *= fPSF
+        Aout[i0:i1] = Fs(pyfftw.interfaces.numpy_fft.irfft2(fA, s=A.shape[-2:], axes=axes,
+                                                            overwrite_input=True, threads=nthreads),
+                         axes=axes)[:, p:p+npix_y, p:p+npix_x]
+
 # FFTW-based convolution
 def _convolveSingleGaussianFFTW(shareddict,
                                 field_in,
@@ -365,7 +769,8 @@ def _convolveSingleGaussianFFTW(shareddict,
                                 GaussPars_ch,
                                 Normalise = False,
                                 nthreads = 1,
-                                return_gaussian = False):
+                                return_gaussian = False,
+                                AllowDirect = False):
     """Convolves a single channel in a cube of nchan, npol, Ny, Nx
        @param shareddict: a dictionary containing an input and output array of size
        [nchans, npols, Ny, Nx]
@@ -377,61 +782,38 @@ def _convolveSingleGaussianFFTW(shareddict,
        @param nthreads: number of threads to use in FFTW
        @param Normalize: Normalize the gaussian amplitude
        @param return_gaussian: return the convolving Gaussian as well
+       @param AllowDirect: convolve small separable Gaussians directly, rather than via FFTs
     """
-    # The FFT needs to be big enough to avoid spectral leakage in the
-    # transforms, so we pad both sides of the stack of images with the same
-    # number of pixels. This preserves the baseband component correctly:
-    # Even - 4 pixels becomes 6 for instance:
-    #   |   |   |  x  |    | => |    |    |    |  x  |    |    |
-    # Odd - 3 pixels becomes 5 for instance:
-    #   |   |  x  |   | => |   |   |  x  |   |   |
-    # IFFTShift will shift the central location down to 0 (middle + 1 and
-    # middle for even and odd respectively). After FFT the baseband is at
-    # 0 as expected. FFTShift can then recentre the FFT. Going back the 
-    # IFF is again applied so baseband is at 0, ifft taken and FFTShift
-    # brings the central location back to middle + 1 and middle for even and
-    # odd respectively. The signal can then safely be unpadded
-
     T = ClassTimeIt.ClassTimeIt()
     T.disable()
     Ain = shareddict[field_in][ch]
     Aout = shareddict[field_out][ch]
-    T.timeit("init %d"%ch)
-    npol, npix_y, npix_x = Ain.shape
-    assert npix_y == npix_x, "Only supports square grids at the moment"
-    pad_edge = max(int(np.ceil((ModToolBox.EstimateNpix(npix_x)[1] - npix_x) /
-                               2.0) * 2),0)
-    PSF = np.pad(GiveGauss(npix_x, CellSizeRad, GaussPars_ch, parallel=True),
-                 ((pad_edge//2,pad_edge//2),(pad_edge//2,pad_edge//2)),
-                 mode="constant")
-
-    if Normalise:
-        PSF /= np.sum(PSF)
-    T.timeit("givegauss %d"%ch)
-    fPSF = pyfftw.interfaces.numpy_fft.rfft2(iFs(PSF),
-                                             overwrite_input=True,
-                                             threads=nthreads)
-    fPSF = np.abs(fPSF)
-    for pol in range(npol):
-        A = iFs(np.pad(Ain[pol],
-                       ((pad_edge//2,pad_edge//2),(pad_edge//2,pad_edge//2)),
-                       mode="constant"))
-        fA = pyfftw.interfaces.numpy_fft.rfft2(A, overwrite_input=True,
-                                               threads=nthreads)
-        nfA = fA*fPSF
-        Aout[pol, :, :] = Fs(
-            pyfftw.interfaces.numpy_fft.irfft2(nfA,
-                                               s=A.shape,
-                                               overwrite_input=True,
-                                               threads=nthreads))[pad_edge//2:pad_edge//2+npix_y,
-                                                                  pad_edge//2:pad_edge//2+npix_x]
+    _convolveGaussianStack(Ain, Aout, CellSizeRad, GaussPars_ch, Normalise=Normalise, nthreads=nthreads,
+                           AllowDirect=AllowDirect)
     T.timeit("convolve %d" % ch)
 
     if return_gaussian:
-        return Aout,PSF
+        npix = Ain.shape[-1]
+        return Aout,_givePaddedGauss(npix, _givePadEdge(npix), CellSizeRad, GaussPars_ch, Normalise)
     else:
         return Aout
 
+def _convolveChannelsGaussianFFTW(shareddict, field_in, field_out, ch0, ch1, CellSizeRad, GaussPars,
+                                  Normalise = False, nthreads = 1, AllowDirect = False):
+    """Convolves channels ch0 to ch1-1 of a cube of nchan, npol, Ny, Nx with the same Gaussian.
+       All the channel and polarization planes are batched together into multi-dimensional FFTs."""
+    Ain = shareddict[field_in][ch0:ch1]
+    Aout = shareddict[field_out][ch0:ch1]
+    shape = Ain.shape
+    Ain = Ain.reshape((-1,) + shape[-2:])
+    Aout1 = Aout.reshape((-1,) + shape[-2:])
+    _convolveGaussianStack(Ain, Aout1, CellSizeRad, GaussPars, Normalise=Normalise, nthreads=nthreads,
+                           AllowDirect=AllowDirect)
+    # reshape() only copies if the slice is not contiguous, in which case the result must be copied back
+    if not np.may_share_memory(Aout, Aout1):
+        Aout[...] = Aout1.reshape(shape)
+    return None
+
 # LAPACK / ATLAS-based convolution
 def _convolveSingleGaussianNP(shareddict, field_in, field_out, ch,
                               CellSizeRad, GaussPars_ch,
@@ -498,19 +880,30 @@ def _convolveSingleGaussianNP(shareddict, field_in, field_out, ch,
 
 ConvolveGaussian = _convolveSingleGaussianFFTW
 
-def ConvolveGaussianParallel(shareddict, field_in, field_out, CellSizeRad=None,GaussPars=[(0.,0.,0.)],Normalise=False):
-    """Convolves images held in a dict, using APP.
+def ConvolveGaussianParallel(shareddict, field_in, field_out, CellSizeRad=None,GaussPars=[(0.,0.,0.)],Normalise=False,
+                             AllowDirect=False):
+    """Convolves images held in a dict, using APP. Consecutive channels sharing the same Gaussian are
+    convolved together in one job (with no more channels per job than are needed to keep all workers busy).
     """
     Ain0 = shareddict[field_in]
     nch,npol,_,_=Ain0.shape
     Aout = shareddict[field_out]
     # single channel? Handle serially
     if nch == 1:
-        return ConvolveGaussian(shareddict, field_in, field_out, 0, CellSizeRad, GaussPars[0], Normalise)
+        return ConvolveGaussian(shareddict, field_in, field_out, 0, CellSizeRad, GaussPars[0], Normalise,
+                                AllowDirect=AllowDirect)
 
+    max_chan_per_job = max(int(np.ceil(nch/float(APP.ncpu or 1))), 1)
     jobid = "convolve:%s:%s:" % (field_in, field_out)
-    for ch in range(nch):
-        APP.runJob(jobid+str(ch),_convolveSingleGaussianFFTW_noret, args=(shareddict.readwrite(), field_in, field_out, ch, CellSizeRad, GaussPars[ch], Normalise))
+    ch0 = 0
+    while ch0 < nch:
+        ch1 = ch0 + 1
+        while ch1 < nch and ch1 - ch0 < max_chan_per_job and tuple(GaussPars[ch1]) == tuple(GaussPars[ch0]):
+            ch1 += 1
+        APP.runJob("%s%d:%d" % (jobid, ch0, ch1), _convolveChannelsGaussianFFTW,
+                   args=(shareddict.readwrite(), field_in, field_out, ch0, ch1, CellSizeRad, GaussPars[ch0], Normalise),
+                   kwargs=dict(AllowDirect=AllowDirect))
+        ch0 = ch1
     APP.awaitJobResults(jobid+"*") #, progress="Convolving")
 
     return Aout
@@ -525,7 +918,7 @@ def _convolveSingleGaussianNP_noret(*args,**kw):
     _convolveSingleGaussianNP(*args,**kw)
     return None
 
-APP.registerJobHandlers(_convolveSingleGaussianFFTW_noret, _convolveSingleGaussianNP_noret)
+APP.registerJobHandlers(_convolveSingleGaussianFFTW_noret, _convolveSingleGaussianNP_noret, _convolveChannelsGaussianFFTW)
 
 ## FFTW version
 #def ConvolveGaussianFFTW(Ain0,